@@ -0,0 +1,38 @@
+from sqlalchemy import func, case
+from app.models import DailyReport
+
+def total(column):
+    """SUM of column over the range; 0 when there are no values."""
+    return func.coalesce(func.sum(column), 0)
+
+def average(column, where=None):
+    """AVG of column over the rows matching where (default: non-zero values); 0 when none match.
+
+    NULLs never count, matching how the reports leave days without a figure empty.
+    """
+    if where is None:
+        where = column != 0
+    return func.coalesce(func.avg(case((where, column))), 0)
+
+def count(where):
+    """Number of rows in the range matching where."""
+    return func.count(case((where, 1)))
+
+def aggregate_range(session, pharmacy_code, start_date, end_date, group_by=None, **measures):
+    """Computes measures (name=expression, built from total/average/count) over the pharmacy's DailyReport
+    rows between start_date and end_date inclusive, in a single SELECT.
+
+    Returns a dict of name -> value, or with group_by (a column or SQL expression) a list of such dicts,
+    one per group in group order, each with the group's value under "group". Only the aggregates come
+    back from the database, so the cost doesn't grow with the number of rows in the range.
+    """
+    labelled = [expression.label(name) for name, expression in measures.items()]
+    query = session.query(*labelled).filter(
+        DailyReport.pharmacy_code == pharmacy_code,
+        DailyReport.report_date >= start_date,
+        DailyReport.report_date <= end_date
+    )
+    if group_by is None:
+        return dict(query.one()._mapping)
+    rows = query.add_columns(group_by.label("group")).group_by(group_by).order_by(group_by)
+    return [dict(row._mapping) for row in rows]
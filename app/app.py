@@ -1,9 +1,15 @@
 from flask import jsonify, request, Blueprint, Flask, g
-from app.models import DailyReport
+from app.models import DailyReport, MonthToDateReport, IngestionJob
+from app.rollups import refresh_rollups
+from app.series import read_series, read_fields, SERIES_FIELDS, DERIVED_FIELDS, GRANULARITIES
+from app.dashboard import DASHBOARDS, summary
 from app.db import create_session, cleanup_db_sessions
-import subprocess
+from app.idle_watcher import start_idle_watchers
+from app.scheduler import IngestionScheduler
+from app.jobs import enqueue_job, job_to_dict
+from app.leader import LeaderElector, lease_status
+from config.settings import FETCH_MODE, JOB_RUNNER
 import threading
-import time
 import os
 import psutil
 from flask_cors import CORS
@@ -104,10 +110,13 @@ def token_required(f):
     return decorated
 
 def authorize_pharmacy(f):
-    """Decorator to check if the user is allowed to access the requested pharmacy."""
+    """Decorator to check if the user is allowed to access the requested pharmacy.
+
+    The pharmacy comes from a <pharmacy> URL segment if the route has one, otherwise the X-Pharmacy header.
+    """
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        pharmacy_code = request.headers.get('X-Pharmacy')
+        pharmacy_code = kwargs.get('pharmacy') or request.headers.get('X-Pharmacy')
         if not pharmacy_code:
             return jsonify({"error": "X-Pharmacy header is required"}), 400
         
@@ -166,15 +175,96 @@ def get_turnover():
 def get_turnover_for_range(start_date, end_date):
     pharmacy = request.headers.get('X-Pharmacy') or request.args.get('pharmacy')
     session = create_session()
-    query = session.query(DailyReport).filter(
-        DailyReport.pharmacy_code == pharmacy,
-        DailyReport.report_date >= start_date,
-        DailyReport.report_date <= end_date
-    )
-    reports = query.all()
-    turnover = sum([r.total_turnover_today for r in reports if r.total_turnover_today])
+    cards = summary(session, pharmacy, start_date, end_date)
     session.close()
-    return jsonify({'pharmacy': pharmacy, 'turnover': turnover})
+    return jsonify({'pharmacy': pharmacy, 'turnover': cards['turnover']})
+
+@api_bp.route('/month_to_date/<month>', methods=['GET'])
+@token_required
+@authorize_pharmacy
+@memory_cleanup
+def get_month_to_date(month):
+    """Month totals (YYYY-MM) as reported in the latest report's "This Month" column; one indexed row lookup."""
+    pharmacy = request.headers.get('X-Pharmacy') or request.args.get('pharmacy')
+    session = create_session()
+    snapshot = session.query(MonthToDateReport).filter(
+        MonthToDateReport.pharmacy_code == pharmacy,
+        MonthToDateReport.month == month
+    ).first()
+    if not snapshot:
+        session.close()
+        return jsonify({'pharmacy': pharmacy, 'month': month, 'found': False}), 404
+    totals = {
+        column.name: getattr(snapshot, column.name)
+        for column in MonthToDateReport.__table__.columns
+        if column.name.endswith('_mtd')
+    }
+    as_of_date = snapshot.as_of_date.strftime('%Y-%m-%d')
+    session.close()
+    return jsonify({
+        'pharmacy': pharmacy,
+        'month': month,
+        'found': True,
+        'as_of_date': as_of_date,
+        'totals': totals
+    })
+
+@api_bp.route('/series', methods=['GET'])
+@token_required
+@authorize_pharmacy
+@memory_cleanup
+def get_series():
+    """Several metrics in one request: ?fields=a,b,c&start=YYYY-MM-DD&end=YYYY-MM-DD&granularity=day|week|month.
+
+    fields are DailyReport column names (see SERIES_FIELDS) or DERIVED_FIELDS; see read_fields for how
+    weeks and months are aggregated.
+    """
+    pharmacy = request.headers.get('X-Pharmacy') or request.args.get('pharmacy')
+    fields = list(dict.fromkeys(field.strip() for field in request.args.get('fields', '').split(',') if field.strip()))
+    start_date = request.args.get('start')
+    end_date = request.args.get('end')
+    granularity = request.args.get('granularity', 'day')
+    if not fields or not start_date or not end_date:
+        return jsonify({
+            'error': 'fields, start and end are required',
+            'available_fields': sorted(SERIES_FIELDS) + sorted(DERIVED_FIELDS),
+            'granularities': list(GRANULARITIES)
+        }), 400
+
+    session = create_session()
+    try:
+        series = read_fields(session, pharmacy, start_date, end_date, fields, granularity)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    finally:
+        session.close()
+    return jsonify({
+        'pharmacy': pharmacy,
+        'start': start_date,
+        'end': end_date,
+        'granularity': granularity,
+        'fields': fields,
+        'series': series
+    })
+
+@api_bp.route('/dashboard/<view>/<pharmacy>/<period>', methods=['GET'])
+@token_required
+@authorize_pharmacy
+@memory_cleanup
+def get_dashboard(view, pharmacy, period):
+    """Everything one dashboard screen shows, in one response: view is daily (period YYYY-MM-DD), monthly
+    (YYYY-MM-DD for month to date, or YYYY-MM), yearly (YYYY-MM-DD for year to date, or YYYY) or stock
+    (YYYY-MM-DD or YYYY-MM). See app/dashboard.py."""
+    if view not in DASHBOARDS:
+        return jsonify({'error': f"Unknown dashboard '{view}'", 'available': list(DASHBOARDS)}), 404
+    session = create_session()
+    try:
+        bundle = DASHBOARDS[view](session, pharmacy, period)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    finally:
+        session.close()
+    return jsonify(dict(pharmacy=pharmacy, view=view, **bundle))
 
 @api_bp.route('/daily_turnover_for_range/<start_date>/<end_date>', methods=['GET'])
 @token_required
@@ -183,16 +273,7 @@ def get_turnover_for_range(start_date, end_date):
 def get_daily_turnover_for_range(start_date, end_date):
     pharmacy = request.headers.get('X-Pharmacy') or request.args.get('pharmacy')
     session = create_session()
-    query = session.query(DailyReport).filter(
-        DailyReport.pharmacy_code == pharmacy,
-        DailyReport.report_date >= start_date,
-        DailyReport.report_date <= end_date
-    ).order_by(DailyReport.report_date)
-    reports = query.all()
-    daily_turnover = [
-        {"date": r.report_date.strftime('%Y-%m-%d'), "turnover": r.total_turnover_today or 0}
-        for r in reports
-    ]
+    daily_turnover = read_series(session, pharmacy, start_date, end_date, turnover=DailyReport.total_turnover_today)
     session.close()
     return jsonify({"pharmacy": pharmacy, "daily_turnover": daily_turnover})
 
@@ -203,19 +284,9 @@ def get_daily_turnover_for_range(start_date, end_date):
 def get_daily_avg_basket_for_range(start_date, end_date):
     pharmacy = request.headers.get('X-Pharmacy') or request.args.get('pharmacy')
     session = create_session()
-    query = session.query(DailyReport).filter(
-        DailyReport.pharmacy_code == pharmacy,
-        DailyReport.report_date >= start_date,
-        DailyReport.report_date <= end_date
-    ).order_by(DailyReport.report_date)
-    reports = query.all()
-    daily_avg_basket = [
-        {
-            "date": r.report_date.strftime('%Y-%m-%d'),
-            "avg_basket_value": round(r.avg_value_per_basket, 2) if r.avg_value_per_basket else 0
-        }
-        for r in reports
-    ]
+    daily_avg_basket = read_series(session, pharmacy, start_date, end_date, avg_basket_value=DailyReport.avg_value_per_basket)
+    for day in daily_avg_basket:
+        day["avg_basket_value"] = round(day["avg_basket_value"], 2)
     session.close()
     return jsonify({"pharmacy": pharmacy, "daily_avg_basket": daily_avg_basket})
 
@@ -226,25 +297,13 @@ def get_daily_avg_basket_for_range(start_date, end_date):
 def get_avg_basket_for_range(start_date, end_date):
     pharmacy = request.headers.get('X-Pharmacy') or request.args.get('pharmacy')
     session = create_session()
-    query = session.query(DailyReport).filter(
-        DailyReport.pharmacy_code == pharmacy,
-        DailyReport.report_date >= start_date,
-        DailyReport.report_date <= end_date
-    )
-    reports = query.all()
-    valid_reports = [r for r in reports if r.avg_value_per_basket and r.avg_value_per_basket > 0]
-    if valid_reports:
-        avg_basket_value = sum(r.avg_value_per_basket for r in valid_reports) / len(valid_reports)
-        avg_basket_size = sum(r.avg_items_per_basket for r in valid_reports) / len(valid_reports)
-    else:
-        avg_basket_value = 0
-        avg_basket_size = 0
+    cards = summary(session, pharmacy, start_date, end_date)
     session.close()
     return jsonify({
         'pharmacy': pharmacy,
-        'avg_basket_value': round(avg_basket_value, 2),
-        'avg_basket_size': round(avg_basket_size, 2),
-        'days_counted': len(valid_reports)
+        'avg_basket_value': cards['avg_basket_value'],
+        'avg_basket_size': cards['avg_basket_size'],
+        'days_counted': cards['basket_days_counted']
     })
 
 @api_bp.route('/gp_for_range/<start_date>/<end_date>', methods=['GET'])
@@ -254,24 +313,13 @@ def get_avg_basket_for_range(start_date, end_date):
 def get_gp_for_range(start_date, end_date):
     pharmacy = request.headers.get('X-Pharmacy') or request.args.get('pharmacy')
     session = create_session()
-    query = session.query(DailyReport).filter(
-        DailyReport.pharmacy_code == pharmacy,
-        DailyReport.report_date >= start_date,
-        DailyReport.report_date <= end_date
-    )
-    reports = query.all()
-    valid_gp_percent = [r.stock_gross_profit_percent_today for r in reports if r.stock_gross_profit_percent_today not in (None, 0)]
-    if valid_gp_percent:
-        avg_gp_percent = sum(valid_gp_percent) / len(valid_gp_percent)
-    else:
-        avg_gp_percent = 0
-    cumulative_gp_value = sum(r.stock_gross_profit_today for r in reports if r.stock_gross_profit_today)
+    cards = summary(session, pharmacy, start_date, end_date)
     session.close()
     return jsonify({
         'pharmacy': pharmacy,
-        'avg_gp_percent': round(avg_gp_percent, 2),
-        'cumulative_gp_value': round(cumulative_gp_value, 2),
-        'days_counted': len(valid_gp_percent)
+        'avg_gp_percent': cards['avg_gp_percent'],
+        'cumulative_gp_value': cards['cumulative_gp_value'],
+        'days_counted': cards['gp_days_counted']
     })
 
 @api_bp.route('/costs_for_range/<start_date>/<end_date>', methods=['GET'])
@@ -281,19 +329,12 @@ def get_gp_for_range(start_date, end_date):
 def get_costs_for_range(start_date, end_date):
     pharmacy = request.headers.get('X-Pharmacy') or request.args.get('pharmacy')
     session = create_session()
-    query = session.query(DailyReport).filter(
-        DailyReport.pharmacy_code == pharmacy,
-        DailyReport.report_date >= start_date,
-        DailyReport.report_date <= end_date
-    )
-    reports = query.all()
-    cost_of_sales = sum(r.cost_of_sales_today for r in reports if r.cost_of_sales_today)
-    purchases = sum(r.stock_purchases_today for r in reports if r.stock_purchases_today)
+    cards = summary(session, pharmacy, start_date, end_date)
     session.close()
     return jsonify({
         'pharmacy': pharmacy,
-        'cost_of_sales': round(cost_of_sales, 2),
-        'purchases': round(purchases, 2)
+        'cost_of_sales': cards['cost_of_sales'],
+        'purchases': cards['purchases']
     })
 
 @api_bp.route('/transactions_for_range/<start_date>/<end_date>', methods=['GET'])
@@ -303,19 +344,12 @@ def get_costs_for_range(start_date, end_date):
 def get_transactions_for_range(start_date, end_date):
     pharmacy = request.headers.get('X-Pharmacy') or request.args.get('pharmacy')
     session = create_session()
-    query = session.query(DailyReport).filter(
-        DailyReport.pharmacy_code == pharmacy,
-        DailyReport.report_date >= start_date,
-        DailyReport.report_date <= end_date
-    )
-    reports = query.all()
-    total_transactions = sum(r.sales_total_trans_today for r in reports if r.sales_total_trans_today)
-    total_scripts = sum(r.scripts_dispensed_today for r in reports if r.scripts_dispensed_today)
+    cards = summary(session, pharmacy, start_date, end_date)
     session.close()
     return jsonify({
         'pharmacy': pharmacy,
-        'total_transactions': int(total_transactions),
-        'total_scripts': int(total_scripts)
+        'total_transactions': cards['total_transactions'],
+        'total_scripts': cards['total_scripts']
     })
 
 @api_bp.route('/dispensary_vs_total_turnover/<start_date>/<end_date>', methods=['GET'])
@@ -325,21 +359,13 @@ def get_transactions_for_range(start_date, end_date):
 def get_dispensary_vs_total_turnover(start_date, end_date):
     pharmacy = request.headers.get('X-Pharmacy') or request.args.get('pharmacy')
     session = create_session()
-    query = session.query(DailyReport).filter(
-        DailyReport.pharmacy_code == pharmacy,
-        DailyReport.report_date >= start_date,
-        DailyReport.report_date <= end_date
-    )
-    reports = query.all()
-    dispensary_turnover = sum(r.dispensary_turnover_today for r in reports if r.dispensary_turnover_today)
-    total_turnover = sum(r.total_turnover_today for r in reports if r.total_turnover_today)
+    cards = summary(session, pharmacy, start_date, end_date)
     session.close()
-    percent = (dispensary_turnover / total_turnover * 100) if total_turnover else 0
     return jsonify({
         'pharmacy': pharmacy,
-        'dispensary_turnover': round(dispensary_turnover, 2),
-        'total_turnover': round(total_turnover, 2),
-        'percent': round(percent, 2)
+        'dispensary_turnover': cards['dispensary_turnover'],
+        'total_turnover': cards['turnover'],
+        'percent': cards['dispensary_percent']
     })
 
 @api_bp.route('/daily_purchases_for_range/<start_date>/<end_date>', methods=['GET'])
@@ -349,16 +375,7 @@ def get_dispensary_vs_total_turnover(start_date, end_date):
 def get_daily_purchases_for_range(start_date, end_date):
     pharmacy = request.headers.get('X-Pharmacy') or request.args.get('pharmacy')
     session = create_session()
-    query = session.query(DailyReport).filter(
-        DailyReport.pharmacy_code == pharmacy,
-        DailyReport.report_date >= start_date,
-        DailyReport.report_date <= end_date
-    ).order_by(DailyReport.report_date)
-    reports = query.all()
-    daily_purchases = [
-        {"date": r.report_date.strftime('%Y-%m-%d'), "purchases": r.stock_purchases_today or 0}
-        for r in reports
-    ]
+    daily_purchases = read_series(session, pharmacy, start_date, end_date, purchases=DailyReport.stock_purchases_today)
     session.close()
     return jsonify({"pharmacy": pharmacy, "daily_purchases": daily_purchases})
 
@@ -369,16 +386,7 @@ def get_daily_purchases_for_range(start_date, end_date):
 def get_daily_cost_of_sales_for_range(start_date, end_date):
     pharmacy = request.headers.get('X-Pharmacy') or request.args.get('pharmacy')
     session = create_session()
-    query = session.query(DailyReport).filter(
-        DailyReport.pharmacy_code == pharmacy,
-        DailyReport.report_date >= start_date,
-        DailyReport.report_date <= end_date
-    ).order_by(DailyReport.report_date)
-    reports = query.all()
-    daily_cost_of_sales = [
-        {"date": r.report_date.strftime('%Y-%m-%d'), "cost_of_sales": r.cost_of_sales_today or 0}
-        for r in reports
-    ]
+    daily_cost_of_sales = read_series(session, pharmacy, start_date, end_date, cost_of_sales=DailyReport.cost_of_sales_today)
     session.close()
     return jsonify({"pharmacy": pharmacy, "daily_cost_of_sales": daily_cost_of_sales})
 
@@ -389,16 +397,7 @@ def get_daily_cost_of_sales_for_range(start_date, end_date):
 def get_daily_cash_sales_for_range(start_date, end_date):
     pharmacy = request.headers.get('X-Pharmacy') or request.args.get('pharmacy')
     session = create_session()
-    query = session.query(DailyReport).filter(
-        DailyReport.pharmacy_code == pharmacy,
-        DailyReport.report_date >= start_date,
-        DailyReport.report_date <= end_date
-    ).order_by(DailyReport.report_date)
-    reports = query.all()
-    daily_cash_sales = [
-        {"date": r.report_date.strftime('%Y-%m-%d'), "cash_sales": r.cash_sales_today or 0}
-        for r in reports
-    ]
+    daily_cash_sales = read_series(session, pharmacy, start_date, end_date, cash_sales=DailyReport.cash_sales_today)
     session.close()
     return jsonify({"pharmacy": pharmacy, "daily_cash_sales": daily_cash_sales})
 
@@ -409,16 +408,7 @@ def get_daily_cash_sales_for_range(start_date, end_date):
 def get_daily_account_sales_for_range(start_date, end_date):
     pharmacy = request.headers.get('X-Pharmacy') or request.args.get('pharmacy')
     session = create_session()
-    query = session.query(DailyReport).filter(
-        DailyReport.pharmacy_code == pharmacy,
-        DailyReport.report_date >= start_date,
-        DailyReport.report_date <= end_date
-    ).order_by(DailyReport.report_date)
-    reports = query.all()
-    daily_account_sales = [
-        {"date": r.report_date.strftime('%Y-%m-%d'), "account_sales": r.account_sales_today or 0}
-        for r in reports
-    ]
+    daily_account_sales = read_series(session, pharmacy, start_date, end_date, account_sales=DailyReport.account_sales_today)
     session.close()
     return jsonify({"pharmacy": pharmacy, "daily_account_sales": daily_account_sales})
 
@@ -429,16 +419,7 @@ def get_daily_account_sales_for_range(start_date, end_date):
 def get_daily_cod_sales_for_range(start_date, end_date):
     pharmacy = request.headers.get('X-Pharmacy') or request.args.get('pharmacy')
     session = create_session()
-    query = session.query(DailyReport).filter(
-        DailyReport.pharmacy_code == pharmacy,
-        DailyReport.report_date >= start_date,
-        DailyReport.report_date <= end_date
-    ).order_by(DailyReport.report_date)
-    reports = query.all()
-    daily_cod_sales = [
-        {"date": r.report_date.strftime('%Y-%m-%d'), "cod_sales": r.cod_sales_today or 0}
-        for r in reports
-    ]
+    daily_cod_sales = read_series(session, pharmacy, start_date, end_date, cod_sales=DailyReport.cod_sales_today)
     session.close()
     return jsonify({"pharmacy": pharmacy, "daily_cod_sales": daily_cod_sales})
 
@@ -449,16 +430,7 @@ def get_daily_cod_sales_for_range(start_date, end_date):
 def get_daily_cash_tenders_for_range(start_date, end_date):
     pharmacy = request.headers.get('X-Pharmacy') or request.args.get('pharmacy')
     session = create_session()
-    query = session.query(DailyReport).filter(
-        DailyReport.pharmacy_code == pharmacy,
-        DailyReport.report_date >= start_date,
-        DailyReport.report_date <= end_date
-    ).order_by(DailyReport.report_date)
-    reports = query.all()
-    daily_cash_tenders = [
-        {"date": r.report_date.strftime('%Y-%m-%d'), "cash_tenders_today": r.cash_tenders_today or 0}
-        for r in reports
-    ]
+    daily_cash_tenders = read_series(session, pharmacy, start_date, end_date, cash_tenders_today=DailyReport.cash_tenders_today)
     session.close()
     return jsonify({"pharmacy": pharmacy, "daily_cash_tenders": daily_cash_tenders})
 
@@ -469,16 +441,7 @@ def get_daily_cash_tenders_for_range(start_date, end_date):
 def get_daily_credit_card_tenders_for_range(start_date, end_date):
     pharmacy = request.headers.get('X-Pharmacy') or request.args.get('pharmacy')
     session = create_session()
-    query = session.query(DailyReport).filter(
-        DailyReport.pharmacy_code == pharmacy,
-        DailyReport.report_date >= start_date,
-        DailyReport.report_date <= end_date
-    ).order_by(DailyReport.report_date)
-    reports = query.all()
-    daily_credit_card_tenders = [
-        {"date": r.report_date.strftime('%Y-%m-%d'), "credit_card_tenders_today": r.credit_card_tenders_today or 0}
-        for r in reports
-    ]
+    daily_credit_card_tenders = read_series(session, pharmacy, start_date, end_date, credit_card_tenders_today=DailyReport.credit_card_tenders_today)
     session.close()
     return jsonify({"pharmacy": pharmacy, "daily_credit_card_tenders": daily_credit_card_tenders})
 
@@ -489,16 +452,9 @@ def get_daily_credit_card_tenders_for_range(start_date, end_date):
 def get_daily_scripts_dispensed_for_range(start_date, end_date):
     pharmacy = request.headers.get('X-Pharmacy') or request.args.get('pharmacy')
     session = create_session()
-    query = session.query(DailyReport).filter(
-        DailyReport.pharmacy_code == pharmacy,
-        DailyReport.report_date >= start_date,
-        DailyReport.report_date <= end_date
-    ).order_by(DailyReport.report_date)
-    reports = query.all()
-    daily_scripts = [
-        {"date": r.report_date.strftime('%Y-%m-%d'), "scripts_dispensed": int(r.scripts_dispensed_today or 0)}
-        for r in reports
-    ]
+    daily_scripts = read_series(session, pharmacy, start_date, end_date, scripts_dispensed=DailyReport.scripts_dispensed_today)
+    for day in daily_scripts:
+        day["scripts_dispensed"] = int(day["scripts_dispensed"])
     session.close()
     return jsonify({"pharmacy": pharmacy, "daily_scripts_dispensed": daily_scripts})
 
@@ -509,16 +465,7 @@ def get_daily_scripts_dispensed_for_range(start_date, end_date):
 def get_daily_gp_percent_for_range(start_date, end_date):
     pharmacy = request.headers.get('X-Pharmacy') or request.args.get('pharmacy')
     session = create_session()
-    query = session.query(DailyReport).filter(
-        DailyReport.pharmacy_code == pharmacy,
-        DailyReport.report_date >= start_date,
-        DailyReport.report_date <= end_date
-    ).order_by(DailyReport.report_date)
-    reports = query.all()
-    daily_gp_percent = [
-        {"date": r.report_date.strftime('%Y-%m-%d'), "gp_percent": r.stock_gross_profit_percent_today if r.stock_gross_profit_percent_today is not None else 0}
-        for r in reports
-    ]
+    daily_gp_percent = read_series(session, pharmacy, start_date, end_date, gp_percent=DailyReport.stock_gross_profit_percent_today)
     session.close()
     return jsonify({"pharmacy": pharmacy, "daily_gp_percent": daily_gp_percent})
 
@@ -529,22 +476,7 @@ def get_daily_gp_percent_for_range(start_date, end_date):
 def get_daily_dispensary_percent_for_range(start_date, end_date):
     pharmacy = request.headers.get('X-Pharmacy') or request.args.get('pharmacy')
     session = create_session()
-    query = session.query(DailyReport).filter(
-        DailyReport.pharmacy_code == pharmacy,
-        DailyReport.report_date >= start_date,
-        DailyReport.report_date <= end_date
-    ).order_by(DailyReport.report_date)
-    reports = query.all()
-    daily_dispensary_percent = []
-    for r in reports:
-        if r.total_turnover_today and r.total_turnover_today != 0:
-            percent = (r.dispensary_turnover_today or 0) / r.total_turnover_today * 100
-        else:
-            percent = 0
-        daily_dispensary_percent.append({
-            "date": r.report_date.strftime('%Y-%m-%d'),
-            "dispensary_percent": percent
-        })
+    daily_dispensary_percent = read_fields(session, pharmacy, start_date, end_date, ["dispensary_percent"])
     session.close()
     return jsonify({"pharmacy": pharmacy, "daily_dispensary_percent": daily_dispensary_percent})
 
@@ -555,16 +487,7 @@ def get_daily_dispensary_percent_for_range(start_date, end_date):
 def get_daily_dispensary_turnover_for_range(start_date, end_date):
     pharmacy = request.headers.get('X-Pharmacy') or request.args.get('pharmacy')
     session = create_session()
-    query = session.query(DailyReport).filter(
-        DailyReport.pharmacy_code == pharmacy,
-        DailyReport.report_date >= start_date,
-        DailyReport.report_date <= end_date
-    ).order_by(DailyReport.report_date)
-    reports = query.all()
-    daily_dispensary_turnover = [
-        {"date": r.report_date.strftime('%Y-%m-%d'), "dispensary_turnover": r.dispensary_turnover_today or 0}
-        for r in reports
-    ]
+    daily_dispensary_turnover = read_series(session, pharmacy, start_date, end_date, dispensary_turnover=DailyReport.dispensary_turnover_today)
     session.close()
     return jsonify({"pharmacy": pharmacy, "daily_dispensary_turnover": daily_dispensary_turnover})
 
@@ -649,17 +572,11 @@ def get_opening_stock_for_range(start_date, end_date):
 def get_stock_adjustments_for_range(start_date, end_date):
     pharmacy = request.headers.get('X-Pharmacy') or request.args.get('pharmacy')
     session = create_session()
-    query = session.query(DailyReport).filter(
-        DailyReport.pharmacy_code == pharmacy,
-        DailyReport.report_date >= start_date,
-        DailyReport.report_date <= end_date
-    )
-    reports = query.all()
-    total_adjustments = sum(r.stock_adjustments_today for r in reports if r.stock_adjustments_today)
+    cards = summary(session, pharmacy, start_date, end_date)
     session.close()
     return jsonify({
         'pharmacy': pharmacy,
-        'stock_adjustments': round(total_adjustments, 2)
+        'stock_adjustments': cards['stock_adjustments']
     })
 
 @api_bp.route('/closing_stock_for_range/<start_date>/<end_date>', methods=['GET'])
@@ -1042,6 +959,9 @@ def add_manual_daily_report():
         if 'script_qty' in data:
             report.scripts_dispensed_today = int(data['script_qty'])
 
+        # Keep the monthly and yearly rollups in step with the edit; they are recomputed from the written row
+        session.flush()
+        refresh_rollups(session, [(pharmacy_code, date_obj)])
         session.commit()
         message = f'{message_action} for {pharmacy_code} on {date_str}'
         
@@ -1121,6 +1041,11 @@ def app_status():
             "memory_mb": round(memory_usage, 2),
             "thread_count": thread_count,
             "periodic_fetch_enabled": os.environ.get("RENDER") == "true",
+            "fetch_mode": FETCH_MODE,
+            "idle_watchers": {w.pharmacy_config["code"]: w.mode for w in _idle_watchers},
+            "ingestion": ingestion_scheduler.status(),
+            "job_runner": JOB_RUNNER,
+            "leader": _leader_status(),
             "environment": "production" if os.environ.get("RENDER") == "true" else "development"
         }), 200
     except Exception as e:
@@ -1129,6 +1054,16 @@ def app_status():
             "error": str(e)
         }), 500
 
+def _leader_status():
+    """Who holds the ingestion lease and what it last reported, as seen from this process."""
+    session = create_session()
+    try:
+        return lease_status(session, "ingestion", _leader.owner if _leader is not None else None)
+    except Exception as e:
+        return {"error": str(e)}
+    finally:
+        session.close()
+
 @api_bp.route('/health', methods=['GET'])
 @memory_cleanup
 def health_check():
@@ -1176,166 +1111,133 @@ def health_check():
 @api_bp.route('/force_update', methods=['POST'])
 @token_required
 def force_update():
+    """Queues a fetch and returns its job id straight away; poll /api/jobs/<id> for the result.
+
+    Clicking again while the fetch is still queued returns the same job instead of adding another.
+    """
     print("=== /api/force_update called ===", flush=True)
-    
-    # Check memory before starting
-    try:
-        initial_memory = psutil.Process(os.getpid()).memory_info().rss / 1024 ** 2
-        print(f"[Force Update] Memory before start: {initial_memory:.2f} MB", flush=True)
-        
-        if initial_memory > 150:  # Don't start if already high
-            return jsonify({
-                "status": "error", 
-                "message": f"Memory usage too high ({initial_memory:.2f} MB) to start update safely"
-            }), 503
-    except Exception as e:
-        print(f"Error checking memory: {e}", flush=True)
-    
+    body = request.get_json(silent=True) or {}
+    pharmacy_code = body.get('pharmacy') or request.args.get('pharmacy')
+    # Same allow-list as authorize_pharmacy; without a pharmacy every mailbox is fetched, as before
+    if pharmacy_code and pharmacy_code not in g.current_user['pharmacies']:
+        return jsonify({"error": "You are not authorized to access this pharmacy"}), 403
+    session = create_session()
     try:
-        print("Starting manual email fetch...", flush=True)
-        result = subprocess.run(
-            ['python3', 'scripts/fetch_latest.py'],
-            capture_output=True,
-            text=True,
-            timeout=300  # Reduced to 5 minutes to match periodic fetch
-        )
-        print("=== subprocess finished ===", flush=True)
-        
-        # Always log the output for debugging
-        if result.stdout:
-            print("stdout:", result.stdout, flush=True)
-        if result.stderr:
-            print("stderr:", result.stderr, flush=True)
-        
-        # Force garbage collection after subprocess
-        import gc
-        gc.collect()
-        
-        # Check final memory usage
-        try:
-            final_memory = psutil.Process(os.getpid()).memory_info().rss / 1024 ** 2
-            print(f"[Force Update] Memory after completion: {final_memory:.2f} MB", flush=True)
-        except Exception:
-            pass
-            
-        if result.returncode == 0:
-            return jsonify({
-                "status": "success", 
-                "message": "Email fetch completed successfully",
-                "output": result.stdout
-            }), 200
-        else:
-            error_msg = result.stderr if result.stderr else "Unknown error: no stderr output"
-            return jsonify({
-                "status": "error", 
-                "message": "Email fetch failed",
-                "error": error_msg,
-                "return_code": result.returncode
-            }), 500
-            
-    except subprocess.TimeoutExpired:
-        print("Force update timeout after 5 minutes", flush=True)
+        job, coalesced = enqueue_job(session, 'fetch', {"pharmacy_code": pharmacy_code} if pharmacy_code else {}, "force_update")
+        job_id = job.id
+        _start_job_worker()
         return jsonify({
-            "status": "error", 
-            "message": "Email fetch timed out after 5 minutes"
-        }), 500
-    except FileNotFoundError:
-        print("fetch_latest.py script not found", flush=True)
-        return jsonify({
-            "status": "error", 
-            "message": "Fetch script not found"
-        }), 500
+            "status": "queued",
+            "job_id": job_id,
+            "coalesced": coalesced,
+            "message": "Email fetch already queued" if coalesced else "Email fetch queued",
+            "status_url": f"/api/jobs/{job_id}"
+        }), 202
     except Exception as e:
         print("Exception in force_update:", str(e), flush=True)
         return jsonify({
             "status": "error", 
-            "message": "Unexpected error during email fetch",
+            "message": "Could not queue email fetch",
             "error": str(e)
         }), 500
+    finally:
+        session.close()
 
-def periodic_fetch():
-    # Wait 5 minutes after startup before starting periodic fetches
-    print("[Periodic Fetch] Waiting 5 minutes before starting periodic fetch...", flush=True)
-    time.sleep(300)  # Wait 5 minutes for system to stabilize
-    
-    while True:
-        print("=== [Periodic Fetch] Loop Start ===", flush=True)
-        try:
-            mem_usage = psutil.Process(os.getpid()).memory_info().rss / 1024 ** 2
-            print(f"[Periodic Fetch] Memory usage before: {mem_usage:.2f} MB", flush=True)
-            
-            # Much more aggressive memory threshold for Render
-            if mem_usage > 200:  # Reduced from 350MB to 200MB for Render
-                print(f"[Periodic Fetch] Memory usage exceeded 200MB, skipping this cycle.", flush=True)
-                # Don't exit, just skip this cycle
-                time.sleep(600)
-                continue
-            
-            try:
-                print("[Periodic Fetch] Starting email fetch process...", flush=True)
-                # Use a shorter timeout for production stability
-                result = subprocess.run(
-                    ['python3', 'scripts/fetch_latest.py'],
-                    capture_output=True,
-                    text=True,
-                    timeout=300  # Reduced to 5 minutes to prevent hanging
-                )
-                
-                if result.stdout:
-                    print(f"[Periodic Fetch] Script output:\n{result.stdout}", flush=True)
-                if result.stderr:
-                    print(f"[Periodic Fetch] Script errors:\n{result.stderr}", flush=True)
-                    
-                if result.returncode != 0:
-                    print(f"[Periodic Fetch] Script failed with return code: {result.returncode}", flush=True)
-                else:
-                    print("[Periodic Fetch] Email fetch completed successfully", flush=True)
-                    
-            except subprocess.TimeoutExpired:
-                print("[Periodic Fetch] Script timeout after 5 minutes, continuing...", flush=True)
-                # Kill any hanging processes
-                try:
-                    subprocess.run(['pkill', '-f', 'fetch_latest.py'], timeout=10)
-                except:
-                    pass
-            except FileNotFoundError:
-                print("[Periodic Fetch] Error: fetch_latest.py not found", flush=True)
-            except Exception as e:
-                print(f"[Periodic Fetch] Error running subprocess: {e}", flush=True)
-                
-        except Exception as e:
-            print(f"[Periodic Fetch] Unexpected error in periodic fetch loop: {e}", flush=True)
-        
-        # Force garbage collection after each cycle
-        import gc
-        gc.collect()
-        
-        try:
-            mem_usage_after = psutil.Process(os.getpid()).memory_info().rss / 1024 ** 2
-            print(f"[Periodic Fetch] Memory usage after: {mem_usage_after:.2f} MB", flush=True)
-            
-            # Additional safety check after processing
-            if mem_usage_after > 250:  # Even after cleanup, if still high, skip next few cycles
-                print(f"[Periodic Fetch] Memory still high after cleanup ({mem_usage_after:.2f} MB), sleeping longer...", flush=True)
-                time.sleep(1800)  # Sleep 30 minutes if memory is high
-                continue
-        except Exception as e:
-            print(f"[Periodic Fetch] Error checking memory after fetch: {e}", flush=True)
-            
-        print("=== [Periodic Fetch] Loop End, sleeping 600s ===", flush=True)
-        time.sleep(600)
+@api_bp.route('/jobs/<int:job_id>', methods=['GET'])
+@token_required
+def get_job(job_id):
+    session = create_session()
+    try:
+        job = session.query(IngestionJob).get(job_id)
+        if job is None:
+            return jsonify({'error': 'Job not found'}), 404
+        return jsonify(job_to_dict(job)), 200
+    finally:
+        session.close()
+
+# Fetches run in this process on the scheduler's single worker thread, so they never overlap and
+# reuse the app's database engine and pooled IMAP sessions
+ingestion_scheduler = IngestionScheduler()
+_idle_watchers = []
+
+def fetch_mailbox(pharmacy_code):
+    """Fetches a single mailbox. Called by the IDLE watchers when new mail arrives."""
+    ingestion_scheduler.run_now("idle", pharmacy_code)
+
+# With JOB_RUNNER=web, queued jobs are claimed by a thread in this process and run on the scheduler
+_job_worker = None
+_job_worker_lock = threading.Lock()
+
+def _start_job_worker():
+    global _job_worker
+    if JOB_RUNNER != "web":
+        return
+    # Under leader election only the leader runs jobs; it starts its worker when elected
+    if _leader is not None and not _leader.is_leader():
+        return
+    with _job_worker_lock:
+        if _job_worker is None:
+            # Imported here: app.worker is also run as a script (python -m app.worker), which imports this module
+            from app.worker import JobWorker
+            _job_worker = JobWorker(runner=lambda trigger, params: ingestion_scheduler.run_now(trigger, **params),
+                                    enabled=_leader.is_leader if _leader is not None else None)
+            threading.Thread(target=_job_worker.run, daemon=True, name="job-worker").start()
+    _job_worker.wake()
+
+# In production every web worker process competes for the ingestion lease once it serves its first request;
+# the one holding it runs the background fetches and jobs, the rest only serve requests (see app/leader.py)
+_leader = None
+_background_started = False
+_background_lock = threading.Lock()
+
+def _on_elected():
+    _start_job_worker()
+    if FETCH_MODE == "idle":
+        # One IMAP IDLE watcher per mailbox; each falls back to polling on its own
+        _idle_watchers.extend(start_idle_watchers(fetch_mailbox, should_run=_leader.is_leader))
+        print(f"[Leader] IMAP IDLE watchers started for {len(_idle_watchers)} mailbox(es)", flush=True)
+
+def _on_demoted():
+    for watcher in _idle_watchers:
+        watcher.stop()
+    _idle_watchers.clear()
+
+def _leader_info():
+    status = ingestion_scheduler.status()
+    return {"running": status["running"], "recent": status["recent"][:5], "fetch_mode": FETCH_MODE}
 
 def start_periodic_fetch_once():
-    # Only start in production environments and only in one process
+    global _leader
+    # Only start in production environments, and only act in the process that holds the ingestion lease
     if os.environ.get("RENDER") == "true":
-        # Only start periodic fetch in production on Render
-        # Use a separate thread that won't block the main application
-        threading.Thread(target=periodic_fetch, daemon=True).start()
-        print("[Startup] Periodic fetch thread started for Render environment", flush=True)
+        if JOB_RUNNER == "worker":
+            print("[Startup] Fetching is left to the job worker (python -m app.worker)", flush=True)
+            return
+        _leader = LeaderElector("ingestion", on_elected=_on_elected, on_demoted=_on_demoted, status=_leader_info)
+        ingestion_scheduler.lease = _leader
+        _leader.start()
+        print(f"[Startup] Competing for the ingestion lease as {_leader.owner}", flush=True)
+        if FETCH_MODE != "idle":
+            # Use a separate thread that won't block the main application; it skips cycles unless this process leads
+            ingestion_scheduler.start_periodic(should_run=_leader.is_leader)
+            print("[Startup] Periodic fetch thread started for Render environment", flush=True)
     else:
         print("[Startup] Periodic fetch disabled for local development", flush=True)
 
-start_periodic_fetch_once()
+@api_bp.before_app_request
+def _start_background_once():
+    """Starts the background fetching with the first request this process serves.
+
+    Not at import: python -m app.worker, the scripts and the reparse pool import this module too, and
+    must not compete for the ingestion lease or start fetch threads of their own.
+    """
+    global _background_started
+    if _background_started:
+        return
+    with _background_lock:
+        if not _background_started:
+            _background_started = True
+            start_periodic_fetch_once()
 
 app = Flask(__name__)
 CORS(app, resources={r"/api/*": {"origins": "https://webdashfront.onrender.com"}})
@@ -0,0 +1,118 @@
+import os
+import gzip
+import tempfile
+from app.models import ArchivedReport
+from app.ingest import payload_sha256
+from config.settings import REPORT_ARCHIVE_DIR
+
+try:
+    import zstandard
+except ImportError:  # zstandard is optional; gzip is always available
+    zstandard = None
+
+# Objects are named by the SHA-256 of the raw payload, so identical reports are stored once:
+# <REPORT_ARCHIVE_DIR>/objects/<first two hex chars>/<sha256>.<codec>
+DEFAULT_CODEC = 'zst' if zstandard is not None else 'gz'
+
+def _compress(payload, codec):
+    if codec == 'zst':
+        return zstandard.ZstdCompressor(level=10).compress(payload)
+    return gzip.compress(payload, compresslevel=9)
+
+def _decompress(data, codec):
+    if codec == 'zst':
+        if zstandard is None:
+            raise RuntimeError("Archive object is zstd-compressed but the zstandard package is not installed")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return gzip.decompress(data)
+
+def object_path(digest, codec, archive_dir=None):
+    return os.path.join(archive_dir or REPORT_ARCHIVE_DIR, 'objects', digest[:2], f"{digest}.{codec}")
+
+def _write_object(payload, digest, codec, archive_dir=None):
+    path = object_path(digest, codec, archive_dir)
+    if os.path.exists(path):
+        return path
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Write then rename, so a crash never leaves a truncated object behind
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(_compress(payload, codec))
+        os.replace(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+    return path
+
+def archive_report(session, payload, charset, message_id, pharmacy_code, report_date, digest=None, archive_dir=None):
+    """Stores a raw report payload (bytes or a binary file object) and indexes it. Returns the ArchivedReport.
+
+    The object is written immediately; the index row is added to the session and the caller commits.
+    """
+    if hasattr(payload, 'read'):
+        payload.seek(0)
+        raw = payload.read()
+        payload.seek(0)
+    else:
+        raw = payload
+    digest = digest or payload_sha256(raw)
+    message_id = message_id or ''
+
+    # Index rows added earlier in the same uncommitted batch are still pending in the session. They're
+    # matched there rather than flushed: a flush would hold the database write lock until the batch commits
+    key = (pharmacy_code, report_date, message_id, digest)
+    entry = next((
+        pending for pending in session.new
+        if isinstance(pending, ArchivedReport)
+        and (pending.pharmacy_code, pending.report_date, pending.message_id, pending.payload_sha256) == key
+    ), None)
+    if entry is None:
+        entry = session.query(ArchivedReport).filter_by(
+            pharmacy_code=pharmacy_code,
+            report_date=report_date,
+            message_id=message_id,
+            payload_sha256=digest
+        ).first()
+    if entry is not None and os.path.exists(object_path(digest, entry.codec, archive_dir)):
+        return entry
+
+    codec = entry.codec if entry is not None else DEFAULT_CODEC
+    _write_object(raw, digest, codec, archive_dir)
+    if entry is None:
+        entry = ArchivedReport(
+            pharmacy_code=pharmacy_code,
+            report_date=report_date,
+            message_id=message_id,
+            payload_sha256=digest,
+            charset=charset,
+            codec=codec,
+            size=len(raw)
+        )
+        session.add(entry)
+    return entry
+
+def read_archived(entry, archive_dir=None):
+    """Returns the raw payload bytes for an ArchivedReport, checking them against its SHA-256."""
+    with open(object_path(entry.payload_sha256, entry.codec, archive_dir), 'rb') as f:
+        payload = _decompress(f.read(), entry.codec)
+    if payload_sha256(payload) != entry.payload_sha256:
+        raise ValueError(f"Archive object {entry.payload_sha256} is corrupt")
+    return payload
+
+def latest_archived(session, pharmacy_code=None, start_date=None, end_date=None):
+    """Returns the most recently archived entry for each (pharmacy, report_date), ordered by pharmacy and date.
+
+    That is the report a live fetch would have left in daily_reports.
+    """
+    query = session.query(ArchivedReport)
+    if pharmacy_code:
+        query = query.filter(ArchivedReport.pharmacy_code == pharmacy_code)
+    if start_date:
+        query = query.filter(ArchivedReport.report_date >= start_date)
+    if end_date:
+        query = query.filter(ArchivedReport.report_date <= end_date)
+    latest = {}
+    for entry in query.order_by(ArchivedReport.id):
+        latest[(entry.pharmacy_code, entry.report_date)] = entry
+    return [latest[key] for key in sorted(latest)]
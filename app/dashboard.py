@@ -0,0 +1,223 @@
+"""
+Builds the per-view bundles served by /api/dashboard/<view>/<pharmacy>/<period>.
+
+Each builder returns everything one dashboard screen (frontend/src/views) shows for a period, computed
+in one session with a handful of statements: the cards from the rollup tables and partial-month daily
+rows (app/rollups.py), the charts from narrow series reads (app/series.py). The *_for_range summary
+endpoints return the same card values.
+"""
+import calendar
+import datetime
+from app.aggregates import aggregate_range, total
+from app.rollups import range_totals
+from app.series import read_series, read_fields
+from app.models import DailyReport
+
+# KPI cards and the range_totals (app/rollups.py) they come from: totals, and averages over the days counted
+SUMMARY_TOTALS = {
+    "turnover": "total_turnover_today",
+    "dispensary_turnover": "dispensary_turnover_today",
+    "cumulative_gp_value": "stock_gross_profit_today",
+    "cost_of_sales": "cost_of_sales_today",
+    "purchases": "stock_purchases_today",
+    "stock_adjustments": "stock_adjustments_today",
+    "total_transactions": "sales_total_trans_today",
+    "total_scripts": "scripts_dispensed_today",
+    "cash_sales": "cash_sales_today",
+    "account_sales": "account_sales_today",
+    "cod_sales": "cod_sales_today",
+    "cash_tenders": "cash_tenders_today",
+    "credit_card_tenders": "credit_card_tenders_today",
+}
+SUMMARY_AVERAGES = {
+    "avg_basket_value": "avg_value_per_basket",
+    "avg_basket_size": "avg_items_per_basket",
+    "avg_gp_percent": "stock_gross_profit_percent_today",
+}
+SUMMARY_DAYS_COUNTED = {
+    "basket_days_counted": "avg_value_per_basket_days",
+    "gp_days_counted": "stock_gross_profit_percent_today_days",
+}
+
+# Per-day chart columns of the monthly view, under the keys the daily_*_for_range endpoints use
+DAILY_CHART_COLUMNS = {
+    "turnover": DailyReport.total_turnover_today,
+    "dispensary_turnover": DailyReport.dispensary_turnover_today,
+    "purchases": DailyReport.stock_purchases_today,
+    "cost_of_sales": DailyReport.cost_of_sales_today,
+    "avg_basket_value": DailyReport.avg_value_per_basket,
+    "cash_sales": DailyReport.cash_sales_today,
+    "account_sales": DailyReport.account_sales_today,
+    "cod_sales": DailyReport.cod_sales_today,
+    "cash_tenders": DailyReport.cash_tenders_today,
+    "credit_card_tenders": DailyReport.credit_card_tenders_today,
+    "scripts_dispensed": DailyReport.scripts_dispensed_today,
+    "gp_percent": DailyReport.stock_gross_profit_percent_today,
+}
+
+# Month buckets for the yearly view's carousel charts (see read_fields for how they're aggregated)
+MONTHLY_CHART_FIELDS = [
+    "total_turnover_today", "dispensary_turnover_today", "stock_purchases_today", "cost_of_sales_today",
+    "avg_value_per_basket", "cash_sales_today", "account_sales_today", "cod_sales_today", "cash_tenders_today",
+    "credit_card_tenders_today", "scripts_dispensed_today", "stock_gross_profit_percent_today",
+]
+
+_PERIOD_FORMATS = {'%Y-%m-%d': 'YYYY-MM-DD', '%Y-%m': 'YYYY-MM', '%Y': 'YYYY'}
+
+def _parse_period(period, *formats):
+    """Returns (first day, last day) of period in the first of formats it matches; a date is a single day."""
+    for fmt in formats:
+        try:
+            parsed = datetime.datetime.strptime(period, fmt).date()
+        except ValueError:
+            continue
+        if fmt == '%Y':
+            return parsed, parsed.replace(month=12, day=31)
+        if fmt == '%Y-%m':
+            return parsed, parsed.replace(day=calendar.monthrange(parsed.year, parsed.month)[1])
+        return parsed, parsed
+    raise ValueError(f"Invalid period '{period}', expected {' or '.join(_PERIOD_FORMATS[fmt] for fmt in formats)}")
+
+def same_day_last_year(day):
+    """The same calendar day a year earlier; 29 February becomes 1 March, as the frontend's Date arithmetic does."""
+    return datetime.date(day.year - 1, day.month, 1) + datetime.timedelta(days=day.day - 1)
+
+def corresponding_day_last_year(day):
+    """The day closest to same_day_last_year that falls on the same weekday, for like-for-like comparisons."""
+    last_year = same_day_last_year(day)
+    # isoweekday() % 7 numbers the week from Sunday, like JavaScript's getDay()
+    return last_year + datetime.timedelta(days=day.isoweekday() % 7 - last_year.isoweekday() % 7)
+
+def summary(session, pharmacy_code, start, end):
+    """The KPI cards for a range, from the monthly/yearly rollups plus the days of any partial month."""
+    totals = range_totals(session, pharmacy_code, start, end)
+    cards = {name: round(totals[column], 2) for name, column in SUMMARY_TOTALS.items()}
+    cards["total_transactions"] = int(cards["total_transactions"])
+    cards["total_scripts"] = int(cards["total_scripts"])
+    for name, metric in SUMMARY_AVERAGES.items():
+        days = totals[f"{metric}_days"]
+        cards[name] = round(totals[f"{metric}_sum"] / days, 2) if days else 0
+    for name, column in SUMMARY_DAYS_COUNTED.items():
+        cards[name] = int(totals[column])
+    cards["dispensary_percent"] = round(cards["dispensary_turnover"] / cards["turnover"] * 100, 2) if cards["turnover"] else 0
+    return cards
+
+def _period(start, end):
+    return {"start": start.isoformat(), "end": end.isoformat()}
+
+def daily_bundle(session, pharmacy_code, period):
+    """DailyView: the day's cards, the turnover on the same weekday last year and a 14-day chart."""
+    day, _ = _parse_period(period, '%Y-%m-%d')
+    last_year = corresponding_day_last_year(day)
+    chart_start = day - datetime.timedelta(days=13)
+    return {
+        "period": _period(day, day),
+        "summary": summary(session, pharmacy_code, day, day),
+        "last_year": {
+            "date": last_year.isoformat(),
+            "turnover": aggregate_range(session, pharmacy_code, last_year, last_year,
+                                        turnover=total(DailyReport.total_turnover_today))["turnover"]
+        },
+        "chart": read_series(session, pharmacy_code, chart_start, day,
+                             turnover=DailyReport.total_turnover_today, avg_basket_value=DailyReport.avg_value_per_basket)
+    }
+
+def monthly_bundle(session, pharmacy_code, period):
+    """MonthlyView: month-to-date cards and per-day charts (YYYY-MM-DD), or the whole month (YYYY-MM),
+    with the same period a year earlier for the turnover comparison."""
+    first, end = _parse_period(period, '%Y-%m-%d', '%Y-%m')
+    start = first.replace(day=1)
+    previous_start, previous_end = same_day_last_year(start), same_day_last_year(end)
+    previous = read_series(session, pharmacy_code, previous_start, previous_end, turnover=DailyReport.total_turnover_today)
+    return {
+        "period": _period(start, end),
+        "summary": summary(session, pharmacy_code, start, end),
+        "daily": read_series(session, pharmacy_code, start, end, **DAILY_CHART_COLUMNS),
+        "previous_year": dict(_period(previous_start, previous_end),
+                              turnover=round(sum(day["turnover"] for day in previous), 2), daily=previous)
+    }
+
+def yearly_bundle(session, pharmacy_code, period):
+    """YearlyView: year-to-date cards (YYYY-MM-DD) or the whole year (YYYY), month buckets for the
+    carousel and daily turnover for this and last year's cumulative chart."""
+    first, end = _parse_period(period, '%Y-%m-%d', '%Y')
+    start = first.replace(month=1, day=1)
+    previous_start, previous_end = same_day_last_year(start), same_day_last_year(end)
+    previous = read_series(session, pharmacy_code, previous_start, previous_end, turnover=DailyReport.total_turnover_today)
+    return {
+        "period": _period(start, end),
+        "summary": summary(session, pharmacy_code, start, end),
+        "monthly": read_fields(session, pharmacy_code, start, end, MONTHLY_CHART_FIELDS, "month"),
+        "daily_turnover": read_series(session, pharmacy_code, start, end, turnover=DailyReport.total_turnover_today),
+        "previous_year": dict(_period(previous_start, previous_end),
+                              turnover=round(sum(day["turnover"] for day in previous), 2), daily_turnover=previous)
+    }
+
+def _add_months(day, months):
+    month = day.month - 1 + months
+    return datetime.date(day.year + month // 12, month % 12 + 1, 1)
+
+def stock_bundle(session, pharmacy_code, period):
+    """StockView: the month's stock cards up to the given day (YYYY-MM-DD) or for the whole month (YYYY-MM),
+    and closing stock for the 12 months ending with it."""
+    first, end = _parse_period(period, '%Y-%m-%d', '%Y-%m')
+    start = first.replace(day=1)
+    flows = aggregate_range(session, pharmacy_code, start, end, cost_of_sales=total(DailyReport.cost_of_sales_today),
+                            purchases=total(DailyReport.stock_purchases_today),
+                            stock_adjustments=total(DailyReport.stock_adjustments_today))
+
+    # Stock levels for the chart's 12 months plus the next one (its opening stock stands in for a missing
+    # month-end closing), read once; zero means the report had no figure
+    chart_start = _add_months(start, -11)
+    chart_end = _add_months(start, 2) - datetime.timedelta(days=1)
+    levels = read_series(session, pharmacy_code, chart_start, chart_end,
+                         opening=DailyReport.opening_stock_today, closing=DailyReport.closing_stock_today)
+    month_open, month_close = {}, {}
+    for day in levels:
+        month = day["date"][:7]
+        if day["opening"] > 0:
+            month_open.setdefault(month, day["opening"])
+        if day["closing"] > 0:
+            month_close[month] = day["closing"]
+
+    current = start.strftime('%Y-%m')
+    opening_stock = month_open.get(current, 0)
+    closing_stock = next((day["closing"] for day in reversed(levels) if day["date"] <= end.isoformat() and day["closing"] > 0), 0)
+    average_inventory = (opening_stock + closing_stock) / 2 if opening_stock + closing_stock > 0 else 1
+    avg_daily_cost_of_sales = flows["cost_of_sales"] / ((end - start).days + 1)
+
+    monthly_closing_stock = []
+    for offset in range(12):
+        month_date = _add_months(chart_start, offset)
+        month = month_date.strftime('%Y-%m')
+        next_month = _add_months(month_date, 1).strftime('%Y-%m')
+        fallback_used = month not in month_close and next_month in month_open
+        monthly_closing_stock.append({
+            "month": month,
+            "month_name": month_date.strftime('%b %Y'),
+            "closing_stock": round(month_close.get(month, month_open.get(next_month, 0)), 2),
+            "fallback_used": fallback_used
+        })
+
+    return {
+        "period": _period(start, end),
+        "summary": {
+            "opening_stock": round(opening_stock, 2),
+            "closing_stock": round(closing_stock, 2),
+            "purchases": round(flows["purchases"], 2),
+            "cost_of_sales": round(flows["cost_of_sales"], 2),
+            "stock_adjustments": round(flows["stock_adjustments"], 2),
+            "turnover_ratio": round(flows["cost_of_sales"] / average_inventory, 2),
+            "average_inventory": round(average_inventory, 2),
+            "days_of_inventory": round(closing_stock / avg_daily_cost_of_sales, 1) if avg_daily_cost_of_sales > 0 else 0,
+            "avg_daily_cost_of_sales": round(avg_daily_cost_of_sales, 2)
+        },
+        "monthly_closing_stock": monthly_closing_stock
+    }
+
+DASHBOARDS = {
+    "daily": daily_bundle,
+    "monthly": monthly_bundle,
+    "yearly": yearly_bundle,
+    "stock": stock_bundle,
+}
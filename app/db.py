@@ -2,17 +2,21 @@ import os
 os.makedirs('db', exist_ok=True)
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker, scoped_session
-from sqlalchemy.pool import StaticPool
+from sqlalchemy.pool import StaticPool, NullPool
 from app.models import Base
 from config.settings import DATABASE_URI # Import DATABASE_URI
 
 # Create engine with better memory management
 if DATABASE_URI.startswith('sqlite'):
-    # For SQLite, use more conservative settings
+    # For SQLite, use more conservative settings. Each session gets its own connection to a database
+    # file, so a commit or rollback on one thread (a request, a lease renewal) can't end the ingestion
+    # writer's transaction on another; SQLite's file locks serialise the writes. Only an in-memory
+    # database has to share a single connection, or every session would see a different database.
+    in_memory = DATABASE_URI in ('sqlite://', 'sqlite:///:memory:')
     engine = create_engine(
         DATABASE_URI, 
         echo=False,
-        poolclass=StaticPool,
+        poolclass=StaticPool if in_memory else NullPool,
         pool_pre_ping=True,
         connect_args={
             'check_same_thread': False,
@@ -31,6 +35,33 @@ else:
         pool_size=2      # Keep pool small for memory efficiency
     )
 
+# Leases (job heartbeats, leader election) are renewed through their own engine, on a connection of their
+# own, so a renewal never shares a transaction with the ingestion writer or queues for its pooled connections
+if DATABASE_URI.startswith('sqlite'):
+    # An in-memory database only exists on the one shared connection
+    lease_engine = engine if in_memory else create_engine(
+        DATABASE_URI,
+        echo=False,
+        poolclass=NullPool,
+        connect_args={
+            'check_same_thread': False,
+            'timeout': 20
+        }
+    )
+else:
+    lease_engine = create_engine(
+        DATABASE_URI,
+        echo=False,
+        pool_pre_ping=True,
+        pool_recycle=300,
+        pool_timeout=20,
+        max_overflow=0,
+        pool_size=2      # A job heartbeat and the leader elector
+    )
+
+# Create tables that don't exist yet (e.g. new ones added to app/models.py); existing tables are left untouched
+Base.metadata.create_all(engine)
+
 # Use scoped session for thread safety and better cleanup
 SessionLocal = scoped_session(sessionmaker(autocommit=False, autoflush=False, bind=engine))
 
@@ -38,6 +69,12 @@ def create_session():
     """Create a new database session with automatic cleanup."""
     return SessionLocal()
 
+LeaseSession = sessionmaker(autocommit=False, autoflush=False, bind=lease_engine)
+
+def create_lease_session():
+    """Create a session on lease_engine for renewing leases; the caller closes it."""
+    return LeaseSession()
+
 def cleanup_db_sessions():
     """Clean up database sessions to free memory."""
     try:
@@ -2,10 +2,17 @@ import imaplib
 import email
 from email.header import decode_header
 import os
+import re
+import base64
+import quopri
 import datetime
 import tempfile
 import socket
-from config.settings import GMAIL_USER, GMAIL_PASSWORD, IMAP_SERVER
+import threading
+import time
+from config.settings import (
+    GMAIL_USER, GMAIL_PASSWORD, IMAP_SERVER, IMAP_FETCH_BATCH_SIZE, IMAP_TIMEOUT, IMAP_POOL_MAX_IDLE, IMAP_POOL_MAX_AGE
+)
 
 # Use a more reliable temp directory that works on all platforms
 TEMP_DIR = os.path.join(tempfile.gettempdir(), "daily_html")
@@ -18,6 +25,9 @@ if not os.path.exists(TEMP_DIR):
         # Fallback to system temp directory
         TEMP_DIR = tempfile.gettempdir()
 
+class IncompleteFetch(Exception):
+    """Raised once a mailbox or window has been fetched when some of its messages could not be."""
+
 def _get_imap_connection(pharmacy_config):
     """Get IMAP connection with proper timeout and error handling."""
     user = pharmacy_config.get("email_user", GMAIL_USER)
@@ -28,9 +38,8 @@ def _get_imap_connection(pharmacy_config):
         raise ValueError(f"Missing email credentials for pharmacy {pharmacy_config.get('code', 'unknown')}")
     
     try:
-        # Set socket timeout to prevent hanging connections
-        socket.setdefaulttimeout(30)
-        mail = imaplib.IMAP4_SSL(server)
+        # Timeout applies to this connection's socket only, not the whole process
+        mail = imaplib.IMAP4_SSL(server, timeout=IMAP_TIMEOUT)
         mail.login(user, password)
         return mail
     except imaplib.IMAP4.error as e:
@@ -40,6 +49,90 @@ def _get_imap_connection(pharmacy_config):
     except Exception as e:
         raise Exception(f"Failed to connect to IMAP server {server}: {e}")
 
+def _logout_quietly(mail):
+    try:
+        mail.logout()
+    except Exception:
+        pass
+
+class IMAPConnectionPool:
+    """Keeps one authenticated IMAP session per mailbox alive between fetch cycles.
+
+    acquire() hands back the pooled session if it passes a NOOP health check and is neither idle
+    longer than max_idle nor older than max_age seconds; otherwise it logs in afresh. release()
+    returns a session for reuse, discard() drops a broken one. Safe to share between threads.
+    """
+    def __init__(self, max_idle=IMAP_POOL_MAX_IDLE, max_age=IMAP_POOL_MAX_AGE):
+        self.max_idle = max_idle
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._idle = {}  # (server, user) -> (mail, created, last_used)
+        self._created = {}  # id(mail) -> created
+
+    @staticmethod
+    def _key(pharmacy_config):
+        return (pharmacy_config.get("imap_server", IMAP_SERVER), pharmacy_config.get("email_user", GMAIL_USER))
+
+    def _is_stale(self, created, last_used, now):
+        return now - last_used > self.max_idle or now - created > self.max_age
+
+    def acquire(self, pharmacy_config):
+        now = time.monotonic()
+        self.evict_stale()
+        with self._lock:
+            entry = self._idle.pop(self._key(pharmacy_config), None)
+        if entry is not None:
+            mail, created, last_used = entry
+            try:
+                status, _ = mail.noop()
+                if status == "OK":
+                    return mail
+            except Exception:
+                pass
+            print(f"[IMAP Pool] Pooled session for {pharmacy_config.get('code', 'unknown')} failed NOOP, reconnecting")
+            self.discard(mail)
+        mail = _get_imap_connection(pharmacy_config)
+        with self._lock:
+            self._created[id(mail)] = now
+        return mail
+
+    def release(self, pharmacy_config, mail):
+        now = time.monotonic()
+        key = self._key(pharmacy_config)
+        with self._lock:
+            created = self._created.get(id(mail), now)
+            if key in self._idle or self._is_stale(created, now, now):
+                keep = False
+            else:
+                self._idle[key] = (mail, created, now)
+                keep = True
+        if not keep:
+            self.discard(mail)
+
+    def discard(self, mail):
+        with self._lock:
+            self._created.pop(id(mail), None)
+        _logout_quietly(mail)
+
+    def evict_stale(self):
+        """Logs out sessions that have been idle or alive too long."""
+        now = time.monotonic()
+        with self._lock:
+            stale = [key for key, (mail, created, last_used) in self._idle.items() if self._is_stale(created, last_used, now)]
+            evicted = [self._idle.pop(key)[0] for key in stale]
+        for mail in evicted:
+            self.discard(mail)
+
+    def close_all(self):
+        with self._lock:
+            sessions = [mail for mail, _, _ in self._idle.values()]
+            self._idle.clear()
+        for mail in sessions:
+            self.discard(mail)
+
+# Shared by every fetch in this process (periodic, /api/force_update, IDLE-triggered)
+connection_pool = IMAPConnectionPool()
+
 def _save_report_content(msg, pharmacy_code, email_date_from_header):
     """Saves HTML part or .htm attachment to a temporary file. Returns filepath or None."""
     if isinstance(email_date_from_header, datetime.datetime):
@@ -61,127 +154,572 @@ def _save_report_content(msg, pharmacy_code, email_date_from_header):
             except Exception:
                 report_file_date_obj = datetime.date.today()
 
-    saved_body_path = None
+    report_part = _find_report_part(msg)
+    if report_part is None:
+        return None
+
+    part_filename = report_part.get_filename()
+    if "attachment" in str(report_part.get("Content-Disposition")):
+        try:
+            clean_attachment_name = f"{pharmacy_code}_{report_file_date_obj.strftime('%Y%m%d')}_{os.path.basename(part_filename)}"
+            filepath_attachment = os.path.join(TEMP_DIR, clean_attachment_name)
+            with open(filepath_attachment, "wb") as f:
+                f.write(report_part.get_payload(decode=True))
+            return filepath_attachment
+        except Exception as e:
+            print(f"Error saving attachment {part_filename} for {report_file_date_obj}: {e}")
+            return None
+
+    try:
+        body = report_part.get_payload(decode=True).decode(errors='replace')
+        filename_body = os.path.join(TEMP_DIR, f"{pharmacy_code}_{report_file_date_obj.strftime('%Y%m%d')}_body.htm")
+        with open(filename_body, "w", encoding="utf-8") as f:
+            f.write(body)
+        return filename_body
+    except Exception as e:
+        print(f"Error decoding/saving HTML body for {report_file_date_obj}: {e}")
+        return None
+
+def _find_report_part(msg):
+    """Returns the .htm attachment part, else the first inline text/html part, else None."""
+    body_part = None
     for part in msg.walk():
-        content_type = part.get_content_type()
         content_disposition = str(part.get("Content-Disposition"))
         part_filename = part.get_filename()
 
         if part_filename and part_filename.lower().endswith(".htm") and "attachment" in content_disposition:
+            return part
+        if part.get_content_type() == "text/html" and "attachment" not in content_disposition and body_part is None:
+            body_part = part
+    return body_part
+
+def _extract_report_payload(msg, spool_threshold=None):
+    """Returns (payload, charset, message_id) for the report part, or None.
+
+    payload is the raw decoded bytes, or a SpooledTemporaryFile that only rolls
+    over to disk once it grows beyond spool_threshold bytes.
+    """
+    report_part = _find_report_part(msg)
+    if report_part is None:
+        return None
+    payload = report_part.get_payload(decode=True)
+    if not payload:
+        return None
+    return _spool_payload(payload, spool_threshold), report_part.get_content_charset(), (msg.get("Message-ID") or '').strip()
+
+def _spool_payload(payload, spool_threshold=None):
+    if spool_threshold is None:
+        return payload
+    spooled = tempfile.SpooledTemporaryFile(max_size=spool_threshold)
+    spooled.write(payload)
+    spooled.seek(0)
+    return spooled
+
+def _decode_subject(subject_header):
+    """Decodes an RFC 2047 subject header into text."""
+    decoded_subject = decode_header(subject_header)
+    # The subject might be split into parts
+    subject_parts = []
+    for part, encoding in decoded_subject:
+        if isinstance(part, bytes):
+            subject_parts.append(part.decode(encoding or 'utf-8', 'ignore'))
+        else:
+            subject_parts.append(part)
+    return "".join(subject_parts)
+
+def _report_date_from_header(email_date_str_header):
+    try:
+        return email.utils.parsedate_to_datetime(email_date_str_header).date() # This is the date from email header
+    except Exception as e:
+        print(f"Could not parse date from email header: '{email_date_str_header}'. Error: {e}. Using today's date.")
+        return datetime.date.today()
+
+# IMAP FETCH response parsing. imaplib hands back the raw response lines, with each literal
+# ({n} followed by n bytes) split out as a (prefix, literal) tuple.
+_IMAP_TOKEN = re.compile(rb'\s*(?:(?P<open>\()|(?P<close>\))|"(?P<quoted>(?:[^"\\]|\\.)*)"|(?P<atom>[^\s()"]+))')
+_IMAP_ESCAPE = re.compile(rb'\\(.)')
+_LITERAL_MARKER = re.compile(rb'\{\d+\}\s*$')
+
+def _imap_tokens(msg_data):
+    for item in msg_data:
+        if isinstance(item, tuple):
+            prefix, literal = item
+            yield from _tokenize_imap(_LITERAL_MARKER.sub(b'', prefix))
+            yield 'string', literal
+        elif isinstance(item, bytes):
+            yield from _tokenize_imap(item)
+
+def _tokenize_imap(line):
+    for match in _IMAP_TOKEN.finditer(line):
+        if match.group('open'):
+            yield '(', None
+        elif match.group('close'):
+            yield ')', None
+        elif match.group('quoted') is not None:
+            yield 'string', _IMAP_ESCAPE.sub(rb'\1', match.group('quoted'))
+        elif match.group('atom'):
+            atom = match.group('atom')
+            yield ('nil', None) if atom.upper() == b'NIL' else ('atom', atom)
+
+def _read_imap_value(tokens, pos):
+    kind, value = tokens[pos]
+    if kind != '(':
+        return value, pos + 1
+    items = []
+    pos += 1
+    while tokens[pos][0] != ')':
+        item, pos = _read_imap_value(tokens, pos)
+        items.append(item)
+    return items, pos + 1
+
+def _parse_fetch_response(msg_data):
+    """Parses UID FETCH response data into {uid: {item name: value}}.
+
+    Lists become Python lists, strings and atoms bytes, NIL None; item names are upper-cased str
+    (e.g. 'BODYSTRUCTURE', 'BODY[2]').
+    """
+    tokens = list(_imap_tokens(msg_data))
+    responses = {}
+    pos = 0
+    while pos < len(tokens):
+        if tokens[pos][0] != 'atom':  # stray closing parens between responses
+            pos += 1
+            continue
+        pos += 1  # message sequence number
+        fields, pos = _read_imap_value(tokens, pos)
+        if not isinstance(fields, list):
+            continue
+        items = {name.decode().upper(): value for name, value in zip(fields[::2], fields[1::2])}
+        if items.get('UID') is not None:
+            responses[int(items['UID'])] = items
+    return responses
+
+def _text(value):
+    return value.decode('utf-8', 'replace') if isinstance(value, bytes) else value
+
+def _param_dict(params):
+    if not isinstance(params, list):
+        return {}
+    return {_text(k).lower(): _text(v) for k, v in zip(params[::2], params[1::2])}
+
+def _iter_body_parts(bodystructure, section=''):
+    """Yields (section, content type, params, encoding, disposition, disposition params) for each leaf part."""
+    if isinstance(bodystructure[0], list):  # multipart: child parts, then the subtype
+        number = 0
+        for child in bodystructure:
+            if not isinstance(child, list):
+                break
+            number += 1
+            yield from _iter_body_parts(child, f"{section}.{number}" if section else str(number))
+        return
+    content_type = f"{_text(bodystructure[0])}/{_text(bodystructure[1])}".lower()
+    # Extension data: text/* parts carry an extra line count, message/rfc822 an envelope, body and line count
+    if content_type.startswith('text/'):
+        disposition_index = 9
+    elif content_type == 'message/rfc822':
+        disposition_index = 11
+    else:
+        disposition_index = 8
+    disposition = bodystructure[disposition_index] if len(bodystructure) > disposition_index else None
+    disposition_type, disposition_params = None, {}
+    if isinstance(disposition, list) and disposition:
+        disposition_type = _text(disposition[0]).lower()
+        disposition_params = _param_dict(disposition[1] if len(disposition) > 1 else None)
+    # A single-part message's body is section 1
+    yield section or '1', content_type, _param_dict(bodystructure[2]), _text(bodystructure[5] or b'7bit').lower(), disposition_type, disposition_params
+
+def _find_report_section(bodystructure):
+    """BODYSTRUCTURE counterpart of _find_report_part. Returns (section, encoding, charset, filename) or None."""
+    body_part = None
+    for section, content_type, params, encoding, disposition, disposition_params in _iter_body_parts(bodystructure):
+        filename = disposition_params.get('filename') or params.get('name')
+        if filename and filename.lower().endswith(".htm") and disposition == "attachment":
+            return section, encoding, params.get('charset'), filename
+        if content_type == "text/html" and disposition != "attachment" and body_part is None:
+            body_part = (section, encoding, params.get('charset'), filename)
+    return body_part
+
+def _decode_transfer_encoding(raw, encoding):
+    if encoding == 'base64':
+        return base64.b64decode(raw)
+    if encoding == 'quoted-printable':
+        return quopri.decodestring(raw)
+    return raw
+
+def _save_report_payload(payload, pharmacy_code, report_date_obj, filename):
+    """Writes a fetched report part to TEMP_DIR. Returns the filepath or None."""
+    name = os.path.basename(filename) if filename else "body.htm"
+    filepath = os.path.join(TEMP_DIR, f"{pharmacy_code}_{report_date_obj.strftime('%Y%m%d')}_{name}")
+    try:
+        with open(filepath, "wb") as f:
+            f.write(payload)
+        return filepath
+    except Exception as e:
+        print(f"Error saving report {name} for {report_date_obj}: {e}")
+        return None
+
+def _uid_set(uids):
+    """Formats sorted UIDs as a compact IMAP sequence set, e.g. [101, 102, 103, 107] -> '101:103,107'."""
+    ranges = []
+    for uid in uids:
+        if ranges and uid == ranges[-1][1] + 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    return ",".join(str(first) if first == last else f"{first}:{last}" for first, last in ranges)
+
+def _fetch_reports(mail, email_uids, pharmacy_config, in_memory=False, spool_threshold=None):
+    """Fetches the report parts for a batch of UIDs. Yields (uid, (report, report_date_obj, subject) or None, error)
+    in UID order; error is the exception if that message couldn't be fetched, else None.
+
+    One UID FETCH (BODYSTRUCTURE ENVELOPE) covers the whole batch, then one BODY.PEEK[<section>]
+    per distinct report section (usually just one), so the .htm attachment or HTML body is all that
+    crosses the wire. Messages whose structure can't be read fall back to the full RFC822 message.
+    """
+    status, msg_data = mail.uid("FETCH", _uid_set(email_uids), "(BODYSTRUCTURE ENVELOPE)")
+    if status != "OK":
+        raise Exception(f"FETCH BODYSTRUCTURE failed: {status}")
+    structures = _parse_fetch_response(msg_data)
+    del msg_data
+
+    headers = {}
+    uids_by_section = {}
+    for email_uid in email_uids:
+        try:
+            items = structures[email_uid]
+            envelope = items['ENVELOPE']
+            report_section = _find_report_section(items['BODYSTRUCTURE'])
+        except Exception as e:
+            print(f"Could not read BODYSTRUCTURE for email UID {email_uid} ({e}), fetching the full message")
+            headers[email_uid] = None
+            continue
+
+        # ENVELOPE: (date subject from sender reply-to to cc bcc in-reply-to message-id)
+        email_date_str_header = _text(envelope[0])
+        subject = "No Subject"
+        try:
+            if envelope[1] is not None:
+                subject = _decode_subject(_text(envelope[1]))
+        except Exception as e:
+            print(f"Could not decode subject for email on {email_date_str_header}: {e}")
+        message_id = (_text(envelope[9]) or '').strip()
+        headers[email_uid] = (_report_date_from_header(email_date_str_header), subject, message_id, report_section)
+        if report_section is not None:
+            uids_by_section.setdefault(report_section[0], []).append(email_uid)
+    del structures
+
+    bodies = {}
+    for section, section_uids in uids_by_section.items():
+        status, msg_data = mail.uid("FETCH", _uid_set(section_uids), f"(BODY.PEEK[{section}])")
+        if status != "OK":
+            raise Exception(f"FETCH BODY[{section}] failed: {status}")
+        for email_uid, items in _parse_fetch_response(msg_data).items():
+            bodies[email_uid] = items.get(f"BODY[{section}]")
+        del msg_data
+
+    for email_uid in email_uids:
+        try:
+            if headers[email_uid] is None:
+                fetched = _fetch_report_rfc822(mail, email_uid, pharmacy_config, in_memory, spool_threshold)
+                yield email_uid, fetched, None
+                continue
+            report_date_obj, subject, message_id, report_section = headers[email_uid]
+            if report_section is None:
+                yield email_uid, None, None
+                continue
+            raw = bodies.pop(email_uid, None)
+            if not raw:
+                fetched = _fetch_report_rfc822(mail, email_uid, pharmacy_config, in_memory, spool_threshold)
+                yield email_uid, fetched, None
+                continue
+            _, encoding, charset, filename = report_section
+            payload = _decode_transfer_encoding(raw, encoding)
+            del raw
+            if in_memory:
+                report = (_spool_payload(payload, spool_threshold), charset, message_id)
+            else:
+                report = _save_report_payload(payload, pharmacy_config['code'], report_date_obj, filename)
+            fetched = (report, report_date_obj, subject) if report else None
+        except Exception as e:
+            print(f"Error processing email UID {email_uid}: {e}")
+            yield email_uid, None, e
+            continue
+        yield email_uid, fetched, None
+
+def _fetch_report_rfc822(mail, email_uid, pharmacy_config, in_memory=False, spool_threshold=None):
+    """Fetches and parses the full message. Returns (report, report_date_obj, subject) or None."""
+    status, msg_data = mail.uid("FETCH", str(email_uid), "(RFC822)")
+    if status != "OK":
+        raise Exception(f"FETCH RFC822 failed: {status}")
+    for response_part in msg_data:
+        if isinstance(response_part, tuple):
+            msg = email.message_from_bytes(response_part[1])
+            email_date_str_header = msg["Date"]
+            subject = "No Subject"
             try:
-                clean_attachment_name = f"{pharmacy_code}_{report_file_date_obj.strftime('%Y%m%d')}_{os.path.basename(part_filename)}"
-                filepath_attachment = os.path.join(TEMP_DIR, clean_attachment_name)
-                with open(filepath_attachment, "wb") as f:
-                    f.write(part.get_payload(decode=True))
-                return filepath_attachment
-            except Exception as e:
-                print(f"Error saving attachment {part_filename} for {report_file_date_obj}: {e}")
-        
-        if content_type == "text/html" and "attachment" not in content_disposition and not saved_body_path:
-            try:
-                body = part.get_payload(decode=True).decode(errors='replace')
-                filename_body = os.path.join(TEMP_DIR, f"{pharmacy_code}_{report_file_date_obj.strftime('%Y%m%d')}_body.htm")
-                with open(filename_body, "w", encoding="utf-8") as f:
-                    f.write(body)
-                saved_body_path = filename_body
+                subject = _decode_subject(msg["Subject"])
             except Exception as e:
-                print(f"Error decoding/saving HTML body for {report_file_date_obj}: {e}")
-    
-    return saved_body_path
+                print(f"Could not decode subject for email on {email_date_str_header}: {e}")
+            report_date_obj = _report_date_from_header(email_date_str_header)
+
+            if in_memory:
+                report = _extract_report_payload(msg, spool_threshold)
+            else:
+                report = _save_report_content(msg, pharmacy_config['code'], report_date_obj)
+            if report:
+                return report, report_date_obj, subject
+    return None
+
+def _select_inbox(mail):
+    """Selects INBOX and returns (uidvalidity, uidnext); either is None if the server didn't report it."""
+    status, _ = mail.select("inbox")
+    if status != "OK":
+        raise Exception(f"Could not select INBOX: {status}")
+
+    values = {}
+    for key in ("UIDVALIDITY", "UIDNEXT"):
+        _, data = mail.response(key)
+        if data and data[0]:
+            values[key] = int(data[0])
+    if len(values) < 2:
+        # Not every server sends both as SELECT response codes
+        status, data = mail.status("INBOX", "(UIDVALIDITY UIDNEXT)")
+        if status == "OK" and data and data[0]:
+            for key in ("UIDVALIDITY", "UIDNEXT"):
+                match = re.search(key.encode() + rb" (\d+)", data[0])
+                if match:
+                    values.setdefault(key, int(match.group(1)))
+    return values.get("UIDVALIDITY"), values.get("UIDNEXT")
+
+def _fetch_in_batches(mail, email_uids, pharmacy_config, in_memory=False, spool_threshold=None, batch_size=None, sync_state=None):
+    """Yields the reports for email_uids, fetched batch_size (default settings.IMAP_FETCH_BATCH_SIZE) at a time.
+
+    sync_state.last_uid, if given, is advanced as each message is consumed. A failed batch or message is
+    logged and the rest are still fetched, but last_uid stops advancing at the first failure so the next
+    incremental run fetches it again; IncompleteFetch is raised after the last batch.
+    """
+    pharmacy_name = pharmacy_config.get('name', pharmacy_config.get('code', 'unknown'))
+    batch_size = max(1, batch_size or IMAP_FETCH_BATCH_SIZE)
+    failed = []
+    for batch_start in range(0, len(email_uids), batch_size):
+        batch = email_uids[batch_start:batch_start + batch_size]
+        print(f"Processing emails {batch_start+1}-{batch_start+len(batch)}/{len(email_uids)} for {pharmacy_name}...")
+        handled = 0
+        try:
+            for email_uid, fetched, error in _fetch_reports(mail, batch, pharmacy_config, in_memory, spool_threshold):
+                handled += 1
+                if error is not None:
+                    failed.append(email_uid)
+                    continue
+                if fetched:
+                    yield fetched
+                # Only reached once the consumer has handled this message, and never past one that failed
+                if sync_state is not None and not failed:
+                    sync_state.last_uid = max(sync_state.last_uid or 0, email_uid)
+        except Exception as e:
+            print(f"Error processing emails with UIDs {batch[0]}-{batch[-1]} for {pharmacy_name}: {e}")
+            failed.extend(batch[handled:])
+    if failed:
+        raise IncompleteFetch(f"{len(failed)} email(s) could not be fetched for {pharmacy_name} (UIDs {_uid_set(failed)})")
+
+def fetch_emails_last_n_days(pharmacy_config, days=7, in_memory=False, spool_threshold=None, sync_state=None, resync=False,
+                             batch_size=None):
+    """Fetches emails from the last N days and yields (filepath, report_date_obj, subject), oldest first.
+
+    With in_memory=True nothing is written to disk and ((payload, charset, message_id), report_date_obj, subject)
+    is yielded instead, ready for parser.parse_html_bytes and the ingestion ledger. spool_threshold is
+    passed to _extract_report_payload.
+
+    sync_state is an optional models.MailboxSyncState. When its UIDVALIDITY still matches the mailbox,
+    only messages with a UID above last_uid are fetched (UID SEARCH UID n:*). Otherwise, or with
+    resync=True, the last N days are searched as before. Either way uidvalidity/last_uid are advanced
+    as messages are consumed, but never past one that couldn't be fetched (see _fetch_in_batches);
+    the caller commits them.
 
-def fetch_emails_last_n_days(pharmacy_config, days=7):
-    """Fetches emails from the last N days and yields (filepath, report_date_obj, subject)."""
+    The mailbox's "search_criteria" (IMAP SEARCH keys, see settings.REPORT_SEARCH_CRITERIA) are applied
+    on the server, so only matching emails are transferred. The default only leaves out forwards; other
+    non-report mail is filtered out only once a deploy sets criteria that match its report emails.
+
+    Messages are fetched batch_size (default settings.IMAP_FETCH_BATCH_SIZE) at a time over UID sets
+    and yielded as each batch is decoded, so memory stays bounded by one batch.
+    """
     mail = None
+    healthy = True
     try:
         pharmacy_name = pharmacy_config.get('name', pharmacy_config.get('code', 'unknown'))
         print(f"Connecting to email for {pharmacy_name}...")
         
-        mail = _get_imap_connection(pharmacy_config)
-        mail.select("inbox")
-        
-        # IMAP date format: DD-Mon-YYYY (e.g., 01-Jan-2023)
-        date_since = (datetime.date.today() - datetime.timedelta(days=days-1))
-        search_criteria_date_str = date_since.strftime("%d-%b-%Y")
-        search_criteria = '(SINCE "' + search_criteria_date_str + '")'
-        
-        print(f"Searching for emails since {search_criteria_date_str} for {pharmacy_name}...")
-        status, messages = mail.search(None, search_criteria)
+        mail = connection_pool.acquire(pharmacy_config)
+        uidvalidity, uidnext = _select_inbox(mail)
+
+        email_user = pharmacy_config.get("email_user", GMAIL_USER)
+        incremental = (
+            sync_state is not None and not resync and uidvalidity is not None
+            and sync_state.uidvalidity == uidvalidity and sync_state.email_user == email_user
+            and sync_state.last_uid
+        )
+        if incremental:
+            last_uid = sync_state.last_uid
+            search_criteria = f"UID {last_uid + 1}:*"
+            print(f"Searching for emails after UID {last_uid} for {pharmacy_name}...")
+        else:
+            if sync_state is not None and sync_state.uidvalidity is not None and sync_state.uidvalidity != uidvalidity:
+                print(f"UIDVALIDITY changed for {pharmacy_name} ({sync_state.uidvalidity} -> {uidvalidity}), resyncing the last {days} days")
+            last_uid = 0
+            # IMAP date format: DD-Mon-YYYY (e.g., 01-Jan-2023)
+            date_since = (datetime.date.today() - datetime.timedelta(days=days-1))
+            search_criteria = '(SINCE "' + date_since.strftime("%d-%b-%Y") + '")'
+            print(f"Searching for emails since {date_since.strftime('%d-%b-%Y')} for {pharmacy_name}...")
+
+        report_criteria = pharmacy_config.get("search_criteria")
+        if report_criteria:
+            search_criteria = f"{search_criteria} ({report_criteria})"
+        status, messages = mail.uid("SEARCH", None, search_criteria)
         if status != "OK":
             print(f"IMAP search failed for {pharmacy_name}: {status}")
             return
-            
-        if not messages[0]:
-            print(f"No emails found since {search_criteria_date_str} for {pharmacy_name}")
+
+        # "n:*" always matches the newest message, even when its UID is below n
+        email_uids = sorted(uid for uid in (int(u) for u in messages[0].split()) if uid > last_uid)
+
+        if sync_state is not None and not incremental:
+            sync_state.uidvalidity = uidvalidity
+            sync_state.email_user = email_user
+            # Nothing in the window: resume from the mailbox's current end next time
+            sync_state.last_uid = email_uids[0] - 1 if email_uids else max((uidnext or 1) - 1, 0)
+
+        if not email_uids:
+            print(f"No new emails found for {pharmacy_name}")
             return
 
-        email_ids = messages[0].split()
-        print(f"Found {len(email_ids)} email(s) since {search_criteria_date_str} for {pharmacy_name}")
-        
-        for i, email_id in enumerate(reversed(email_ids)): # Process newest first within the date range
-            try:
-                print(f"Processing email {i+1}/{len(email_ids)} for {pharmacy_name}...")
-                status, msg_data = mail.fetch(email_id, "(RFC822)")
-                if status != "OK":
-                    print(f"Failed to fetch email {email_id} for {pharmacy_name}: {status}")
-                    continue
-                    
-                for response_part in msg_data:
-                    if isinstance(response_part, tuple):
-                        try:
-                            msg = email.message_from_bytes(response_part[1])
-                            email_date_str_header = msg["Date"]
-                            subject_header = msg["Subject"]
-                            report_date_obj = None
-                            
-                            # Decode subject
-                            subject = "No Subject"
-                            try:
-                                decoded_subject = decode_header(subject_header)
-                                # The subject might be split into parts
-                                subject_parts = []
-                                for part, encoding in decoded_subject:
-                                    if isinstance(part, bytes):
-                                        subject_parts.append(part.decode(encoding or 'utf-8', 'ignore'))
-                                    else:
-                                        subject_parts.append(part)
-                                subject = "".join(subject_parts)
-                            except Exception as e:
-                                print(f"Could not decode subject for email on {email_date_str_header}: {e}")
-
-                            try:
-                                email_dt_header = email.utils.parsedate_to_datetime(email_date_str_header)
-                                report_date_obj = email_dt_header.date() # This is the date from email header
-                            except Exception as e:
-                                print(f"Could not parse date from email header: '{email_date_str_header}'. Error: {e}. Using today's date.")
-                                report_date_obj = datetime.date.today() 
-                            
-                            filepath = _save_report_content(msg, pharmacy_config['code'], report_date_obj)
-                            if filepath:
-                                yield filepath, report_date_obj, subject
-                        except Exception as e:
-                            print(f"Error processing email content for {pharmacy_name}: {e}")
-                            continue
-            except Exception as e:
-                print(f"Error processing email {email_id} for {pharmacy_name}: {e}")
-                continue
-                
+        print(f"Found {len(email_uids)} email(s) for {pharmacy_name}")
+        yield from _fetch_in_batches(mail, email_uids, pharmacy_config, in_memory, spool_threshold, batch_size, sync_state)
+
+    except IncompleteFetch:
+        # Already logged per batch/message; the session itself is still usable
+        raise
     except Exception as e:
+        healthy = False
         print(f"Error fetching emails for {pharmacy_config.get('name', pharmacy_config.get('code', 'unknown'))}: {e}")
         raise e  # Re-raise to allow calling code to handle appropriately
     finally:
         if mail:
-            try:
-                mail.close()
-                mail.logout()
-            except Exception as e_logout:
-                print(f"Error during IMAP logout: {e_logout}")
+            # Sessions go back to the pool for the next cycle; the NOOP on acquire catches any that died
+            if healthy:
+                connection_pool.release(pharmacy_config, mail)
+            else:
+                connection_pool.discard(mail)
+
+def month_windows(start_date, end_date):
+    """Splits start_date..end_date (inclusive) into calendar-month windows [(first_day, last_day), ...], oldest first.
+
+    The first and last windows are clipped to the range.
+    """
+    windows = []
+    window_start = start_date
+    while window_start <= end_date:
+        next_month = (window_start.replace(day=1) + datetime.timedelta(days=32)).replace(day=1)
+        window_end = min(next_month - datetime.timedelta(days=1), end_date)
+        windows.append((window_start, window_end))
+        window_start = next_month
+    return windows
+
+def mailbox_position(pharmacy_config):
+    """Returns the mailbox's current (uidvalidity, uidnext), using a pooled session."""
+    mail = connection_pool.acquire(pharmacy_config)
+    try:
+        position = _select_inbox(mail)
+    except Exception:
+        connection_pool.discard(mail)
+        raise
+    connection_pool.release(pharmacy_config, mail)
+    return position
+
+def fetch_emails_in_window(pharmacy_config, start_date, end_date, in_memory=False, spool_threshold=None, batch_size=None):
+    """Fetches the emails received from start_date to end_date (inclusive) and yields them like fetch_emails_last_n_days.
+
+    Each call takes its own session from the pool, so several windows of the same mailbox can be
+    fetched in parallel from different threads.
+    """
+    mail = None
+    healthy = True
+    try:
+        pharmacy_name = pharmacy_config.get('name', pharmacy_config.get('code', 'unknown'))
+        mail = connection_pool.acquire(pharmacy_config)
+        _select_inbox(mail)
+
+        # BEFORE is exclusive; both compare against the server's INTERNALDATE
+        search_criteria = '(SINCE "{}" BEFORE "{}")'.format(
+            start_date.strftime("%d-%b-%Y"), (end_date + datetime.timedelta(days=1)).strftime("%d-%b-%Y")
+        )
+        report_criteria = pharmacy_config.get("search_criteria")
+        if report_criteria:
+            search_criteria = f"{search_criteria} ({report_criteria})"
+        status, messages = mail.uid("SEARCH", None, search_criteria)
+        if status != "OK":
+            raise Exception(f"IMAP search failed: {status}")
+
+        email_uids = sorted(int(u) for u in messages[0].split())
+        if not email_uids:
+            return
+        print(f"Found {len(email_uids)} email(s) for {pharmacy_name} between {start_date} and {end_date}")
+        yield from _fetch_in_batches(mail, email_uids, pharmacy_config, in_memory, spool_threshold, batch_size)
+
+    except IncompleteFetch:
+        raise
+    except Exception as e:
+        healthy = False
+        print(f"Error fetching emails for {pharmacy_config.get('name', pharmacy_config.get('code', 'unknown'))} "
+              f"between {start_date} and {end_date}: {e}")
+        raise e
+    finally:
+        if mail:
+            if healthy:
+                connection_pool.release(pharmacy_config, mail)
+            else:
+                connection_pool.discard(mail)
+
+def advance_sync_state(sync_state, pharmacy_config, uidvalidity, uidnext):
+    """Points sync_state at uidnext - 1 after a full sync, without moving it backwards within the same UIDVALIDITY."""
+    email_user = pharmacy_config.get("email_user", GMAIL_USER)
+    last_uid = max((uidnext or 1) - 1, 0)
+    if sync_state.uidvalidity == uidvalidity and sync_state.email_user == email_user:
+        last_uid = max(last_uid, sync_state.last_uid or 0)
+    sync_state.uidvalidity = uidvalidity
+    sync_state.email_user = email_user
+    sync_state.last_uid = last_uid
+
+def sync_all_emails(pharmacy_config, in_memory=False, spool_threshold=None, sync_state=None, batch_size=None, days=3650,
+                    skip_windows=()):
+    """Fetches every email from the last ~10 years (days), one calendar month at a time, oldest first.
 
-def sync_all_emails(pharmacy_config):
-    """Approximates fetching all emails by fetching for a large number of days (e.g., 10 years = 3650 days)."""
+    Only one month's UID list is held at a time. Windows whose first day is in skip_windows are not
+    searched (see scripts/sync_all.py, which checkpoints completed windows and runs them in parallel).
+
+    Once every window has been fetched, a sync_state is left pointing at the mailbox's end as it was
+    when the sync started, so later incremental fetches pick up anything that arrived meanwhile. If the
+    sync is interrupted, or IncompleteFetch is raised at the end because some emails couldn't be
+    fetched, the sync_state is left untouched.
+    """
     pharmacy_name = pharmacy_config.get('name', pharmacy_config.get('code', 'unknown'))
     print(f"Syncing all emails by fetching reports from the last ~10 years for {pharmacy_name}")
     try:
-        yield from fetch_emails_last_n_days(pharmacy_config, days=3650) 
+        uidvalidity, uidnext = mailbox_position(pharmacy_config)
+        today = datetime.date.today()
+        incomplete = []
+        for window_start, window_end in month_windows(today - datetime.timedelta(days=days - 1), today):
+            if window_start in skip_windows:
+                continue
+            try:
+                yield from fetch_emails_in_window(pharmacy_config, window_start, window_end, in_memory=in_memory,
+                                                  spool_threshold=spool_threshold, batch_size=batch_size)
+            except IncompleteFetch as e:
+                # Carry on with the other windows, but don't move the sync position past the missing emails
+                incomplete.append(str(e))
+        if incomplete:
+            raise IncompleteFetch("; ".join(incomplete))
+        if sync_state is not None:
+            advance_sync_state(sync_state, pharmacy_config, uidvalidity, uidnext)
     except Exception as e:
         print(f"Error during sync_all_emails for {pharmacy_name}: {e}")
-        raise e 
\ No newline at end of file
+        raise e
@@ -0,0 +1,162 @@
+import re
+import time
+import select
+import socket
+import threading
+from app.email_fetcher import _get_imap_connection
+from config.settings import MAILBOXES, IMAP_IDLE_TIMEOUT, FETCH_POLL_INTERVAL
+
+_EXISTS = re.compile(rb'^\* \d+ EXISTS', re.I)
+
+def _supports_idle(mail):
+    status, data = mail.capability()
+    return status == "OK" and b"IDLE" in (data[0] or b"").upper().split()
+
+def _idle(mail, timeout):
+    """Runs one IMAP IDLE (RFC 2177) round. Returns True if the server reported new mail (EXISTS).
+
+    imaplib has no IDLE support, so the command is driven by hand: IDLE, wait up to timeout seconds
+    for an untagged EXISTS, then DONE and read through to the tagged completion.
+    """
+    tag = mail._new_tag()
+    mail.send(tag + b" IDLE\r\n")
+    line = mail.readline()
+    if not line.startswith(b"+"):
+        raise Exception(f"IDLE refused: {line.strip()!r}")
+
+    new_mail = False
+    deadline = time.monotonic() + timeout
+    while not new_mail:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        # TLS may already hold decrypted bytes that select() can't see
+        pending = getattr(mail.sock, "pending", lambda: 0)()
+        if not pending and not select.select([mail.sock], [], [], remaining)[0]:
+            break
+        line = mail.readline()
+        if not line:
+            raise Exception("Connection closed during IDLE")
+        if _EXISTS.match(line):
+            new_mail = True
+
+    mail.send(b"DONE\r\n")
+    while True:
+        line = mail.readline()
+        if not line:
+            raise Exception("Connection closed while ending IDLE")
+        if _EXISTS.match(line):
+            new_mail = True
+        if line.startswith(tag):
+            if line[len(tag):].split()[:1] != [b"OK"]:
+                raise Exception(f"IDLE failed: {line.strip()!r}")
+            return new_mail
+
+class IdleWatcher(threading.Thread):
+    """Watches one mailbox with IMAP IDLE and calls on_new_mail(pharmacy_code) when mail arrives.
+
+    on_new_mail also runs once per (re)connect, to catch up on anything that arrived while the
+    watcher was down. Connection failures reconnect with exponential backoff; while disconnected,
+    or if the server doesn't support IDLE, the mailbox is polled every poll_interval seconds instead.
+    should_run(), if given, is checked before every fetch (e.g. this process still holds the ingestion
+    lease). stop() ends the IDLE straight away by shutting down the connection.
+    """
+    def __init__(self, pharmacy_config, on_new_mail, idle_timeout=IMAP_IDLE_TIMEOUT, poll_interval=FETCH_POLL_INTERVAL,
+                 min_backoff=5, max_backoff=300, should_run=None):
+        super().__init__(daemon=True, name=f"idle-{pharmacy_config['code']}")
+        self.pharmacy_config = pharmacy_config
+        self.on_new_mail = on_new_mail
+        self.should_run = should_run
+        self.idle_timeout = idle_timeout
+        self.poll_interval = poll_interval
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.mode = "starting"
+        self.last_fetch = None
+        self._stopped = threading.Event()
+        self._backoff = min_backoff
+        self._mail = None
+
+    @property
+    def label(self):
+        return self.pharmacy_config.get("name", self.pharmacy_config["code"])
+
+    def stop(self):
+        self._stopped.set()
+        mail = self._mail
+        if mail is not None:
+            # Wakes the select() in _idle; the watcher thread then sees the closed connection and exits
+            try:
+                mail.sock.shutdown(socket.SHUT_RDWR)
+            except Exception:
+                pass
+
+    def _trigger(self, reason):
+        if self._stopped.is_set() or (self.should_run is not None and not self.should_run()):
+            print(f"[IDLE] {self.label}: not fetching ({reason}), the watcher is stopped or this process no longer leads ingestion", flush=True)
+            return
+        print(f"[IDLE] {self.label}: fetching ({reason})", flush=True)
+        self.last_fetch = time.monotonic()
+        try:
+            self.on_new_mail(self.pharmacy_config["code"])
+        except Exception as e:
+            print(f"[IDLE] {self.label}: fetch failed: {e}", flush=True)
+
+    def _poll_due(self):
+        return self.last_fetch is None or time.monotonic() - self.last_fetch >= self.poll_interval
+
+    def _watch(self):
+        """Idles until the connection fails (raises) or the watcher is stopped. Returns False if IDLE isn't supported."""
+        mail = self._mail = _get_imap_connection(self.pharmacy_config)
+        try:
+            if self._stopped.is_set():
+                return True
+            if not _supports_idle(mail):
+                return False
+            status, _ = mail.select("inbox", readonly=True)
+            if status != "OK":
+                raise Exception(f"Could not select INBOX: {status}")
+            self.mode = "idle"
+            self._backoff = self.min_backoff
+            self._trigger("connected")
+            while not self._stopped.is_set():
+                if _idle(mail, self.idle_timeout):
+                    self._trigger("new mail")
+            return True
+        finally:
+            self._mail = None
+            try:
+                mail.logout()
+            except Exception:
+                pass
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                if self._watch() is False:
+                    self.mode = "polling"
+                    print(f"[IDLE] {self.label}: server does not support IDLE, polling every {self.poll_interval}s", flush=True)
+                    if self._poll_due():
+                        self._trigger("poll")
+                    self._stopped.wait(self.poll_interval)
+            except Exception as e:
+                if self._stopped.is_set():
+                    break  # stop() closed the connection
+                self.mode = "reconnecting"
+                print(f"[IDLE] {self.label}: {e}; reconnecting in {self._backoff}s", flush=True)
+                # Polling fallback: don't let an outage delay reports longer than a poll interval
+                if self._poll_due():
+                    self._trigger("poll while disconnected")
+                self._stopped.wait(self._backoff)
+                self._backoff = min(self._backoff * 2, self.max_backoff)
+
+def start_idle_watchers(on_new_mail, mailboxes=None, should_run=None):
+    """Starts an IdleWatcher for every mailbox with credentials. Returns the watchers."""
+    watchers = []
+    for pharmacy_config in (mailboxes if mailboxes is not None else MAILBOXES):
+        if not pharmacy_config.get("email_user") or not pharmacy_config.get("email_password"):
+            continue
+        watcher = IdleWatcher(pharmacy_config, on_new_mail, should_run=should_run)
+        watcher.start()
+        watchers.append(watcher)
+    return watchers
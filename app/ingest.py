@@ -0,0 +1,135 @@
+import hashlib
+import datetime
+from sqlalchemy.dialects import sqlite, postgresql
+from app.models import DailyReport, MonthToDateReport, IngestionLedger, MailboxSyncState, BackfillCheckpoint
+
+def store_month_to_date(session, pharmacy_code, report_date, mtd):
+    """Upserts the month-to-date snapshot for report_date's month. Older reports never overwrite newer ones.
+
+    The caller owns the transaction; nothing is committed here.
+    """
+    month = report_date.strftime('%Y-%m')
+    snapshot = session.query(MonthToDateReport).filter_by(
+        pharmacy_code=pharmacy_code,
+        month=month
+    ).first()
+
+    if snapshot is None:
+        snapshot = MonthToDateReport(pharmacy_code=pharmacy_code, month=month, as_of_date=report_date)
+        session.add(snapshot)
+    elif snapshot.as_of_date > report_date:
+        return snapshot
+
+    snapshot.as_of_date = report_date
+    for column, value in mtd.items():
+        setattr(snapshot, column, value)
+    return snapshot
+
+# Dialects with INSERT ... ON CONFLICT DO UPDATE; anything else falls back to delete + insert
+_UPSERT_INSERTS = {'sqlite': sqlite.insert, 'postgresql': postgresql.insert}
+_DAILY_REPORT_KEY = ('pharmacy_code', 'report_date')
+
+def upsert_daily_reports(session, rows):
+    """Writes DailyReport rows (dicts of column values, including pharmacy_code and report_date).
+
+    An existing row for the same (pharmacy_code, report_date) is updated in place, keeping its id.
+    On SQLite and PostgreSQL this is a single INSERT ... ON CONFLICT DO UPDATE executed for all rows;
+    if rows repeats a key, the last one wins. The monthly and yearly rollups of the months written are then
+    recomputed (app/rollups.py). Returns the number of rows written. The caller owns the transaction.
+    """
+    # Imported here: app.rollups builds on this module
+    from app.rollups import refresh_rollups
+
+    latest = {}
+    for row in rows:
+        latest[(row['pharmacy_code'], row['report_date'])] = row
+    if not latest:
+        return 0
+    columns = [column.name for column in DailyReport.__table__.columns if column.name != 'id']
+    # executemany needs the same keys in every row; missing columns are written as NULL, as an insert would
+    rows = [{column: row.get(column) for column in columns} for row in latest.values()]
+
+    insert = _UPSERT_INSERTS.get(session.get_bind().dialect.name)
+    if insert is None:
+        for pharmacy_code, report_date in latest:
+            session.query(DailyReport).filter_by(
+                pharmacy_code=pharmacy_code,
+                report_date=report_date
+            ).delete(synchronize_session=False)
+        session.bulk_insert_mappings(DailyReport, rows)
+    else:
+        statement = insert(DailyReport.__table__)
+        statement = statement.on_conflict_do_update(
+            index_elements=list(_DAILY_REPORT_KEY),
+            set_={column: statement.excluded[column] for column in columns if column not in _DAILY_REPORT_KEY}
+        )
+        session.execute(statement, rows)
+    refresh_rollups(session, latest)
+    return len(rows)
+
+def payload_sha256(payload):
+    """Hex SHA-256 of a report payload (bytes or a binary file object, which is rewound afterwards)."""
+    if not hasattr(payload, 'read'):
+        return hashlib.sha256(payload).hexdigest()
+    digest = hashlib.sha256()
+    payload.seek(0)
+    for chunk in iter(lambda: payload.read(65536), b''):
+        digest.update(chunk)
+    payload.seek(0)
+    return digest.hexdigest()
+
+def ingested_keys(session, pharmacy_code):
+    """Returns {(message_id, payload_sha256)} already ingested for a pharmacy.
+
+    Entries whose DailyReport row has since been deleted are left out, so those reports get re-ingested.
+    """
+    rows = session.query(IngestionLedger.message_id, IngestionLedger.payload_sha256).join(
+        DailyReport,
+        (DailyReport.pharmacy_code == IngestionLedger.pharmacy_code) &
+        (DailyReport.report_date == IngestionLedger.report_date)
+    ).filter(IngestionLedger.pharmacy_code == pharmacy_code).all()
+    return {(message_id, digest) for message_id, digest in rows}
+
+def record_ingestion(session, message_id, digest, pharmacy_code, report_date):
+    """Adds a ledger entry for a report that was just written. The caller owns the transaction."""
+    entry = session.query(IngestionLedger).filter_by(
+        message_id=message_id or '',
+        payload_sha256=digest
+    ).first()
+    if entry is None:
+        entry = IngestionLedger(message_id=message_id or '', payload_sha256=digest)
+        session.add(entry)
+    entry.pharmacy_code = pharmacy_code
+    entry.report_date = report_date
+    return entry
+
+def get_mailbox_state(session, pharmacy_code):
+    """Returns the MailboxSyncState for a pharmacy, adding an empty one on first use."""
+    state = session.query(MailboxSyncState).filter_by(pharmacy_code=pharmacy_code).first()
+    if state is None:
+        state = MailboxSyncState(pharmacy_code=pharmacy_code, last_uid=0)
+        session.add(state)
+    return state
+
+def completed_windows(session, pharmacy_code, email_user):
+    """Returns the window_start dates of backfill windows already completed for a mailbox."""
+    rows = session.query(BackfillCheckpoint.window_start).filter_by(
+        pharmacy_code=pharmacy_code,
+        email_user=email_user
+    ).all()
+    return {window_start for (window_start,) in rows}
+
+def mark_window_complete(session, pharmacy_code, email_user, window_start, window_end, reports):
+    """Checkpoints a fully ingested backfill window. The caller owns the transaction."""
+    checkpoint = session.query(BackfillCheckpoint).filter_by(
+        pharmacy_code=pharmacy_code,
+        email_user=email_user,
+        window_start=window_start
+    ).first()
+    if checkpoint is None:
+        checkpoint = BackfillCheckpoint(pharmacy_code=pharmacy_code, email_user=email_user, window_start=window_start)
+        session.add(checkpoint)
+    checkpoint.window_end = window_end
+    checkpoint.reports = reports
+    checkpoint.completed_at = datetime.datetime.utcnow()
+    return checkpoint
@@ -0,0 +1,115 @@
+import json
+import datetime
+from sqlalchemy import or_, and_
+from sqlalchemy.exc import IntegrityError
+from app.models import IngestionJob
+
+def _dedupe_key(kind, params):
+    return f"{kind}:{json.dumps(params, sort_keys=True)}"
+
+def enqueue_job(session, kind, params=None, trigger=None):
+    """Queues a job and commits. Returns (job, coalesced).
+
+    If an identical job (same kind and params) is still pending, no new job is added: that job's
+    requested_count goes up and it is returned with coalesced=True.
+    """
+    params = params or {}
+    key = _dedupe_key(kind, params)
+    for _ in range(3):
+        job = session.query(IngestionJob).filter_by(dedupe_key=key, status='pending').first()
+        if job is not None:
+            # Conditional, so a job claimed since the lookup isn't counted
+            bumped = session.query(IngestionJob).filter_by(id=job.id, status='pending').update(
+                {IngestionJob.requested_count: IngestionJob.requested_count + 1}, synchronize_session=False
+            )
+            session.commit()
+            if bumped:
+                session.refresh(job)
+                return job, True
+            continue
+
+        job = IngestionJob(kind=kind, params=json.dumps(params, sort_keys=True), dedupe_key=key, trigger=trigger,
+                           status='pending', requested_count=1, attempts=0)
+        session.add(job)
+        try:
+            session.commit()
+            return job, False
+        except IntegrityError:
+            # Someone enqueued the same job between the lookup and the insert; coalesce into theirs
+            session.rollback()
+    raise RuntimeError(f"Could not enqueue {kind} job")
+
+def claim_job(session, owner, lease_seconds, max_attempts=3):
+    """Claims the oldest claimable job for owner and commits. Returns the IngestionJob, or None.
+
+    Pending jobs and running jobs whose lease has expired are claimable. The claim is a conditional
+    UPDATE, so two workers can never both win, on SQLite as well as PostgreSQL (where the candidate
+    rows are also locked with SKIP LOCKED so workers don't queue up behind each other).
+    """
+    now = datetime.datetime.utcnow()
+    expired = and_(IngestionJob.status == 'running', IngestionJob.lease_expires_at < now)
+
+    # Jobs whose worker died max_attempts times are given up on
+    session.query(IngestionJob).filter(expired, IngestionJob.attempts >= max_attempts).update({
+        IngestionJob.status: 'failed',
+        IngestionJob.error: 'Lease expired too many times; the worker running it kept stopping',
+        IngestionJob.finished_at: now,
+        IngestionJob.lease_owner: None,
+        IngestionJob.lease_expires_at: None
+    }, synchronize_session=False)
+    session.commit()
+
+    claimable = or_(IngestionJob.status == 'pending', expired)
+    candidates = session.query(IngestionJob.id).filter(claimable).order_by(IngestionJob.id).limit(5) \
+        .with_for_update(skip_locked=True).all()
+    for (job_id,) in candidates:
+        claimed = session.query(IngestionJob).filter(IngestionJob.id == job_id, claimable).update({
+            IngestionJob.status: 'running',
+            IngestionJob.lease_owner: owner,
+            IngestionJob.lease_expires_at: now + datetime.timedelta(seconds=lease_seconds),
+            IngestionJob.started_at: now,
+            IngestionJob.attempts: IngestionJob.attempts + 1
+        }, synchronize_session=False)
+        session.commit()
+        if claimed:
+            return session.query(IngestionJob).get(job_id)
+    session.commit()
+    return None
+
+def renew_lease(session, job_id, owner, lease_seconds):
+    """Extends a running job's lease. Returns False if owner no longer holds it."""
+    renewed = session.query(IngestionJob).filter_by(id=job_id, lease_owner=owner, status='running').update({
+        IngestionJob.lease_expires_at: datetime.datetime.utcnow() + datetime.timedelta(seconds=lease_seconds)
+    }, synchronize_session=False)
+    session.commit()
+    return bool(renewed)
+
+def finish_job(session, job_id, owner, result=None, error=None):
+    """Records a job's outcome (failed if error is given) and commits. Returns False if owner had lost the lease."""
+    finished = session.query(IngestionJob).filter_by(id=job_id, lease_owner=owner, status='running').update({
+        IngestionJob.status: 'failed' if error else 'succeeded',
+        IngestionJob.result: json.dumps(result, default=str) if result is not None else None,
+        IngestionJob.error: error,
+        IngestionJob.finished_at: datetime.datetime.utcnow(),
+        IngestionJob.lease_expires_at: None
+    }, synchronize_session=False)
+    session.commit()
+    return bool(finished)
+
+def job_to_dict(job):
+    def iso(value):
+        return value.isoformat() if value else None
+    return {
+        "id": job.id,
+        "kind": job.kind,
+        "params": json.loads(job.params or '{}'),
+        "status": job.status,
+        "trigger": job.trigger,
+        "requested_count": job.requested_count,
+        "attempts": job.attempts,
+        "created_at": iso(job.created_at),
+        "started_at": iso(job.started_at),
+        "finished_at": iso(job.finished_at),
+        "result": json.loads(job.result) if job.result else None,
+        "error": job.error
+    }
@@ -0,0 +1,161 @@
+import os
+import json
+import time
+import uuid
+import atexit
+import socket
+import datetime
+import threading
+from sqlalchemy.exc import IntegrityError
+from app.db import create_lease_session
+from app.models import RunnerLease
+from config.settings import LEADER_LEASE_SECONDS
+
+class LeaseLost(Exception):
+    """Raised when a write is about to commit on behalf of a lease its owner no longer holds."""
+
+def try_acquire(session, name, owner, ttl, info=None):
+    """Takes or renews the named lease for owner and commits. Returns True if owner holds it now.
+
+    Conditional UPDATEs on the lease row do the work, so it behaves the same on SQLite and PostgreSQL:
+    the holder can always renew, anyone else only once expires_at has passed.
+    """
+    now = datetime.datetime.utcnow()
+    values = {RunnerLease.owner: owner, RunnerLease.expires_at: now + datetime.timedelta(seconds=ttl)}
+    if info is not None:
+        values[RunnerLease.info] = json.dumps(info, default=str)
+
+    held = session.query(RunnerLease).filter(RunnerLease.name == name, RunnerLease.owner == owner) \
+        .update(values, synchronize_session=False)
+    if not held:
+        values[RunnerLease.acquired_at] = now
+        held = session.query(RunnerLease).filter(RunnerLease.name == name, RunnerLease.expires_at < now) \
+            .update(values, synchronize_session=False)
+    if not held and session.query(RunnerLease.id).filter_by(name=name).first() is None:
+        session.add(RunnerLease(name=name, owner=owner, acquired_at=now, expires_at=now + datetime.timedelta(seconds=ttl),
+                                info=json.dumps(info, default=str) if info is not None else None))
+        try:
+            session.commit()
+            return True
+        except IntegrityError:
+            # Another process created it first
+            session.rollback()
+            return False
+    session.commit()
+    return bool(held)
+
+def release(session, name, owner):
+    """Gives up the lease if owner holds it, so another process can take over without waiting for it to expire."""
+    session.query(RunnerLease).filter(RunnerLease.name == name, RunnerLease.owner == owner).update(
+        {RunnerLease.expires_at: datetime.datetime.utcnow()}, synchronize_session=False
+    )
+    session.commit()
+
+def holds_lease(session, name, owner):
+    """True if owner holds the named lease right now.
+
+    Meant to be called inside the transaction the lease protects, after its writes: the lease row is
+    locked (FOR UPDATE on PostgreSQL, the write lock on SQLite) until that transaction ends, so nobody can
+    take the lease over between this check and the commit.
+    """
+    return session.query(RunnerLease.id).filter(
+        RunnerLease.name == name, RunnerLease.owner == owner, RunnerLease.expires_at > datetime.datetime.utcnow()
+    ).with_for_update().first() is not None
+
+def lease_status(session, name, owner=None):
+    """Returns the lease holder's details (None if nobody ever held it); is_me compares against owner."""
+    lease = session.query(RunnerLease).filter_by(name=name).first()
+    if lease is None:
+        return None
+    return {
+        "name": lease.name,
+        "owner": lease.owner,
+        "is_me": lease.owner == owner,
+        "active": lease.expires_at > datetime.datetime.utcnow(),
+        "acquired_at": lease.acquired_at.isoformat(),
+        "expires_at": lease.expires_at.isoformat(),
+        "info": json.loads(lease.info) if lease.info else None
+    }
+
+class LeaderElector(threading.Thread):
+    """Competes for a named lease and keeps renewing it while this process holds it.
+
+    on_elected() runs when this process becomes leader and on_demoted() when it loses the lease
+    (e.g. a renewal failed for longer than the TTL). status(), if given, is published with every
+    renewal so other processes can see what the leader is doing. is_leader() errs on the side of
+    False: it stops being true a third of a TTL before the lease could expire. Lease rows are written
+    on a connection of their own (app.db.create_lease_session), never on one a writer is using; writers
+    call ensure_held(session) in their own transaction right before committing.
+    """
+    def __init__(self, name, on_elected=None, on_demoted=None, status=None, ttl=LEADER_LEASE_SECONDS, owner=None):
+        super().__init__(daemon=True, name=f"leader-{name}")
+        self.lease_name = name
+        self.on_elected = on_elected
+        self.on_demoted = on_demoted
+        self.status = status
+        self.ttl = ttl
+        # Unique per elector, not just per process, so two electors can never both believe they hold the lease
+        self.owner = owner or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._valid_until = 0
+        self._leader = False
+        self._ready = threading.Event()
+        self._stopped = threading.Event()
+
+    def is_leader(self):
+        return self._leader and time.monotonic() < self._valid_until
+
+    def wait_elected(self, timeout=None):
+        """Waits for the first round of the election (the thread must be started). Returns is_leader()."""
+        self._ready.wait(timeout)
+        return self.is_leader()
+
+    def ensure_held(self, session):
+        """Raises LeaseLost unless this elector still holds the lease, checked in session's transaction."""
+        if not holds_lease(session, self.lease_name, self.owner):
+            raise LeaseLost(f"{self.owner} no longer holds the {self.lease_name} lease")
+
+    def _round(self):
+        started = time.monotonic()
+        session = create_lease_session()
+        try:
+            info = self.status() if self.status else None
+            held = try_acquire(session, self.lease_name, self.owner, self.ttl, info)
+        except Exception as e:
+            print(f"[Leader] Could not renew the {self.lease_name} lease: {e}", flush=True)
+            held = None
+        finally:
+            session.close()
+
+        if held:
+            self._valid_until = started + self.ttl * 2 / 3
+        if held and not self._leader:
+            self._leader = True
+            print(f"[Leader] {self.owner} now holds the {self.lease_name} lease", flush=True)
+            if self.on_elected:
+                self.on_elected()
+        elif self._leader and (held is False or not self.is_leader()):
+            self._leader = False
+            print(f"[Leader] {self.owner} lost the {self.lease_name} lease", flush=True)
+            if self.on_demoted:
+                self.on_demoted()
+        self._ready.set()
+
+    def run(self):
+        atexit.register(self.stop)
+        while not self._stopped.is_set():
+            self._round()
+            self._stopped.wait(self.ttl / 3)
+
+    def stop(self):
+        if self._stopped.is_set():
+            return
+        self._stopped.set()
+        if self._leader:
+            self._leader = False
+            session = create_lease_session()
+            try:
+                release(session, self.lease_name, self.owner)
+            except Exception:
+                pass
+            finally:
+                session.close()
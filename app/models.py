@@ -1,4 +1,5 @@
-from sqlalchemy import Column, Integer, String, Float, Date, UniqueConstraint
+import datetime
+from sqlalchemy import Column, Integer, BigInteger, String, Text, Float, Date, DateTime, UniqueConstraint, Index, Table, text
 from sqlalchemy.ext.declarative import declarative_base
 
 Base = declarative_base()
@@ -69,4 +70,216 @@ class DailyReport(Base):
 
     __table_args__ = (
         UniqueConstraint("pharmacy_code", "report_date", name="_pharmacy_day_uc"),
-    ) 
\ No newline at end of file
+    )
+
+class MonthToDateReport(Base):
+    """Latest "This Month" column of the daily report, one row per pharmacy and month."""
+    __tablename__ = "month_to_date_reports"
+
+    id = Column(Integer, primary_key=True)
+    pharmacy_code = Column(String, nullable=False)
+    month = Column(String(7), nullable=False)  # YYYY-MM
+    as_of_date = Column(Date, nullable=False)  # report_date of the report the snapshot came from
+
+    # SALES SUMMARY
+    cash_sales_mtd = Column(Float)
+    cash_sales_trans_mtd = Column(Integer)
+    cod_payments_mtd = Column(Float)
+    cod_payments_trans_mtd = Column(Integer)
+    receipt_on_account_mtd = Column(Float)
+    receipt_on_account_trans_mtd = Column(Integer)
+    subtotal_mtd = Column(Float)
+    subtotal_trans_mtd = Column(Integer)
+    paid_outs_mtd = Column(Float)
+    paid_outs_trans_mtd = Column(Integer)
+    cash_refunds_mtd = Column(Float)
+    cash_refunds_trans_mtd = Column(Integer)
+    sales_total_mtd = Column(Float)
+    sales_total_trans_mtd = Column(Integer)
+    account_sales_mtd = Column(Float)
+    account_sales_trans_mtd = Column(Integer)
+    cod_sales_mtd = Column(Float)
+    cod_sales_trans_mtd = Column(Integer)
+    account_refunds_mtd = Column(Float)
+    account_refunds_trans_mtd = Column(Integer)
+    pos_turnover_mtd = Column(Float)
+    pos_turnover_trans_mtd = Column(Integer)
+
+    # BASKET METRICS
+    avg_items_per_basket_mtd = Column(Float)
+    avg_value_per_basket_mtd = Column(Float)
+
+    # CASH-UP RECONCILIATION
+    cash_tenders_mtd = Column(Float)
+    credit_card_tenders_mtd = Column(Float)
+    total_banked_mtd = Column(Float)
+
+    # STOCK TRADING ACCOUNT
+    stock_sales_mtd = Column(Float)
+    stock_purchases_mtd = Column(Float)
+    stock_adjustments_mtd = Column(Float)
+    cost_of_sales_mtd = Column(Float)
+    stock_gross_profit_mtd = Column(Float)
+    stock_gross_profit_percent_mtd = Column(Float)
+    opening_stock_mtd = Column(Float)
+    closing_stock_mtd = Column(Float)
+
+    # DISPENSARY SUMMARY
+    dispensary_turnover_mtd = Column(Float)
+    scripts_dispensed_mtd = Column(Float)
+    avg_script_value_mtd = Column(Float)
+    avg_items_per_script_mtd = Column(Float)
+    avg_item_gross_value_mtd = Column(Float)
+    outstanding_levies_mtd = Column(Float)
+
+    # TURNOVER SUMMARY
+    retail_sales_mtd = Column(Float)
+    type_r_sales_mtd = Column(Float)
+    capitation_sales_mtd = Column(Float)
+    total_turnover_mtd = Column(Float)
+
+    __table_args__ = (
+        UniqueConstraint("pharmacy_code", "month", name="_pharmacy_month_uc"),
+    )
+
+class IngestionLedger(Base):
+    """One row per report payload that has been parsed and written, so unchanged reports can be skipped."""
+    __tablename__ = "ingestion_ledger"
+
+    id = Column(Integer, primary_key=True)
+    message_id = Column(String, nullable=False)  # Message-ID header, '' when the email has none
+    payload_sha256 = Column(String(64), nullable=False)
+    pharmacy_code = Column(String, nullable=False)
+    report_date = Column(Date, nullable=False)
+    ingested_at = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+    __table_args__ = (
+        UniqueConstraint("message_id", "payload_sha256", name="_message_payload_uc"),
+    )
+
+class MailboxSyncState(Base):
+    """Last-seen IMAP UID per mailbox, so each fetch only transfers messages that arrived since the previous one."""
+    __tablename__ = "mailbox_sync_state"
+
+    id = Column(Integer, primary_key=True)
+    pharmacy_code = Column(String, nullable=False, unique=True)
+    email_user = Column(String)  # A different account means the stored UIDs no longer apply
+    uidvalidity = Column(BigInteger)
+    last_uid = Column(BigInteger, nullable=False, default=0)
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
+
+class ArchivedReport(Base):
+    """Index of the raw report payloads kept by app/archive.py, one row per (pharmacy, date, message, payload)."""
+    __tablename__ = "archived_reports"
+
+    id = Column(Integer, primary_key=True)
+    pharmacy_code = Column(String, nullable=False, index=True)
+    report_date = Column(Date, nullable=False, index=True)
+    message_id = Column(String, nullable=False)  # '' when the email has none
+    payload_sha256 = Column(String(64), nullable=False)  # Also the archive object's name
+    charset = Column(String)
+    codec = Column(String(8), nullable=False)  # 'zst' or 'gz'
+    size = Column(Integer, nullable=False)  # Uncompressed bytes
+    archived_at = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+    __table_args__ = (
+        UniqueConstraint("pharmacy_code", "report_date", "message_id", "payload_sha256", name="_archived_report_uc"),
+    )
+
+class BackfillCheckpoint(Base):
+    """Month windows of the historical backfill (scripts/sync_all.py) that were fully ingested, per mailbox."""
+    __tablename__ = "backfill_checkpoints"
+
+    id = Column(Integer, primary_key=True)
+    pharmacy_code = Column(String, nullable=False, index=True)
+    email_user = Column(String, nullable=False)  # Checkpoints from a different account don't apply
+    window_start = Column(Date, nullable=False)
+    window_end = Column(Date, nullable=False)
+    reports = Column(Integer, nullable=False, default=0)  # Reports found in the window
+    completed_at = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+    __table_args__ = (
+        UniqueConstraint("pharmacy_code", "email_user", "window_start", name="_backfill_window_uc"),
+    )
+
+class IngestionJob(Base):
+    """Queued ingestion work (app/jobs.py), e.g. a fetch requested through /api/force_update.
+
+    status goes pending -> running -> succeeded/failed. A running job belongs to lease_owner until
+    lease_expires_at; a worker that dies mid-job lets the lease lapse and another worker picks it up.
+    """
+    __tablename__ = "ingestion_jobs"
+
+    id = Column(Integer, primary_key=True)
+    kind = Column(String, nullable=False)  # 'fetch'
+    params = Column(Text, nullable=False, default='{}')  # JSON
+    dedupe_key = Column(String, nullable=False)  # kind + params; identical pending jobs are coalesced on it
+    status = Column(String, nullable=False, default='pending')
+    trigger = Column(String)  # 'force_update', 'periodic', 'idle', ...
+    requested_count = Column(Integer, nullable=False, default=1)  # Requests coalesced into this job
+    attempts = Column(Integer, nullable=False, default=0)
+    lease_owner = Column(String)
+    lease_expires_at = Column(DateTime)
+    result = Column(Text)  # JSON result of the run
+    error = Column(Text)
+    created_at = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
+    started_at = Column(DateTime)
+    finished_at = Column(DateTime)
+
+    __table_args__ = (
+        # At most one pending job per dedupe_key, enforced by the database
+        Index("ix_ingestion_jobs_pending_key", "dedupe_key", unique=True,
+              sqlite_where=text("status = 'pending'"), postgresql_where=text("status = 'pending'")),
+        Index("ix_ingestion_jobs_status", "status"),
+    )
+
+class RunnerLease(Base):
+    """Named leases for leader election between processes (app/leader.py).
+
+    Whoever holds the 'ingestion' lease is the one process that runs background fetches; it renews
+    expires_at while alive and publishes its status in info for the other processes to read.
+    """
+    __tablename__ = "runner_leases"
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String, nullable=False, unique=True)
+    owner = Column(String, nullable=False)  # host:pid
+    acquired_at = Column(DateTime, nullable=False)
+    expires_at = Column(DateTime, nullable=False)
+    info = Column(Text)  # JSON
+
+# DailyReport figures kept by the rollup tables. Averages and percentages can't be added up, so the rollups
+# hold their sum (<name>_sum) and the number of days that count towards them (<name>_days); stock levels are
+# balances and aren't rolled up; every other numeric figure is a daily flow and is summed under its own name.
+ROLLUP_AVERAGED = (
+    "avg_items_per_basket", "avg_value_per_basket", "stock_gross_profit_percent_today",
+    "avg_script_value_today", "avg_items_per_script_today", "avg_item_gross_value_today"
+)
+ROLLUP_SUMMED = tuple(
+    column.name for column in DailyReport.__table__.columns
+    if isinstance(column.type, (Integer, Float)) and not column.primary_key
+    and column.name not in ROLLUP_AVERAGED and column.name not in ("opening_stock_today", "closing_stock_today")
+)
+
+def _rollup_table(name, period):
+    return Table(
+        name, Base.metadata,
+        Column("id", Integer, primary_key=True),
+        Column("pharmacy_code", String, nullable=False),
+        period,
+        Column("days", Integer, nullable=False, default=0),  # Daily reports in the period
+        *[Column(metric, Float, nullable=False, default=0) for metric in ROLLUP_SUMMED],
+        *[column for metric in ROLLUP_AVERAGED for column in (
+            Column(f"{metric}_sum", Float, nullable=False, default=0),
+            Column(f"{metric}_days", Integer, nullable=False, default=0)
+        )],
+        UniqueConstraint("pharmacy_code", period.name, name=f"_{name}_uc")
+    )
+
+class MonthlyRollup(Base):
+    """Totals of each pharmacy's daily reports per month, kept up to date by app/rollups.py."""
+    __table__ = _rollup_table("monthly_rollups", Column("month", String(7), nullable=False))  # YYYY-MM
+
+class YearlyRollup(Base):
+    """Totals of each pharmacy's daily reports per calendar year, kept up to date by app/rollups.py."""
+    __table__ = _rollup_table("yearly_rollups", Column("year", Integer, nullable=False))
@@ -0,0 +1,290 @@
+import os
+import gc
+import time
+import queue
+import datetime
+import threading
+import psutil
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor
+from app.db import create_session, cleanup_db_sessions
+from app.parser import parse_html_bytes
+from app.ingest import payload_sha256, ingested_keys, get_mailbox_state
+from app.archive import archive_report
+from app.writer import ReportWriter
+from app.leader import LeaseLost
+from app.email_fetcher import fetch_emails_last_n_days, sync_all_emails
+from config.settings import MAILBOXES, DATABASE_URI, FETCH_CONCURRENCY
+
+def _memory_mb():
+    return psutil.Process(os.getpid()).memory_info().rss / 1024 ** 2
+
+def _position(sync_state):
+    return sync_state.uidvalidity, sync_state.email_user, sync_state.last_uid
+
+def _put(reports, message, abort):
+    # Don't block forever on a full queue once the writer has stopped listening
+    while not abort.is_set():
+        try:
+            reports.put(message, timeout=1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+def _fetch_mailbox(pharmacy_config, position, fetch_all, days_to_fetch, reports, stop, abort):
+    """Runs in a fetcher thread. Puts ('report', code, item, position, None) for every report, then
+    ('done', code, None, position, error).
+
+    Only IMAP work happens here; parsing and DB writes stay on the writer thread. position is a
+    plain copy of the mailbox's MailboxSyncState, and the snapshot sent with each report covers
+    every message before it, so the writer can persist it once that report has been handled.
+    stop ends this mailbox early; abort means the writer is gone.
+    """
+    code = pharmacy_config["code"]
+    error = None
+    try:
+        # Reports are yielded as in-memory payloads, so nothing touches the filesystem
+        if fetch_all:
+            email_iter = sync_all_emails(pharmacy_config, in_memory=True, sync_state=position)
+        else:
+            email_iter = fetch_emails_last_n_days(pharmacy_config, days=days_to_fetch, in_memory=True, sync_state=position)
+        for item in email_iter:
+            if not _put(reports, ('report', code, item, _position(position), None), abort) or stop.is_set():
+                email_iter.close()
+                break
+    except Exception as e:
+        error = e
+    _put(reports, ('done', code, None, _position(position), error), abort)
+
+def run_fetch(pharmacy_code=None, fetch_all=False, days_to_fetch=7, reingest=False, concurrency=FETCH_CONCURRENCY,
+              memory_budget_mb=100, lease=None):
+    """Fetches, parses and stores new reports for every mailbox (or just pharmacy_code). Returns a result dict.
+
+    This is the whole ingestion pipeline, shared by scripts/fetch_latest.py and the in-process scheduler
+    (app/scheduler.py): mailboxes are fetched on up to `concurrency` threads while the calling thread is
+    the single writer. A mailbox stops early once the process has grown more than memory_budget_mb since
+    the run started (measured against the start, so it means the same in a script and in the web
+    process); its UID position is only advanced past reports that were handled, so the next run picks
+    up the rest.
+
+    lease, when given, is the app.leader.LeaderElector this run is on behalf of: once it no longer
+    leads, every mailbox stops and nothing more is written, and each batch re-checks the lease in its
+    own transaction before committing.
+
+    The result is JSON-serialisable:
+    {"status": "success"|"partial", "started_at", "finished_at", "duration_seconds", "processed",
+     "unchanged", "latest_date", "memory_mb": {"start", "end"}, "errors": [...],
+     "mailboxes": {code: {"processed", "unchanged", "stopped", "error"}}}
+    """
+    started = time.perf_counter()
+    result = {
+        "status": "success",
+        "pharmacy": pharmacy_code,
+        "fetch_all": fetch_all,
+        "started_at": datetime.datetime.utcnow().isoformat(),
+        "processed": 0,
+        "unchanged": 0,
+        "latest_date": None,
+        "memory_mb": {"start": round(_memory_mb(), 2)},
+        "errors": [],
+        "mailboxes": {},
+    }
+    print(f"[Memory] At fetch start: {result['memory_mb']['start']:.2f} MB", flush=True)
+
+    session = create_session()
+    print(f"Database: {DATABASE_URI}")
+
+    total_emails_processed = 0
+    total_unchanged = 0
+    latest_date = None
+
+    mailboxes = []
+    for pharmacy_config in MAILBOXES:
+        if pharmacy_code and pharmacy_config["code"] != pharmacy_code:
+            continue
+        # Check if we have the required credentials for this pharmacy
+        if not pharmacy_config.get("email_user") or not pharmacy_config.get("email_password"):
+            print(f"[SKIP] Missing email credentials for {pharmacy_config.get('name', pharmacy_config['code'])}, skipping...")
+            continue
+        mailboxes.append(pharmacy_config)
+
+    # Bounded, so fetchers wait for the writer instead of buffering whole mailboxes in memory
+    concurrency = max(1, concurrency)
+    reports = queue.Queue(maxsize=concurrency * 2)
+
+    # Per-mailbox state lives on the writer thread only
+    configs, sync_states, seen, stops, stats = {}, {}, {}, {}, {}
+    abort = threading.Event()
+    # Parsed reports are written in batches, one transaction each
+    writer = ReportWriter(session, lease=lease)
+
+    def lease_lost():
+        # Another process may be ingesting already; drop the buffer and leave everything to it
+        print("[ERROR] Lost the ingestion lease, stopping this run", flush=True)
+        result["errors"].append("Lost the ingestion lease")
+        for code in stops:
+            stops[code].set()
+            stats[code]['stopped'] = True
+        abort.set()
+
+    def flush():
+        nonlocal total_emails_processed, latest_date
+        count, codes = len(writer), writer.pharmacy_codes()
+        try:
+            written = writer.flush()
+        except LeaseLost:
+            lease_lost()
+            return
+        except Exception as e:
+            print(f"[ERROR] Failed to save {count} report(s): {e}")
+            result["errors"].append(f"Failed to save {count} report(s): {e}")
+            # The rollback put these mailboxes' positions back before the lost reports; stop them so no
+            # later report or flush moves a position past them again, and the next run fetches them
+            for code in codes:
+                stops[code].set()
+                stats[code]['stopped'] = True
+            return
+        for code, report_date, message_id, digest in written:
+            seen[code].add((message_id, digest))
+            stats[code]['processed'] += 1
+            total_emails_processed += 1
+            if latest_date is None or report_date > latest_date:
+                latest_date = report_date
+            print(f"  > New data added for {configs[code].get('name', code)} for {report_date.strftime('%Y-%m-%d')}", flush=True)
+    try:
+        for pharmacy_config in mailboxes:
+            code = pharmacy_config["code"]
+            configs[code] = pharmacy_config
+            # Last-seen UID for this mailbox; only messages after it are fetched
+            sync_states[code] = get_mailbox_state(session, code)
+            # Reports already ingested byte-for-byte are skipped before parsing
+            seen[code] = set() if reingest else ingested_keys(session, code)
+            stops[code] = threading.Event()
+            stats[code] = {'processed': 0, 'unchanged': 0, 'stopped': False, 'error': None}
+        session.commit()
+
+        print(f"Fetching {len(mailboxes)} mailbox(es), {concurrency} at a time...", flush=True)
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="imap") as executor:
+            for code, pharmacy_config in configs.items():
+                print(f"Checking for new emails for {pharmacy_config.get('name', code)}...", flush=True)
+                state = sync_states[code]
+                position = SimpleNamespace(uidvalidity=state.uidvalidity, email_user=state.email_user, last_uid=state.last_uid or 0)
+                executor.submit(_fetch_mailbox, pharmacy_config, position, fetch_all, days_to_fetch, reports, stops[code], abort)
+
+            # Single writer: everything below runs on this thread, one report at a time
+            try:
+                pending = len(configs)
+                while pending and not abort.is_set():
+                    kind, code, item, position, error = reports.get()
+                    if lease is not None and not lease.is_leader():
+                        lease_lost()
+                        break
+                    pharmacy_config = configs[code]
+                    pharmacy_name = pharmacy_config.get("name", code)
+                    sync_state = sync_states[code]
+
+                    if kind == 'done':
+                        pending -= 1
+                        if not stops[code].is_set():
+                            sync_state.uidvalidity, sync_state.email_user, sync_state.last_uid = position
+                        # Persist the buffered reports and the UID position, including messages that were skipped
+                        flush()
+                        if error is not None:
+                            print(f"[ERROR] Could not fetch emails for {pharmacy_name}: {error}")
+                            stats[code]['error'] = str(error)
+                            result["errors"].append(f"{code}: {error}")
+                        total_unchanged += stats[code]['unchanged']
+                        if stats[code]['unchanged']:
+                            print(f"  > {stats[code]['unchanged']} report(s) unchanged since last ingestion for {pharmacy_name}, skipped.", flush=True)
+                        if stats[code]['processed'] == 0:
+                            print(f"No new data found to be added for {pharmacy_name}.")
+                        print(f"[Memory] After processing {pharmacy_name}: {_memory_mb():.2f} MB", flush=True)
+                        print(f"Finished fetching emails for {pharmacy_name}.")
+                        continue
+
+                    if stops[code].is_set():
+                        continue  # Left for the next run; the UID position was not advanced past it
+                    (payload, charset, message_id), report_date_obj, subject = item
+                    # Everything before this message has been handled
+                    sync_state.uidvalidity, sync_state.email_user, sync_state.last_uid = position
+                    try:
+                        print(f"  > 1 new email found for {pharmacy_name} with subject: '{subject}'", flush=True)
+
+                        # Skip forwarded emails that don't contain the report
+                        if "fwd:" in subject.lower():
+                            print(f"  > Skipping forwarded email: '{subject}'", flush=True)
+                            continue
+
+                        digest = payload_sha256(payload)
+                        if (message_id, digest) in seen[code]:
+                            stats[code]['unchanged'] += 1
+                            continue
+
+                        # Keep the raw payload before parsing, so parser fixes can be replayed offline.
+                        # The index row is committed with the next batch
+                        try:
+                            archive_report(session, payload, charset, message_id, code, report_date_obj, digest)
+                        except Exception as e:
+                            print(f"[ERROR] Failed to archive report for {report_date_obj}: {e}")
+
+                        print(f"[Memory] Before parsing: {_memory_mb():.2f} MB", flush=True)
+                        print(f"Parsing report for date: {report_date_obj.strftime('%Y-%m-%d')}")
+
+                        try:
+                            data, mtd = parse_html_bytes(payload, charset, with_mtd=True)
+                            print(f"[Memory] After parsing: {_memory_mb():.2f} MB", flush=True)
+                            writer.add(code, report_date_obj, data, mtd, message_id, digest)
+                            if writer.full:
+                                flush()
+                        except Exception as e:
+                            print(f"[ERROR] Failed to parse report for {report_date_obj}: {e}")
+                            result["errors"].append(f"{code} {report_date_obj}: {e}")
+                        finally:
+                            del payload
+
+                            # Force garbage collection to free memory
+                            gc.collect()
+
+                            # Check how much this run has grown and stop this mailbox if it's getting too much
+                            current_memory = _memory_mb()
+                            if current_memory > result["memory_mb"]["start"] + memory_budget_mb:
+                                print(f"[WARNING] Memory usage high ({current_memory:.2f} MB, {result['memory_mb']['start']:.2f} MB at start), "
+                                      f"stopping processing for {pharmacy_name}")
+                                stops[code].set()
+                                stats[code]['stopped'] = True
+
+                    except Exception as e_process:
+                        print(f"[ERROR] Error processing email for {pharmacy_name}: {e_process}")
+                        continue
+            finally:
+                # Fetchers blocked on a full queue must not keep the pool from shutting down
+                abort.set()
+
+    finally:
+        # Always clean up database resources
+        try:
+            session.close()
+            cleanup_db_sessions()
+        except Exception as e:
+            print(f"[ERROR] Error closing database session: {e}")
+
+    if total_emails_processed > 0:
+        print(f"{total_emails_processed} emails processed, all pharmacies now up to date until {latest_date.strftime('%Y-%m-%d') if latest_date else 'N/A'}.")
+    else:
+        print("No emails processed. Database may already be up to date.")
+    if total_unchanged > 0:
+        print(f"{total_unchanged} unchanged report(s) skipped via the ingestion ledger.")
+
+    result.update({
+        "status": "partial" if result["errors"] or any(s['stopped'] for s in stats.values()) else "success",
+        "finished_at": datetime.datetime.utcnow().isoformat(),
+        "duration_seconds": round(time.perf_counter() - started, 2),
+        "processed": total_emails_processed,
+        "unchanged": total_unchanged,
+        "latest_date": latest_date.isoformat() if latest_date else None,
+        "mailboxes": stats,
+    })
+    result["memory_mb"]["end"] = round(_memory_mb(), 2)
+    print(f"[Memory] At fetch end: {result['memory_mb']['end']:.2f} MB", flush=True)
+    return result
@@ -0,0 +1,235 @@
+import datetime
+from sqlalchemy import select, and_, or_, func, case
+from app.aggregates import total, count
+from app.ingest import _UPSERT_INSERTS
+from app.models import DailyReport, MonthlyRollup, YearlyRollup, ROLLUP_AVERAGED, ROLLUP_SUMMED
+
+# Averages only count days with a figure: the basket averages days with sales, the rest non-zero days,
+# the same rules the *_for_range endpoints apply (see app/aggregates.py)
+_AVERAGE_BASIS = {"avg_items_per_basket": "avg_value_per_basket", "avg_value_per_basket": "avg_value_per_basket"}
+
+# DailyReport columns a row's rollup contribution depends on
+ROLLUP_INPUTS = ROLLUP_SUMMED + ROLLUP_AVERAGED
+ROLLUP_COLUMNS = ("days",) + ROLLUP_SUMMED + tuple(
+    column for metric in ROLLUP_AVERAGED for column in (f"{metric}_sum", f"{metric}_days")
+)
+
+def _counted(metric, values):
+    value, basis = values.get(metric), values.get(_AVERAGE_BASIS.get(metric, metric))
+    if value is None or basis is None:
+        return False
+    return basis > 0 if metric in _AVERAGE_BASIS else basis != 0
+
+def _counted_sql(metric):
+    column, basis = getattr(DailyReport, metric), getattr(DailyReport, _AVERAGE_BASIS.get(metric, metric))
+    return and_(column.isnot(None), basis > 0 if metric in _AVERAGE_BASIS else basis != 0)
+
+def contribution(values):
+    """What one daily report (a mapping of DailyReport column values, or None for no row) adds to its rollups."""
+    if values is None:
+        return dict.fromkeys(ROLLUP_COLUMNS, 0)
+    result = {"days": 1}
+    for metric in ROLLUP_SUMMED:
+        result[metric] = values.get(metric) or 0
+    for metric in ROLLUP_AVERAGED:
+        counted = _counted(metric, values)
+        result[f"{metric}_sum"] = values[metric] if counted else 0
+        result[f"{metric}_days"] = 1 if counted else 0
+    return result
+
+def _add(totals, values):
+    for name, value in values.items():
+        totals[name] = totals.get(name, 0) + value
+
+def _lock_rollups(session, model, period, keys):
+    """Locks the rollup rows for keys ([(pharmacy_code, period value)], sorted) until the transaction ends,
+    adding empty ones where missing, so writers to the same period take turns."""
+    table = model.__table__
+    rows = [dict(dict.fromkeys(ROLLUP_COLUMNS, 0), pharmacy_code=pharmacy_code, **{period: key}) for pharmacy_code, key in keys]
+    insert = _UPSERT_INSERTS.get(session.get_bind().dialect.name)
+    if insert is not None:
+        # The no-op update locks an existing row just as the insert locks a new one
+        statement = insert(table).on_conflict_do_update(
+            index_elements=["pharmacy_code", period], set_={"days": table.c.days}
+        )
+        session.execute(statement, rows)
+        return
+    for row in rows:
+        found = session.execute(select(table.c.id).where(
+            table.c.pharmacy_code == row["pharmacy_code"], table.c[period] == row[period]
+        ).with_for_update()).first()
+        if found is None:
+            session.execute(table.insert().values(row))
+
+def _write_totals(session, model, period, totals):
+    """Sets the rollup rows for totals ({(pharmacy_code, period value): ROLLUP_COLUMNS}) to those values,
+    deleting the ones without any days."""
+    table = model.__table__
+    rows = [dict(values, pharmacy_code=pharmacy_code, **{period: key})
+            for (pharmacy_code, key), values in totals.items() if values["days"]]
+    insert = _UPSERT_INSERTS.get(session.get_bind().dialect.name)
+    if rows and insert is not None:
+        statement = insert(table)
+        statement = statement.on_conflict_do_update(
+            index_elements=["pharmacy_code", period],
+            set_={name: statement.excluded[name] for name in ROLLUP_COLUMNS}
+        )
+        session.execute(statement, rows)
+    else:
+        for row in rows:
+            updated = session.execute(table.update().where(
+                table.c.pharmacy_code == row["pharmacy_code"], table.c[period] == row[period]
+            ).values({name: row[name] for name in ROLLUP_COLUMNS}))
+            if not updated.rowcount:
+                session.execute(table.insert().values(row))
+    for (pharmacy_code, key), values in totals.items():
+        if not values["days"]:
+            session.execute(table.delete().where(table.c.pharmacy_code == pharmacy_code, table.c[period] == key))
+
+def refresh_rollups(session, keys):
+    """Recomputes the month and year rollups containing keys ((pharmacy_code, report_date) pairs) from the
+    daily reports. Call it after the daily rows were written, in the same transaction (the caller owns it).
+
+    The rollup rows are locked before anything is read, so concurrent writers to the same month or year
+    take turns, and each one totals the daily rows the other committed rather than adjusting a stale value.
+    """
+    if ensure_rollups(session):
+        return
+    months = sorted({(pharmacy_code, report_date.strftime('%Y-%m')) for pharmacy_code, report_date in keys})
+    years = sorted({(pharmacy_code, report_date.year) for pharmacy_code, report_date in keys})
+    if not months:
+        return
+    _lock_rollups(session, MonthlyRollup, "month", months)
+    _lock_rollups(session, YearlyRollup, "year", years)
+
+    monthly = {}
+    for pharmacy_code, month in months:
+        first = datetime.date.fromisoformat(f"{month}-01")
+        monthly[(pharmacy_code, month)] = _daily_totals(session, pharmacy_code, [(first, _next_month(first) - datetime.timedelta(days=1))])
+    _write_totals(session, MonthlyRollup, "month", monthly)
+    # The months are current now, so each year is the sum of its monthly rollups
+    _write_totals(session, YearlyRollup, "year", {
+        (pharmacy_code, year): _rollup_totals(session, MonthlyRollup, "month", pharmacy_code, [f"{year}-{month:02d}" for month in range(1, 13)])
+        for pharmacy_code, year in years
+    })
+
+def rebuild_rollups(session, pharmacy_code=None):
+    """Recomputes the rollups (of one pharmacy, or all) from the daily reports. The caller owns the transaction.
+
+    Needed after daily rows are changed other than through upsert_daily_reports, /api/manual_turnover or
+    refresh_rollups, e.g. edited by hand. Returns the number of monthly rollups written.
+
+    Rows are written as upserts, so two processes building the rollups for the first time at once don't
+    trip over each other's rows.
+    """
+    monthly_table, yearly_table = MonthlyRollup.__table__, YearlyRollup.__table__
+    statement = select(DailyReport.pharmacy_code, DailyReport.report_date, *[getattr(DailyReport, name) for name in ROLLUP_INPUTS])
+    if pharmacy_code is not None:
+        statement = statement.where(DailyReport.pharmacy_code == pharmacy_code)
+        session.execute(monthly_table.delete().where(monthly_table.c.pharmacy_code == pharmacy_code))
+        session.execute(yearly_table.delete().where(yearly_table.c.pharmacy_code == pharmacy_code))
+    else:
+        session.execute(monthly_table.delete())
+        session.execute(yearly_table.delete())
+
+    monthly, yearly = {}, {}
+    for row in session.execute(statement.execution_options(yield_per=1000)):
+        values = contribution(dict(zip(ROLLUP_INPUTS, row[2:])))
+        _add(monthly.setdefault((row[0], row[1].strftime('%Y-%m')), {}), values)
+        _add(yearly.setdefault((row[0], row[1].year), {}), values)
+    if monthly:
+        _write_totals(session, MonthlyRollup, "month", monthly)
+        _write_totals(session, YearlyRollup, "year", yearly)
+    return len(monthly)
+
+def ensure_rollups(session):
+    """Builds the rollups if their tables are empty while there are daily reports, e.g. on the first write
+    after they were added. Returns True if it did. The caller owns the transaction."""
+    if session.query(MonthlyRollup.id).first() is None and session.query(DailyReport.id).first() is not None:
+        print("[Rollups] Building monthly and yearly rollups from the daily reports...", flush=True)
+        print(f"[Rollups] Built {rebuild_rollups(session)} monthly rollups", flush=True)
+        return True
+    return False
+
+_rollups_built = False
+
+def rollups_built(session):
+    """Whether range queries can use the rollups: they are non-empty (remembered for the process once seen)
+    or there are no daily reports yet."""
+    global _rollups_built
+    if not _rollups_built:
+        if session.query(MonthlyRollup.id).first() is None:
+            return session.query(DailyReport.id).first() is None
+        _rollups_built = True
+    return True
+
+def _daily_totals(session, pharmacy_code, spans):
+    """ROLLUP_COLUMNS summed over the pharmacy's daily reports in the given (start, end) spans, in one SELECT."""
+    measures = [func.count().label("days")]
+    measures += [total(getattr(DailyReport, metric)).label(metric) for metric in ROLLUP_SUMMED]
+    for metric in ROLLUP_AVERAGED:
+        counted = _counted_sql(metric)
+        measures.append(total(case((counted, getattr(DailyReport, metric)))).label(f"{metric}_sum"))
+        measures.append(count(counted).label(f"{metric}_days"))
+    statement = select(*measures).where(
+        DailyReport.pharmacy_code == pharmacy_code,
+        or_(*[and_(DailyReport.report_date >= start, DailyReport.report_date <= end) for start, end in spans])
+    )
+    return dict(session.execute(statement).one()._mapping)
+
+def _rollup_totals(session, model, period, pharmacy_code, keys):
+    table = model.__table__
+    statement = select(*[func.coalesce(func.sum(table.c[name]), 0).label(name) for name in ROLLUP_COLUMNS]).where(
+        table.c.pharmacy_code == pharmacy_code,
+        table.c[period].in_(keys)
+    )
+    return dict(session.execute(statement).one()._mapping)
+
+def _next_month(day):
+    return (day.replace(day=28) + datetime.timedelta(days=4)).replace(day=1)
+
+def range_totals(session, pharmacy_code, start_date, end_date):
+    """ROLLUP_COLUMNS summed over a pharmacy's daily reports from start_date to end_date inclusive.
+
+    Whole years are read from yearly_rollups, the remaining whole months from monthly_rollups and only
+    the days of a partial first or last month from daily_reports, so the cost grows with the number of
+    months rather than days. Falls back to the daily rows alone if the dates aren't YYYY-MM-DD or the
+    rollups haven't been built.
+    """
+    try:
+        start = start_date if isinstance(start_date, datetime.date) else datetime.date.fromisoformat(start_date)
+        end = end_date if isinstance(end_date, datetime.date) else datetime.date.fromisoformat(end_date)
+    except ValueError:
+        return _daily_totals(session, pharmacy_code, [(start_date, end_date)])
+    if not rollups_built(session):
+        return _daily_totals(session, pharmacy_code, [(start, end)])
+
+    # Whole months are [first_month, after_last_month)
+    first_month = start if start.day == 1 else _next_month(start)
+    after_last_month = _next_month(end) if _next_month(end) == end + datetime.timedelta(days=1) else end.replace(day=1)
+    if first_month >= after_last_month:
+        return _daily_totals(session, pharmacy_code, [(start, end)])
+
+    spans = []
+    if start < first_month:
+        spans.append((start, first_month - datetime.timedelta(days=1)))
+    if after_last_month <= end:
+        spans.append((after_last_month, end))
+    years, months = [], []
+    month = first_month
+    while month < after_last_month:
+        if month.month == 1 and month.replace(year=month.year + 1) <= after_last_month:
+            years.append(month.year)
+            month = month.replace(year=month.year + 1)
+        else:
+            months.append(month.strftime('%Y-%m'))
+            month = _next_month(month)
+
+    totals = dict.fromkeys(ROLLUP_COLUMNS, 0)
+    if spans:
+        _add(totals, _daily_totals(session, pharmacy_code, spans))
+    if months:
+        _add(totals, _rollup_totals(session, MonthlyRollup, "month", pharmacy_code, months))
+    if years:
+        _add(totals, _rollup_totals(session, YearlyRollup, "year", pharmacy_code, years))
+    return totals
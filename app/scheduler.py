@@ -0,0 +1,111 @@
+import gc
+import os
+import datetime
+import threading
+import collections
+import psutil
+from concurrent.futures import ThreadPoolExecutor
+from app.pipeline import run_fetch
+from config.settings import FETCH_POLL_INTERVAL
+
+def _memory_mb():
+    return psutil.Process(os.getpid()).memory_info().rss / 1024 ** 2
+
+class IngestionScheduler:
+    """Runs the ingestion pipeline (app.pipeline.run_fetch) inside the web process, on one worker thread.
+
+    Runs never overlap: /api/force_update, the IDLE watchers and the periodic loop all queue on the same
+    worker, which shares the app's database engine and the pooled IMAP sessions from one run to the next.
+    A run is skipped when the process is already above memory_limit_mb. The last `history` per-run
+    results (see run_fetch) are kept, each tagged with its trigger, for /api/status.
+    """
+    def __init__(self, history=20, memory_limit_mb=200, lease=None):
+        self.memory_limit_mb = memory_limit_mb
+        self.lease = lease  # Optional LeaderElector; runs stop writing once it no longer holds the lease
+        self.results = collections.deque(maxlen=history)
+        self.current = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ingest")
+        self._stopped = threading.Event()
+        self._periodic = None
+
+    def _run(self, trigger, pharmacy_code=None, **options):
+        mem_usage = _memory_mb()
+        if mem_usage > self.memory_limit_mb:
+            print(f"[Scheduler] Memory usage {mem_usage:.2f} MB exceeded {self.memory_limit_mb}MB, skipping {trigger} fetch.", flush=True)
+            result = {
+                "status": "skipped",
+                "reason": f"Memory usage too high ({mem_usage:.2f} MB)",
+                "pharmacy": pharmacy_code,
+                "started_at": datetime.datetime.utcnow().isoformat()
+            }
+        else:
+            self.current = {"trigger": trigger, "pharmacy": pharmacy_code, "started_at": datetime.datetime.utcnow().isoformat()}
+            print(f"[Scheduler] Starting {trigger} fetch{f' for {pharmacy_code}' if pharmacy_code else ''}...", flush=True)
+            try:
+                result = run_fetch(pharmacy_code=pharmacy_code, lease=self.lease, **options)
+            except Exception as e:
+                print(f"[Scheduler] {trigger} fetch failed: {e}", flush=True)
+                result = dict(self.current, status="error", error=str(e))
+            finally:
+                self.current = None
+                gc.collect()
+            print(f"[Scheduler] {trigger} fetch finished: {result['status']}", flush=True)
+        result["trigger"] = trigger
+        self.results.append(result)
+        return result
+
+    def submit(self, trigger, pharmacy_code=None, **options):
+        """Queues a run and returns its Future; the result is the run's result dict. options go to run_fetch."""
+        return self._executor.submit(self._run, trigger, pharmacy_code, **options)
+
+    def run_now(self, trigger, pharmacy_code=None, timeout=None, **options):
+        """Queues a run and waits for its result. Raises concurrent.futures.TimeoutError after timeout seconds;
+        the run itself carries on in the background."""
+        return self.submit(trigger, pharmacy_code, **options).result(timeout)
+
+    def _periodic_loop(self, interval, initial_delay, should_run):
+        print(f"[Periodic Fetch] Waiting {initial_delay}s before starting periodic fetch...", flush=True)
+        if self._stopped.wait(initial_delay):
+            return
+        while not self._stopped.is_set():
+            if should_run is not None and not should_run():
+                self._stopped.wait(interval)
+                continue
+            print("=== [Periodic Fetch] Loop Start ===", flush=True)
+            try:
+                self.run_now("periodic")
+            except Exception as e:
+                print(f"[Periodic Fetch] Unexpected error in periodic fetch loop: {e}", flush=True)
+
+            delay = interval
+            mem_usage_after = _memory_mb()
+            print(f"[Periodic Fetch] Memory usage after: {mem_usage_after:.2f} MB", flush=True)
+            if mem_usage_after > self.memory_limit_mb + 50:
+                print(f"[Periodic Fetch] Memory still high after cleanup ({mem_usage_after:.2f} MB), sleeping longer...", flush=True)
+                delay = 1800
+            print(f"=== [Periodic Fetch] Loop End, sleeping {delay}s ===", flush=True)
+            self._stopped.wait(delay)
+
+    def start_periodic(self, interval=FETCH_POLL_INTERVAL, initial_delay=300, should_run=None):
+        """Starts a daemon thread that runs a fetch every interval seconds, after an initial_delay to let the app settle.
+
+        Cycles where should_run() returns False (e.g. this process isn't the leader) are skipped.
+        """
+        if self._periodic is None:
+            self._periodic = threading.Thread(target=self._periodic_loop, args=(interval, initial_delay, should_run),
+                                              daemon=True, name="periodic-fetch")
+            self._periodic.start()
+        return self._periodic
+
+    def stop(self):
+        self._stopped.set()
+
+    def status(self):
+        return {
+            "running": self.current,
+            "last_result": self.results[-1] if self.results else None,
+            "recent": [
+                {key: result.get(key) for key in ("trigger", "status", "pharmacy", "started_at", "duration_seconds", "processed")}
+                for result in reversed(self.results)
+            ]
+        }
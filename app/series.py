@@ -0,0 +1,105 @@
+from sqlalchemy import select, func, cast, String, Integer, Float
+from app.aggregates import total, average
+from app.models import DailyReport
+
+# Fields /api/series can return: every numeric DailyReport column, plus ratios computed from two of them
+SERIES_FIELDS = {
+    column.name: column
+    for column in DailyReport.__table__.columns
+    if isinstance(column.type, (Integer, Float)) and not column.primary_key
+}
+DERIVED_FIELDS = {
+    "dispensary_percent": (DailyReport.dispensary_turnover_today, DailyReport.total_turnover_today)
+}
+GRANULARITIES = ("day", "week", "month")
+
+# Stock levels are balances, not flows: a week or month takes the level on its first or last day
+_FIRST_OF_BUCKET = {"opening_stock_today"}
+_LAST_OF_BUCKET = {"closing_stock_today"}
+
+def read_series(session, pharmacy_code, start_date, end_date, **columns):
+    """Reads a per-day series for a pharmacy: [{"date": "YYYY-MM-DD", name: value, ...}] ordered by date.
+
+    columns maps output names to DailyReport columns (or SQL expressions over them); NULLs come back as 0.
+    Only report_date and those columns are selected, as plain rows through Core, and the date is
+    rendered as text by the database, so no ORM objects or per-row date formatting are involved.
+    """
+    names = ("date",) + tuple(columns)
+    statement = select(
+        cast(DailyReport.report_date, String),
+        *[func.coalesce(column, 0) for column in columns.values()]
+    ).where(
+        DailyReport.pharmacy_code == pharmacy_code,
+        DailyReport.report_date >= start_date,
+        DailyReport.report_date <= end_date
+    ).order_by(DailyReport.report_date)
+    return [dict(zip(names, row)) for row in session.execute(statement)]
+
+def _ratio(numerator, denominator):
+    return func.coalesce(numerator, 0) / func.nullif(denominator, 0) * 100
+
+def bucket_start(granularity, dialect):
+    """SQL expression for the first day ("YYYY-MM-DD") of the week (starting Monday) or month holding report_date."""
+    date = DailyReport.report_date
+    if dialect == "sqlite":
+        if granularity == "week":
+            # Forward to the next Sunday (or stay on it), then back to that week's Monday
+            return func.date(date, "weekday 0", "-6 days")
+        return func.strftime("%Y-%m-01", date)
+    if dialect == "postgresql":
+        return func.to_char(func.date_trunc(granularity, date), "YYYY-MM-DD")
+    raise ValueError(f"Weekly and monthly series aren't supported on {dialect}")
+
+def read_fields(session, pharmacy_code, start_date, end_date, fields, granularity="day"):
+    """Reads SERIES_FIELDS / DERIVED_FIELDS by name for a pharmacy in one query, ordered by date.
+
+    With granularity "day" this is read_series over the named columns. With "week" or "month" rows are
+    grouped in SQL by bucket_start and each entry's "date" is the bucket's first day, with "days" the
+    number of reports in it. Flows are summed, averages and percentages averaged over non-zero days (as
+    the *_for_range summaries do), stock levels taken from the first/last day and derived ratios
+    computed from the bucket's totals. Raises ValueError for an unknown field or granularity.
+    """
+    unknown = [name for name in fields if name not in SERIES_FIELDS and name not in DERIVED_FIELDS]
+    if unknown:
+        raise ValueError(f"Unknown field(s): {', '.join(unknown)}")
+    if granularity not in GRANULARITIES:
+        raise ValueError(f"granularity must be one of: {', '.join(GRANULARITIES)}")
+
+    if granularity == "day":
+        return read_series(session, pharmacy_code, start_date, end_date, **{
+            name: _ratio(*DERIVED_FIELDS[name]) if name in DERIVED_FIELDS else SERIES_FIELDS[name]
+            for name in fields
+        })
+
+    # Inner query: the day rows tagged with their bucket; opening/closing levels are picked per bucket
+    # with window functions so the outer GROUP BY can read them back with MAX
+    bucket = bucket_start(granularity, session.bind.dialect.name).label("bucket")
+    raw = {column.name for name in fields for column in DERIVED_FIELDS.get(name, ())}
+    raw.update(name for name in fields if name in SERIES_FIELDS)
+    inner = [bucket] + [SERIES_FIELDS[name] for name in sorted(raw)]
+    for name in fields:
+        if name in _FIRST_OF_BUCKET or name in _LAST_OF_BUCKET:
+            order = DailyReport.report_date if name in _FIRST_OF_BUCKET else DailyReport.report_date.desc()
+            inner.append(func.first_value(SERIES_FIELDS[name]).over(partition_by=bucket, order_by=order).label(f"{name}_edge"))
+    days = select(*inner).where(
+        DailyReport.pharmacy_code == pharmacy_code,
+        DailyReport.report_date >= start_date,
+        DailyReport.report_date <= end_date
+    ).subquery()
+
+    measures = []
+    for name in fields:
+        if name in DERIVED_FIELDS:
+            numerator, denominator = DERIVED_FIELDS[name]
+            measure = func.coalesce(_ratio(func.sum(days.c[numerator.name]), func.sum(days.c[denominator.name])), 0)
+        elif name in _FIRST_OF_BUCKET or name in _LAST_OF_BUCKET:
+            measure = func.coalesce(func.max(days.c[f"{name}_edge"]), 0)
+        elif name.startswith("avg_") or "_percent" in name:
+            measure = average(days.c[name])
+        else:
+            measure = total(days.c[name])
+        measures.append(measure)
+
+    names = ("date",) + tuple(fields) + ("days",)
+    statement = select(days.c.bucket, *measures, func.count()).group_by(days.c.bucket).order_by(days.c.bucket)
+    return [dict(zip(names, row)) for row in session.execute(statement)]
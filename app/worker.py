@@ -0,0 +1,202 @@
+"""
+Runs queued ingestion jobs (app/jobs.py) outside the web process.
+
+Usage:
+    python -m app.worker            # run until stopped
+    python -m app.worker --once     # drain the queue and exit
+
+While it holds the ingestion lease (app/leader.py) this process also schedules the background fetches
+(every FETCH_POLL_INTERVAL seconds, or from IMAP IDLE watchers with FETCH_MODE=idle) by queueing jobs.
+With JOB_RUNNER=worker the web processes only queue and report on jobs; with JOB_RUNNER=web they compete
+for the same lease, and whichever process wins does the fetching. Several workers can run; the others
+stand by to take over.
+"""
+import os
+import gc
+import json
+import time
+import uuid
+import socket
+import argparse
+import threading
+from app.db import create_session, create_lease_session, cleanup_db_sessions
+from app.jobs import enqueue_job, claim_job, renew_lease, finish_job
+from app.pipeline import run_fetch
+from app.leader import LeaderElector
+from config.settings import (
+    JOB_POLL_INTERVAL, JOB_LEASE_SECONDS, JOB_MAX_ATTEMPTS, FETCH_MODE, FETCH_POLL_INTERVAL
+)
+
+def _run_fetch_job(trigger, params, lease=None):
+    return run_fetch(lease=lease, **params)
+
+class JobWorker:
+    """Claims jobs from ingestion_jobs and runs them one at a time.
+
+    runner(trigger, params) runs a 'fetch' job and returns its result dict; it defaults to calling
+    app.pipeline.run_fetch directly, on behalf of lease (see run_fetch). The web app passes its
+    IngestionScheduler instead, so jobs it runs queue behind periodic and IDLE fetches. While a job runs its lease is renewed every lease_seconds / 3,
+    on a connection of its own (app.db.create_lease_session).
+    """
+    def __init__(self, runner=None, owner=None, poll_interval=JOB_POLL_INTERVAL, lease_seconds=JOB_LEASE_SECONDS,
+                 max_attempts=JOB_MAX_ATTEMPTS, enabled=None, lease=None):
+        self.runner = runner or (lambda trigger, params: _run_fetch_job(trigger, params, lease))
+        self.enabled = enabled  # Optional callable; no jobs are claimed while it returns False (see app/leader.py)
+        # Unique per worker, so two workers in one process can't renew or finish each other's jobs
+        self.owner = owner or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+
+    def wake(self):
+        """Checks for jobs now instead of at the next poll."""
+        self._wake.set()
+
+    def stop(self):
+        self._stopped.set()
+        self._wake.set()
+
+    def _heartbeat(self, job_id, done):
+        # Not the thread's scoped session: renewals commit while the job is halfway through writing a batch
+        session = create_lease_session()
+        try:
+            while not done.wait(self.lease_seconds / 3):
+                if not renew_lease(session, job_id, self.owner, self.lease_seconds):
+                    print(f"[Worker] Lost the lease on job {job_id}", flush=True)
+                    return
+        except Exception as e:
+            print(f"[Worker] Could not renew the lease on job {job_id}: {e}", flush=True)
+        finally:
+            session.close()
+
+    def run_one(self):
+        """Claims and runs one job. Returns False if there was nothing to do."""
+        session = create_session()
+        try:
+            job = claim_job(session, self.owner, self.lease_seconds, self.max_attempts)
+            if job is None:
+                return False
+            job_id, kind, trigger, params, attempt = job.id, job.kind, job.trigger, job.params, job.attempts
+        finally:
+            # The runner may use (and remove) this thread's scoped session itself
+            session.close()
+        print(f"[Worker] Running job {job_id} ({kind}, {trigger or 'manual'}, attempt {attempt})", flush=True)
+
+        done = threading.Event()
+        threading.Thread(target=self._heartbeat, args=(job_id, done), daemon=True, name=f"lease-{job_id}").start()
+        result = error = None
+        try:
+            if kind != 'fetch':
+                raise ValueError(f"Unknown job kind: {kind}")
+            result = self.runner(trigger or 'job', json.loads(params or '{}'))
+            if result.get("status") in ("error", "skipped"):
+                error = result.get("error") or result.get("reason") or result["status"]
+        except Exception as e:
+            error = str(e)
+        finally:
+            done.set()
+            gc.collect()
+
+        session = create_session()
+        try:
+            if not finish_job(session, job_id, self.owner, result, error):
+                print(f"[Worker] Job {job_id} finished after its lease was lost; result not recorded", flush=True)
+        finally:
+            session.close()
+        print(f"[Worker] Job {job_id} {'failed: ' + error if error else 'succeeded'}", flush=True)
+        return True
+
+    def run(self, once=False):
+        print(f"[Worker] {self.owner} waiting for jobs (poll every {self.poll_interval}s)", flush=True)
+        while not self._stopped.is_set():
+            try:
+                if (self.enabled is None or self.enabled()) and self.run_one():
+                    continue
+            except Exception as e:
+                print(f"[Worker] Error claiming or running a job: {e}", flush=True)
+            if once:
+                break
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+        cleanup_db_sessions()
+
+def enqueue_fetch(trigger, pharmacy_code=None):
+    """Queues (or coalesces into) a fetch job. Returns (job_id, coalesced)."""
+    session = create_session()
+    try:
+        job, coalesced = enqueue_job(session, 'fetch', {"pharmacy_code": pharmacy_code} if pharmacy_code else {}, trigger)
+        return job.id, coalesced
+    finally:
+        session.close()
+
+def _schedule_fetches(worker, elector):
+    """Queues the background fetches while elector says this worker is the leader, so they keep happening
+    whichever process wins the lease."""
+    idle_watchers = []
+
+    def on_new_mail(pharmacy_code):
+        enqueue_fetch("idle", pharmacy_code)
+        worker.wake()
+
+    def on_elected():
+        worker.wake()
+        if FETCH_MODE == "idle":
+            from app.idle_watcher import start_idle_watchers
+            idle_watchers.extend(start_idle_watchers(on_new_mail, should_run=elector.is_leader))
+            print(f"[Worker] IMAP IDLE watchers started for {len(idle_watchers)} mailbox(es)", flush=True)
+
+    def on_demoted():
+        for watcher in idle_watchers:
+            watcher.stop()
+        idle_watchers.clear()
+
+    elector.on_elected = on_elected
+    elector.on_demoted = on_demoted
+    if FETCH_MODE == "idle":
+        return
+
+    def loop():
+        while True:
+            if elector.is_leader():
+                try:
+                    enqueue_fetch("periodic")
+                    worker.wake()
+                except Exception as e:
+                    print(f"[Worker] Could not queue periodic fetch: {e}", flush=True)
+            time.sleep(FETCH_POLL_INTERVAL)
+    threading.Thread(target=loop, daemon=True, name="periodic-fetch").start()
+    print(f"[Worker] Queueing a fetch every {FETCH_POLL_INTERVAL}s while leader", flush=True)
+
+def main():
+    parser = argparse.ArgumentParser(description="Run queued ingestion jobs.")
+    parser.add_argument('--once', action='store_true', help='Run the jobs that are queued now, then exit')
+    parser.add_argument('--poll-interval', type=int, default=JOB_POLL_INTERVAL, help=f'Seconds between polls (default: {JOB_POLL_INTERVAL})')
+    args = parser.parse_args()
+
+    # However many workers are started, only the holder of the ingestion lease claims jobs and schedules fetches
+    elector = LeaderElector("ingestion")
+    if args.once:
+        elector.start()
+        try:
+            if not elector.wait_elected(timeout=60):
+                print("[Worker] Another process holds the ingestion lease, leaving the queue to it", flush=True)
+                return
+            JobWorker(poll_interval=args.poll_interval, enabled=elector.is_leader, lease=elector).run(once=True)
+        finally:
+            elector.stop()
+        return
+
+    worker = JobWorker(poll_interval=args.poll_interval, enabled=elector.is_leader, lease=elector)
+    _schedule_fetches(worker, elector)
+    elector.start()
+    try:
+        worker.run()
+    except KeyboardInterrupt:
+        print("[Worker] Stopped", flush=True)
+    finally:
+        elector.stop()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+from app.ingest import upsert_daily_reports, store_month_to_date, record_ingestion
+from config.settings import INGEST_BATCH_SIZE
+
+class ReportWriter:
+    """Buffers parsed reports and writes them batch_size at a time, one transaction per batch.
+
+    flush() upserts the DailyReport rows (ingest.upsert_daily_reports, which also recomputes the monthly and
+    yearly rollups they fall in), stores the newest month-to-date snapshot per month and the ledger entries, and
+    commits. Anything else the caller left pending in the session (archive index rows, mailbox sync
+    positions, backfill checkpoints) is committed with the same batch, so it can never get ahead of the
+    reports it refers to. With a lease (app.leader.LeaderElector), a batch only commits while the lease is
+    still held; otherwise flush() raises app.leader.LeaseLost.
+    """
+    def __init__(self, session, batch_size=INGEST_BATCH_SIZE, lease=None):
+        self.session = session
+        self.batch_size = max(1, batch_size)
+        self.lease = lease
+        self._pending = []
+
+    def __len__(self):
+        return len(self._pending)
+
+    @property
+    def full(self):
+        return len(self._pending) >= self.batch_size
+
+    def pharmacy_codes(self):
+        """The pharmacies with reports waiting in the buffer."""
+        return {pending[0] for pending in self._pending}
+
+    def add(self, pharmacy_code, report_date, data, mtd=None, message_id=None, digest=None):
+        """Queues one parsed report. message_id/digest, when given, are recorded in the ingestion ledger."""
+        self._pending.append((pharmacy_code, report_date, data, mtd, message_id, digest))
+
+    def flush(self):
+        """Writes and commits the buffered reports. Returns them as [(pharmacy_code, report_date, message_id, digest)].
+
+        On failure the transaction is rolled back, the buffer is dropped and the exception re-raised.
+        """
+        pending, self._pending = self._pending, []
+        try:
+            upsert_daily_reports(self.session, [
+                dict(data, pharmacy_code=pharmacy_code, report_date=report_date)
+                for pharmacy_code, report_date, data, mtd, message_id, digest in pending
+            ])
+            # The session doesn't autoflush, so each month snapshot and ledger key is written once per batch
+            latest_mtd, ledger = {}, {}
+            for pharmacy_code, report_date, data, mtd, message_id, digest in pending:
+                month_key = (pharmacy_code, report_date.strftime('%Y-%m'))
+                if mtd is not None and (month_key not in latest_mtd or latest_mtd[month_key][0] <= report_date):
+                    latest_mtd[month_key] = (report_date, mtd)
+                if digest is not None:
+                    ledger[(message_id or '', digest)] = (pharmacy_code, report_date)
+            for (pharmacy_code, _), (report_date, mtd) in latest_mtd.items():
+                store_month_to_date(self.session, pharmacy_code, report_date, mtd)
+            for (message_id, digest), (pharmacy_code, report_date) in ledger.items():
+                record_ingestion(self.session, message_id, digest, pharmacy_code, report_date)
+            if self.lease is not None:
+                # Flushed first, so the check runs under this transaction's locks right up to the commit
+                self.session.flush()
+                self.lease.ensure_held(self.session)
+            self.session.commit()
+        except Exception:
+            self.session.rollback()
+            raise
+        return [(pharmacy_code, report_date, message_id, digest)
+                for pharmacy_code, report_date, data, mtd, message_id, digest in pending]
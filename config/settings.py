@@ -7,6 +7,13 @@ load_dotenv()
 
 IMAP_SERVER = "imap.gmail.com" # Default IMAP server
 
+# IMAP SEARCH keys that pick out report emails on the server, e.g. 'FROM "reports@example.com" NOT SUBJECT "Fwd"'.
+# ANDed with the date/UID range of each fetch; override per mailbox with <CODE>_SEARCH_CRITERIA.
+# The default only excludes forwards, so every other email in the mailbox is still transferred and inspected:
+# set REPORT_SEARCH_CRITERIA (or <CODE>_SEARCH_CRITERIA) to the report sender/subject on each deploy
+DEFAULT_REPORT_SEARCH_CRITERIA = 'NOT SUBJECT "Fwd"'
+REPORT_SEARCH_CRITERIA = os.getenv("REPORT_SEARCH_CRITERIA", DEFAULT_REPORT_SEARCH_CRITERIA)
+
 # Define MAILBOXES structure by loading credentials from environment variables
 MAILBOXES = [
     {
@@ -14,6 +21,7 @@ MAILBOXES = [
         "name": "Reitz Pharmacy",
         "email_user": os.getenv("REITZ_GMAIL_USERNAME"),
         "email_password": os.getenv("REITZ_GMAIL_APP_PASSWORD"),
+        "search_criteria": os.getenv("REITZ_SEARCH_CRITERIA", REPORT_SEARCH_CRITERIA),
         "imap_server": IMAP_SERVER # Defaulting to global IMAP_SERVER
     },
     {
@@ -21,6 +29,7 @@ MAILBOXES = [
         "name": "Roos Pharmacy",
         "email_user": os.getenv("ROOS_GMAIL_USERNAME"),
         "email_password": os.getenv("ROOS_GMAIL_APP_PASSWORD"),
+        "search_criteria": os.getenv("ROOS_SEARCH_CRITERIA", REPORT_SEARCH_CRITERIA),
         "imap_server": IMAP_SERVER
     },
     {
@@ -28,6 +37,7 @@ MAILBOXES = [
         "name": "Tugela Pharmacy",
         "email_user": os.getenv("TUGELA_GMAIL_USERNAME"),
         "email_password": os.getenv("TUGELA_GMAIL_APP_PASSWORD"),
+        "search_criteria": os.getenv("TUGELA_SEARCH_CRITERIA", REPORT_SEARCH_CRITERIA),
         "imap_server": IMAP_SERVER
     },
     {
@@ -35,6 +45,7 @@ MAILBOXES = [
         "name": "Villiers Pharmacy",
         "email_user": os.getenv("VILLIERS_GMAIL_USERNAME"),
         "email_password": os.getenv("VILLIERS_GMAIL_APP_PASSWORD"),
+        "search_criteria": os.getenv("VILLIERS_SEARCH_CRITERIA", REPORT_SEARCH_CRITERIA),
         "imap_server": IMAP_SERVER
     },
     {
@@ -42,6 +53,7 @@ MAILBOXES = [
         "name": "Winterton Pharmacy",
         "email_user": os.getenv("WINTERTON_GMAIL_USERNAME"),
         "email_password": os.getenv("WINTERTON_GMAIL_APP_PASSWORD"),
+        "search_criteria": os.getenv("WINTERTON_SEARCH_CRITERIA", REPORT_SEARCH_CRITERIA),
         "imap_server": IMAP_SERVER
     }
 ]
@@ -54,6 +66,47 @@ GMAIL_PASSWORD = os.getenv("FALLBACK_GMAIL_APP_PASSWORD")
 # Database URI: use DATABASE_URL from .env if set, otherwise default to SQLite
 DATABASE_URI = os.getenv("DATABASE_URL", "sqlite:///db/daily_reports.db")
 
+# Compressed copies of every fetched report payload (app/archive.py), for offline re-ingestion with scripts/replay.py
+REPORT_ARCHIVE_DIR = os.getenv("REPORT_ARCHIVE_DIR", "archive")
+
+# Parsed reports written per database transaction by app/writer.py (fetch_latest.py, sync_all.py)
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "200"))
+
+# Messages per UID FETCH round-trip in app/email_fetcher.py
+IMAP_FETCH_BATCH_SIZE = int(os.getenv("IMAP_FETCH_BATCH_SIZE", "50"))
+
+# Socket timeout (seconds) for each IMAP connection
+IMAP_TIMEOUT = int(os.getenv("IMAP_TIMEOUT", "30"))
+# Pooled IMAP sessions are logged out after this many idle seconds, or this many seconds after login
+IMAP_POOL_MAX_IDLE = int(os.getenv("IMAP_POOL_MAX_IDLE", "900"))
+IMAP_POOL_MAX_AGE = int(os.getenv("IMAP_POOL_MAX_AGE", "3600"))
+
+# Mailboxes fetched in parallel by scripts/fetch_latest.py
+FETCH_CONCURRENCY = int(os.getenv("FETCH_CONCURRENCY", "3"))
+# Month windows fetched in parallel by the historical backfill (scripts/sync_all.py), each on its own IMAP connection
+BACKFILL_WORKERS = int(os.getenv("BACKFILL_WORKERS", "3"))
+
+# Background fetching in production: "poll" runs the ingestion pipeline (app/scheduler.py) every FETCH_POLL_INTERVAL seconds,
+# "idle" keeps an IMAP IDLE watcher per mailbox (app/idle_watcher.py) and fetches as mail arrives
+FETCH_MODE = os.getenv("FETCH_MODE", "poll")
+FETCH_POLL_INTERVAL = int(os.getenv("FETCH_POLL_INTERVAL", "600"))
+# Re-issue IDLE before servers drop it (RFC 2177 allows 29 minutes; some NATs are less patient)
+IMAP_IDLE_TIMEOUT = int(os.getenv("IMAP_IDLE_TIMEOUT", "540"))
+
+# Who runs queued ingestion jobs (/api/force_update, app/jobs.py): "web" runs them on the web process's
+# scheduler thread; "worker" leaves them, and periodic/IDLE fetching, to a separate `python -m app.worker`.
+# A worker started alongside JOB_RUNNER=web competes for the same ingestion lease and fetches when it wins
+JOB_RUNNER = os.getenv("JOB_RUNNER", "web")
+# Seconds between polls for new jobs, and how long a claimed job stays leased without a heartbeat
+JOB_POLL_INTERVAL = int(os.getenv("JOB_POLL_INTERVAL", "5"))
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "600"))
+# A job whose lease lapsed this many times (its worker kept dying) is marked failed
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+
+# Only the process holding the ingestion lease (app/leader.py) runs background fetches. It renews the lease
+# every third of this many seconds; if it dies, another process takes over once the lease runs out
+LEADER_LEASE_SECONDS = int(os.getenv("LEADER_LEASE_SECONDS", "60"))
+
 # Verify that critical environment variables are loaded for each mailbox
 missing_credentials = []
 for mailbox in MAILBOXES:
@@ -65,6 +118,11 @@ if missing_credentials:
     print(f"Warning: The following mailboxes have missing credentials: {', '.join(missing_credentials)}")
     print("These pharmacies will be skipped during email fetching.")
 
+unfiltered = [m['code'] for m in MAILBOXES if m["email_user"] and m["email_password"] and m["search_criteria"] == DEFAULT_REPORT_SEARCH_CRITERIA]
+if unfiltered:
+    print(f"Warning: No report search criteria set for: {', '.join(unfiltered)}. Every non-forwarded email is fetched; "
+          f"set REPORT_SEARCH_CRITERIA or <CODE>_SEARCH_CRITERIA (e.g. FROM \"reports@example.com\") to filter on the server.")
+
 if not DATABASE_URI:
     print("Error: DATABASE_URI is not set. Please check your .env file or ensure the default is correct.")
     sys.exit(1)
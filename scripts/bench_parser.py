@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""
+Parser benchmark and regression check built on MANAGE.htm.
+
+Times every parser backend on MANAGE.htm and generated variants (repeated body, extra rows,
+a missing section, cp1252 edge cases) and on each report section on its own. Records peak
+allocations with tracemalloc, checks that all backends return identical data dicts, and
+compares throughput against a stored baseline.
+
+Usage:
+    python3 scripts/bench_parser.py                   # run and compare against the baseline
+    python3 scripts/bench_parser.py --save-baseline   # run and store the results as the new baseline
+    python3 scripts/bench_parser.py --skip-baseline   # only check that the backends agree
+
+Exits with status 1 if backends disagree, throughput drops more than --tolerance below the baseline,
+or there is no baseline to compare against (unless --skip-baseline is given).
+"""
+import os
+import sys
+import re
+import io
+import json
+import time
+import argparse
+import contextlib
+import tracemalloc
+
+# Add project root to Python path
+current_dir = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.dirname(current_dir)
+sys.path.append(project_root)
+
+with contextlib.redirect_stdout(io.StringIO()):  # app import prints startup/config noise
+    from app.parser import parse_html_bytes, PARSER_BACKENDS, SECTION_HEADERS, REPORT_CHARSET
+
+MANAGE_PATH = os.path.join(project_root, 'MANAGE.htm')
+BASELINE_PATH = os.path.join(current_dir, 'bench_parser_baseline.json')
+TABLE_PATTERN = re.compile(r'<table\b.*?</table>', re.S | re.I)
+
+def _section_tables(html_text):
+    """Returns {section header: table html} for the sections the parser extracts."""
+    tables = {}
+    for match in TABLE_PATTERN.finditer(html_text):
+        for header in SECTION_HEADERS:
+            if header in match.group(0) and header not in tables:
+                tables[header] = match.group(0)
+                break
+    return tables
+
+def build_variants(html_text):
+    """Returns {variant name: report bytes} derived from MANAGE.htm."""
+    tables = _section_tables(html_text)
+    body_start = html_text.index('<body')
+    body_end = html_text.rindex('</body>')
+    head, body, tail = html_text[:body_start], html_text[body_start:body_end], html_text[body_end:]
+
+    extra_row = ('<tr><td bgcolor=#848484><font size=2>Extra Row {n}</font></td>'
+                 '<td>00001</td><td>1,234.56</td><td>00010</td><td>12,345.67</td></tr>\n')
+    extra_rows = ''.join(extra_row.format(n=n) for n in range(200))
+
+    # Smart punctuation, euro/fraction signs and a trailing non-breaking space inside a label cell
+    cp1252_text = html_text.replace('Vexall Support Team', 'Vexall Support Team – café € ’')
+    cp1252_text = cp1252_text.replace('>Cash Sales<', '>Cash Sales\xa0<').replace('Regards,', 'Regards ½,')
+    cp1252_bytes = cp1252_text.encode(REPORT_CHARSET)
+    # 0x81 is undefined in windows-1252; the bytes path must survive it
+    cp1252_bytes = cp1252_bytes.replace(b'Regards', b'Regards\x81', 1)
+
+    return {
+        'manage': html_text.encode(REPORT_CHARSET),
+        'repeated_body_x10': (head + body * 10 + tail).encode(REPORT_CHARSET),
+        'extra_rows': TABLE_PATTERN.sub(lambda m: m.group(0).replace('</table>', extra_rows + '</table>'), html_text).encode(REPORT_CHARSET),
+        'missing_turnover_section': html_text.replace(tables['TURNOVER SUMMARY'], '').encode(REPORT_CHARSET),
+        'cp1252_edge_cases': cp1252_bytes,
+    }
+
+def build_section_docs(html_text):
+    """Returns {section header: report bytes containing only that section's table}."""
+    body_start = html_text.index('<body')
+    head = html_text[:html_text.index('>', body_start) + 1]
+    return {
+        header: (head + table + '</body></html>').encode(REPORT_CHARSET)
+        for header, table in _section_tables(html_text).items()
+    }
+
+def _parse_quietly(payload, backend):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return parse_html_bytes(payload, backend=backend, with_mtd=True)
+
+def measure(payload, backend, min_seconds):
+    """Returns (parses/sec, peak tracemalloc KiB, result) for one payload and backend."""
+    result = _parse_quietly(payload, backend)  # warm-up, and the result to compare
+
+    tracemalloc.start()
+    _parse_quietly(payload, backend)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    iterations = 0
+    started = time.perf_counter()
+    elapsed = 0.0
+    while elapsed < min_seconds:
+        _parse_quietly(payload, backend)
+        iterations += 1
+        elapsed = time.perf_counter() - started
+    return iterations / elapsed, peak / 1024, result
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark app.parser backends on MANAGE.htm and variants.")
+    parser.add_argument('--backends', help=f"Comma-separated backends (default: {','.join(PARSER_BACKENDS)})")
+    parser.add_argument('--min-seconds', type=float, default=0.5, help='Minimum timing window per case (default: 0.5)')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed throughput drop vs. baseline (default: 0.25)')
+    parser.add_argument('--baseline', default=BASELINE_PATH, help='Baseline JSON file')
+    parser.add_argument('--save-baseline', action='store_true', help='Store this run as the new baseline')
+    parser.add_argument('--skip-baseline', action='store_true', help="Don't compare throughput against a baseline")
+    args = parser.parse_args()
+
+    backends = args.backends.split(',') if args.backends else list(PARSER_BACKENDS)
+    unknown = [b for b in backends if b not in PARSER_BACKENDS]
+    if unknown:
+        parser.error(f"Unknown backend(s): {', '.join(unknown)}. Available: {', '.join(PARSER_BACKENDS)}")
+
+    with open(MANAGE_PATH, 'r', encoding=REPORT_CHARSET) as f:
+        html_text = f.read()
+    cases = {f"variant:{name}": payload for name, payload in build_variants(html_text).items()}
+    cases.update({f"section:{header}": payload for header, payload in build_section_docs(html_text).items()})
+
+    failures = []
+    results = {backend: {} for backend in backends}
+    print(f"{'case':<40} {'backend':<12} {'parses/s':>10} {'ms/parse':>9} {'peak KiB':>9}")
+    for case, payload in cases.items():
+        outputs = {}
+        for backend in backends:
+            rate, peak_kib, outputs[backend] = measure(payload, backend, args.min_seconds)
+            results[backend][case] = rate
+            print(f"{case:<40} {backend:<12} {rate:>10.1f} {1000 / rate:>9.2f} {peak_kib:>9.0f}")
+        reference_backend = backends[0]
+        for backend in backends[1:]:
+            if outputs[backend] != outputs[reference_backend]:
+                data, mtd = outputs[backend]
+                ref_data, ref_mtd = outputs[reference_backend]
+                diff = {k: (ref_data[k], data[k]) for k in data if data[k] != ref_data[k]}
+                diff.update({k: (ref_mtd[k], mtd[k]) for k in mtd if mtd[k] != ref_mtd[k]})
+                failures.append(f"{case}: {backend} differs from {reference_backend}: {diff}")
+
+    compared = False
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print(f"Baseline saved to {args.baseline}")
+    elif args.skip_baseline:
+        print("Baseline comparison skipped (--skip-baseline).")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        compared = True
+        for backend, rates in results.items():
+            for case, rate in rates.items():
+                expected = baseline.get(backend, {}).get(case)
+                if expected and rate < expected * (1 - args.tolerance):
+                    failures.append(f"{case} [{backend}]: {rate:.1f} parses/s is more than "
+                                    f"{args.tolerance:.0%} below the baseline {expected:.1f}")
+    else:
+        # Timings are machine-specific, so the baseline is created on the machine that runs the check
+        failures.append(f"No baseline at {args.baseline}; run with --save-baseline on the reference tree to "
+                        f"create one, or pass --skip-baseline to only check that the backends agree")
+
+    if failures:
+        print("\nFAILED:")
+        for failure in failures:
+            print(f"  - {failure}")
+        sys.exit(1)
+    print("\nOK: all backends agree" + (" and throughput is within tolerance" if compared else ""))
+
+if __name__ == "__main__":
+    main()
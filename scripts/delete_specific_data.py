@@ -8,6 +8,7 @@ sys.path.append(project_root)
 
 from app.db import create_session, cleanup_db_sessions
 from app.models import DailyReport
+from app.rollups import refresh_rollups
 
 # --- Configuration ---
 PHARMACY_CODE_TO_DELETE = "reitz"
@@ -55,6 +56,8 @@ def delete_data_for_date():
         print("Deleting records...")
         for record in records_to_delete:
             session.delete(record)
+        session.flush()
+        refresh_rollups(session, [(record.pharmacy_code, record.report_date) for record in records_to_delete])
         
         session.commit()
         print("Records successfully deleted and transaction committed.")
@@ -7,6 +7,7 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 from app.db import create_session
 from app.models import DailyReport
+from app.rollups import rebuild_rollups
 
 def copy_pharmacy_data(session, source_code, dest_code):
     """
@@ -56,6 +57,8 @@ def copy_pharmacy_data(session, source_code, dest_code):
         )
         session.add(new_report)
     
+    session.flush()
+    rebuild_rollups(session, dest_code)
     print(f"Data copy for {dest_code} complete.")
 
 
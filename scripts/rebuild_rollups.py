@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+"""
+Recompute the monthly and yearly rollup tables (app/rollups.py) from the daily reports.
+
+Ingestion, /api/manual_turnover and the scripts keep the rollups up to date as they write; run this
+after daily rows were changed any other way, e.g. edited by hand in the database.
+
+Usage:
+    python3 scripts/rebuild_rollups.py                   # all pharmacies
+    python3 scripts/rebuild_rollups.py --pharmacy reitz
+"""
+import os
+import sys
+import time
+import argparse
+
+# Add project root to Python path
+current_dir = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.dirname(current_dir)
+sys.path.append(project_root)
+
+from app.db import create_session
+from app.rollups import rebuild_rollups
+from config import settings
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuild the monthly and yearly rollups from the daily reports.")
+    parser.add_argument('--pharmacy', help='Only rebuild this pharmacy code')
+    args = parser.parse_args()
+
+    session = create_session()
+    print(f"Database: {settings.DATABASE_URI}")
+    started = time.perf_counter()
+    try:
+        months = rebuild_rollups(session, args.pharmacy)
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+    print(f"Rebuilt {months} monthly rollup(s){f' for {args.pharmacy}' if args.pharmacy else ''} in {time.perf_counter() - started:.1f}s")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+Re-parse archived daily report HTML files across a process pool and write them to the database.
+
+Files are expected to be named like the fetcher's temp files: <pharmacy>_<YYYYMMDD>_<anything>.htm.
+When the name doesn't carry that, --pharmacy is used and the date is read from the report's
+"Generated on YYYY/MM/DD" line.
+
+Usage:
+    python3 scripts/reparse.py /path/to/reports --workers 8
+    python3 scripts/reparse.py reports.zip --pharmacy reitz --dry-run
+"""
+import os
+import sys
+import re
+import time
+import datetime
+import argparse
+import tarfile
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import psutil
+
+# Add project root to Python path
+current_dir = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.dirname(current_dir)
+sys.path.append(project_root)
+
+REPORT_EXTENSIONS = ('.htm', '.html')
+FILENAME_PATTERN = re.compile(r'^(?P<pharmacy>[A-Za-z0-9]+)_(?P<date>\d{8})_')
+GENERATED_ON_PATTERN = re.compile(rb'Generated on (\d{4})/(\d{2})/(\d{2})')
+
+def _report_key(name, payload, default_pharmacy):
+    """Returns (pharmacy_code, report_date) for a report file, or None if it can't be determined."""
+    match = FILENAME_PATTERN.match(os.path.basename(name))
+    if match:
+        try:
+            return match.group('pharmacy'), datetime.datetime.strptime(match.group('date'), '%Y%m%d').date()
+        except ValueError:
+            pass
+    if default_pharmacy:
+        generated = GENERATED_ON_PATTERN.search(payload)
+        if generated:
+            year, month, day = (int(part) for part in generated.groups())
+            return default_pharmacy, datetime.date(year, month, day)
+    return None
+
+def _iter_report_files(path):
+    """Yields (name, payload bytes) for every report file in a directory, .zip or tar archive."""
+    if os.path.isdir(path):
+        for dirpath, _, filenames in os.walk(path):
+            for filename in sorted(filenames):
+                if filename.lower().endswith(REPORT_EXTENSIONS):
+                    with open(os.path.join(dirpath, filename), 'rb') as f:
+                        yield filename, f.read()
+    elif zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as archive:
+            for member in archive.infolist():
+                if not member.is_dir() and member.filename.lower().endswith(REPORT_EXTENSIONS):
+                    yield member.filename, archive.read(member)
+    elif tarfile.is_tarfile(path):
+        with tarfile.open(path) as archive:
+            for member in archive:
+                if member.isfile() and member.name.lower().endswith(REPORT_EXTENSIONS):
+                    yield member.name, archive.extractfile(member).read()
+    else:
+        raise ValueError(f"{path} is not a directory, zip or tar archive")
+
+def _init_worker():
+    # The parser prints progress per report; keep worker output out of the summary
+    sys.stdout = open(os.devnull, 'w')
+
+def _parse_job(job):
+    """Runs in a worker process. Returns (name, pharmacy_code, report_date, data, mtd, error, pid, rss_mb)."""
+    from app.parser import parse_html_bytes
+    name, pharmacy_code, report_date, payload, backend = job
+    data = mtd = error = None
+    try:
+        data, mtd = parse_html_bytes(payload, backend=backend, with_mtd=True)
+    except Exception as e:
+        error = str(e)
+    rss_mb = psutil.Process(os.getpid()).memory_info().rss / 1024 ** 2
+    return name, pharmacy_code, report_date, data, mtd, error, os.getpid(), rss_mb
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-parse archived report HTML files in parallel and store the results.")
+    parser.add_argument('path', help='Directory, .zip or tar archive of raw report .htm files')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Parser processes (default: CPU count)')
+    parser.add_argument('--batch-size', type=int, default=200, help='Reports per database transaction (default: 200)')
+    parser.add_argument('--pharmacy', help='Pharmacy code for files whose name does not start with <pharmacy>_<YYYYMMDD>_')
+    parser.add_argument('--backend', help='Parser backend (see app.parser.PARSER_BACKENDS)')
+    parser.add_argument('--dry-run', action='store_true', help='Parse only; do not write to the database')
+    args = parser.parse_args()
+
+    session = writer = None
+    if not args.dry_run:
+        from app.db import create_session
+        from app.writer import ReportWriter
+        from config import settings
+        session = create_session()
+        # Same write path as ingestion: one upsert transaction per batch
+        writer = ReportWriter(session, batch_size=args.batch_size)
+        print(f"Database: {settings.DATABASE_URI}")
+
+    print(f"Re-parsing {args.path} with {args.workers} worker(s), batch size {args.batch_size}", flush=True)
+    started = time.perf_counter()
+    parsed = failed = skipped = stored = 0
+    worker_rss = {}
+    max_in_flight = args.workers * 4
+
+    def handle(result):
+        nonlocal parsed, failed, stored
+        name, pharmacy_code, report_date, data, mtd, error, pid, rss_mb = result
+        worker_rss[pid] = max(rss_mb, worker_rss.get(pid, 0))
+        if error:
+            failed += 1
+            print(f"[ERROR] {name}: {error}", flush=True)
+            return
+        parsed += 1
+        if parsed % 500 == 0:
+            elapsed = time.perf_counter() - started
+            print(f"[Progress] {parsed} parsed, {parsed / elapsed:.1f} files/sec", flush=True)
+        if writer is None:
+            return
+        writer.add(pharmacy_code, report_date, data, mtd)
+        if writer.full:
+            stored += len(writer.flush())
+
+    try:
+        with ProcessPoolExecutor(max_workers=args.workers, initializer=_init_worker) as executor:
+            in_flight = set()
+            for name, payload in _iter_report_files(args.path):
+                key = _report_key(name, payload, args.pharmacy)
+                if key is None:
+                    skipped += 1
+                    print(f"[SKIP] {name}: no pharmacy/date in filename (use --pharmacy)", flush=True)
+                    continue
+                in_flight.add(executor.submit(_parse_job, (name, key[0], key[1], payload, args.backend)))
+                if len(in_flight) >= max_in_flight:
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        handle(future.result())
+            for future in in_flight:
+                handle(future.result())
+
+        if writer is not None and len(writer):
+            stored += len(writer.flush())
+    finally:
+        if session is not None:
+            session.close()
+
+    elapsed = time.perf_counter() - started
+    print(f"Done in {elapsed:.1f}s: {parsed} parsed, {failed} failed, {skipped} skipped, {stored} stored "
+          f"({parsed / elapsed if elapsed else 0:.1f} files/sec)")
+    for pid, rss_mb in sorted(worker_rss.items()):
+        print(f"  worker {pid}: peak RSS {rss_mb:.1f} MB")
+
+if __name__ == "__main__":
+    main()
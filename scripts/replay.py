@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+Re-ingest reports from the local raw report archive (app/archive.py) without touching IMAP.
+
+For every (pharmacy, date) the most recently archived payload is parsed again and written to the
+database, e.g. after a parser fix or a new REPORT_SCHEMA column.
+
+Usage:
+    python3 scripts/replay.py                                  # everything in the archive
+    python3 scripts/replay.py --pharmacy reitz --start 2025-01-01 --end 2025-06-30
+    python3 scripts/replay.py --dry-run                        # parse only
+"""
+import os
+import sys
+import time
+import datetime
+import argparse
+import contextlib
+import io
+
+# Add project root to Python path
+current_dir = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.dirname(current_dir)
+sys.path.append(project_root)
+
+from app.db import create_session
+from app.parser import parse_html_bytes
+from app.writer import ReportWriter
+from app.archive import latest_archived, read_archived
+from config import settings
+
+def _date(value):
+    return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-ingest archived raw reports without network access.")
+    parser.add_argument('--pharmacy', help='Only replay this pharmacy code')
+    parser.add_argument('--start', type=_date, help='First report date (YYYY-MM-DD)')
+    parser.add_argument('--end', type=_date, help='Last report date (YYYY-MM-DD)')
+    parser.add_argument('--batch-size', type=int, default=200, help='Reports per database transaction (default: 200)')
+    parser.add_argument('--backend', help='Parser backend (see app.parser.PARSER_BACKENDS)')
+    parser.add_argument('--archive-dir', default=settings.REPORT_ARCHIVE_DIR, help=f'Archive directory (default: {settings.REPORT_ARCHIVE_DIR})')
+    parser.add_argument('--dry-run', action='store_true', help='Parse only; do not write to the database')
+    args = parser.parse_args()
+
+    session = create_session()
+    print(f"Database: {settings.DATABASE_URI}")
+    print(f"Archive: {args.archive_dir}")
+
+    entries = latest_archived(session, args.pharmacy, args.start, args.end)
+    session.expunge_all()  # keep the loaded index rows from being expired and re-queried after every commit
+    print(f"Replaying {len(entries)} archived report(s)...", flush=True)
+
+    started = time.perf_counter()
+    parsed = failed = stored = 0
+    # Same write path as ingestion: one upsert transaction per batch, with ledger entries
+    writer = ReportWriter(session, batch_size=args.batch_size)
+    try:
+        for entry in entries:
+            try:
+                payload = read_archived(entry, args.archive_dir)
+                with contextlib.redirect_stdout(io.StringIO()):  # per-report parser chatter
+                    data, mtd = parse_html_bytes(payload, entry.charset, backend=args.backend, with_mtd=True)
+            except Exception as e:
+                failed += 1
+                print(f"[ERROR] {entry.pharmacy_code} {entry.report_date} ({entry.payload_sha256[:12]}): {e}", flush=True)
+                continue
+            parsed += 1
+            if args.dry_run:
+                continue
+            writer.add(entry.pharmacy_code, entry.report_date, data, mtd, entry.message_id, entry.payload_sha256)
+            if writer.full:
+                stored += len(writer.flush())
+                print(f"[Progress] {stored}/{len(entries)} stored", flush=True)
+        if len(writer):
+            stored += len(writer.flush())
+    finally:
+        session.close()
+
+    elapsed = time.perf_counter() - started
+    print(f"Done in {elapsed:.1f}s: {parsed} parsed, {failed} failed, {stored} stored "
+          f"({parsed / elapsed if elapsed else 0:.1f} reports/sec)")
+
+if __name__ == "__main__":
+    main()
@@ -1,91 +1,247 @@
 #!/usr/bin/env python3
+"""
+Historical backfill of every mailbox, one calendar month at a time.
+
+Each (mailbox, month) window is searched and fetched on its own IMAP connection, several windows in
+parallel, while this thread parses and writes the reports. A window is checkpointed in
+backfill_checkpoints once all of its reports are stored, so an interrupted backfill (timeout, memory
+guard, Ctrl-C) resumes with the windows that are still missing. The current month is never
+checkpointed; it is searched again on every run.
+
+Usage:
+    python3 scripts/sync_all.py                          # all mailboxes, last ~10 years
+    python3 scripts/sync_all.py --pharmacy reitz --workers 4
+    python3 scripts/sync_all.py --restart                # forget checkpoints and backfill everything again
+"""
 import os
 import sys
+import gc
+import time
+import queue
 import datetime
-import shutil
 import argparse
+import threading
+import psutil
+from concurrent.futures import ThreadPoolExecutor
 
 # Add project root to Python path
 current_dir = os.path.dirname(os.path.abspath(__file__))
 project_root = os.path.dirname(current_dir)
 sys.path.append(project_root)
 
-from app.db import create_session
-from app.models import DailyReport
-from app.parser import parse_html_daily
-from app.email_fetcher import sync_all_emails # Uses a large day count (3650) by default
+from app.db import create_session, cleanup_db_sessions
+from app.models import BackfillCheckpoint
+from app.parser import parse_html_bytes
+from app.ingest import payload_sha256, ingested_keys, get_mailbox_state, completed_windows, mark_window_complete
+from app.archive import archive_report
+from app.writer import ReportWriter
+from app.email_fetcher import month_windows, mailbox_position, fetch_emails_in_window, advance_sync_state
 from config import settings
 
-TEMP_HTML_DIR = "/tmp/daily_html/"
+def _put(reports, message, abort):
+    # Don't block forever on a full queue once the writer has stopped listening
+    while not abort.is_set():
+        try:
+            reports.put(message, timeout=1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+def _fetch_window(pharmacy_config, window, reports, stop, abort):
+    """Runs in a fetcher thread. Puts ('report', key, item, None) for every report in the window, then
+    ('done', key, None, error), where key is (pharmacy code, window).
+    """
+    key = (pharmacy_config["code"], window)
+    error = None
+    if not stop.is_set():
+        try:
+            email_iter = fetch_emails_in_window(pharmacy_config, window[0], window[1], in_memory=True)
+            for item in email_iter:
+                if not _put(reports, ('report', key, item, None), abort) or stop.is_set():
+                    email_iter.close()
+                    break
+        except Exception as e:
+            error = e
+    _put(reports, ('done', key, None, error), abort)
+
+def _duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h{minutes:02d}m{seconds:02d}s" if hours else f"{minutes}m{seconds:02d}s"
 
 def main():
-    parser = argparse.ArgumentParser()
+    parser = argparse.ArgumentParser(description="Resumable month-by-month backfill of all historical report emails.")
     parser.add_argument('--pharmacy', help='Pharmacy code to sync (e.g., winterton)')
+    parser.add_argument('--reingest', action='store_true', help='Re-parse reports even if the ingestion ledger has already seen them')
+    parser.add_argument('--days', type=int, default=3650, help='How far back to backfill (default: 3650)')
+    parser.add_argument('--workers', type=int, default=settings.BACKFILL_WORKERS,
+                        help=f'Windows fetched in parallel, one IMAP connection each (default: {settings.BACKFILL_WORKERS})')
+    parser.add_argument('--restart', action='store_true', help='Ignore and clear existing checkpoints')
     args = parser.parse_args()
 
     session = create_session()
     print(f"Database: {settings.DATABASE_URI}")
 
-    # sync_all_emails fetches for a very long period (e.g., 10 years)
-    # by default to get all historical emails.
+    today = datetime.date.today()
+    windows = month_windows(today - datetime.timedelta(days=args.days - 1), today)
 
+    # Per-mailbox state lives on this (the writer) thread only
+    configs, seen, sync_states, positions, remaining, failed = {}, {}, {}, {}, {}, {}
+    tasks = []
+    skipped_windows = 0
     for pharmacy_config in settings.MAILBOXES:
-        if args.pharmacy and pharmacy_config["code"] != args.pharmacy:
+        code = pharmacy_config["code"]
+        if args.pharmacy and code != args.pharmacy:
+            continue
+        pharmacy_name = pharmacy_config.get("name", code)
+        if not pharmacy_config.get("email_user") or not pharmacy_config.get("email_password"):
+            print(f"[SKIP] Missing email credentials for {pharmacy_name}, skipping...")
             continue
-        pharmacy_name = pharmacy_config.get("name", pharmacy_config["code"])
-        print(f"Attempting to sync ALL emails for: {pharmacy_name} ({pharmacy_config.get('username')})")
-        
-        processed_files_count = 0
+        email_user = pharmacy_config["email_user"]
+        if args.restart:
+            session.query(BackfillCheckpoint).filter_by(pharmacy_code=code).delete(synchronize_session=False)
+        done = completed_windows(session, code, email_user)
+        pending_windows = [window for window in windows if window[0] not in done]
+        skipped_windows += len(windows) - len(pending_windows)
         try:
-            # sync_all_emails internally calls fetch_emails_last_n_days with a large 'days' value
-            for filepath, report_date_obj in sync_all_emails(pharmacy_config):
-                if filepath:
-                    print(f"Parsing report: {filepath} for date: {report_date_obj.strftime('%Y-%m-%d')}")
+            # Where incremental fetches should continue once this mailbox is fully backfilled
+            positions[code] = mailbox_position(pharmacy_config)
+        except Exception as e:
+            print(f"[ERROR] Could not sync emails for {pharmacy_name}: {e}")
+            continue
+        configs[code] = pharmacy_config
+        seen[code] = set() if args.reingest else ingested_keys(session, code)
+        sync_states[code] = get_mailbox_state(session, code)
+        remaining[code] = len(pending_windows)
+        failed[code] = 0
+        tasks.extend((pharmacy_config, window) for window in pending_windows)
+    session.commit()
+
+    workers = max(1, args.workers)
+    print(f"Backfilling {len(tasks)} month window(s) across {len(configs)} mailbox(es), {workers} at a time "
+          f"({skipped_windows} already checkpointed)...", flush=True)
+
+    # Bounded, so fetchers wait for the writer instead of buffering whole windows in memory
+    reports = queue.Queue(maxsize=workers * 2)
+    stop = threading.Event()
+    abort = threading.Event()
+    # Reports per window, and how many of them failed to parse; a window with failures isn't checkpointed
+    window_reports, window_failures = {}, {}
+    finished = windows_done = reports_stored = unchanged = 0
+    started = time.perf_counter()
+    # Reports, archive index rows, checkpoints and sync positions are committed together, one batch at a time
+    writer = ReportWriter(session)
+
+    def flush():
+        nonlocal reports_stored
+        count = len(writer)
+        try:
+            written = writer.flush()
+        except Exception as e:
+            # The batch's checkpoints were rolled back with it; stop so no later window gets checkpointed either
+            print(f"[ERROR] Failed to save {count} report(s), stopping; run again to resume: {e}", flush=True)
+            stop.set()
+            return
+        for code, report_date, message_id, digest in written:
+            seen[code].add((message_id, digest))
+        reports_stored += len(written)
+    try:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="backfill") as executor:
+            for pharmacy_config, window in tasks:
+                executor.submit(_fetch_window, pharmacy_config, window, reports, stop, abort)
+
+            # Single writer: everything below runs on this thread, one report at a time
+            try:
+                pending = len(tasks)
+                while pending:
+                    kind, key, item, error = reports.get()
+                    code, (window_start, window_end) = key
+                    pharmacy_config = configs[code]
+                    pharmacy_name = pharmacy_config.get("name", code)
+
+                    if kind == 'done':
+                        pending -= 1
+                        finished += 1
+                        found = window_reports.pop(key, 0)
+                        parse_failures = window_failures.pop(key, 0)
+                        if error is None and parse_failures:
+                            error = f"{parse_failures} report(s) could not be parsed"
+                        # error includes emails that couldn't be fetched (email_fetcher.IncompleteFetch)
+                        if error is not None:
+                            failed[code] += 1
+                            print(f"[ERROR] Window {window_start:%Y-%m} failed for {pharmacy_name}, will retry next run: {error}", flush=True)
+                            continue
+                        if stop.is_set():
+                            continue  # Not checkpointed (e.g. a batch failed to save); the next run fetches this window again
+                        windows_done += 1
+                        remaining[code] -= 1
+                        if window_end < today:
+                            mark_window_complete(session, code, pharmacy_config["email_user"], window_start, window_end, found)
+                        if remaining[code] == 0 and failed[code] == 0:
+                            advance_sync_state(sync_states[code], pharmacy_config, *positions[code])
+                            print(f"Finished syncing all emails for {pharmacy_name}.", flush=True)
+
+                        elapsed = time.perf_counter() - started
+                        eta = elapsed / finished * (len(tasks) - finished)
+                        print(f"[Progress] {finished}/{len(tasks)} windows ({finished / len(tasks):.0%}), "
+                              f"{reports_stored} report(s) stored, elapsed {_duration(elapsed)}, ETA {_duration(eta)} "
+                              f"- {pharmacy_name} {window_start:%Y-%m}: {found} report(s)", flush=True)
+                        continue
+
+                    if stop.is_set():
+                        continue
+                    window_reports[key] = window_reports.get(key, 0) + 1
+                    (payload, charset, message_id), report_date_obj, subject = item
+
+                    # Skip forwarded emails that don't contain the report
+                    if "fwd:" in subject.lower():
+                        continue
+
+                    digest = payload_sha256(payload)
+                    if (message_id, digest) in seen[code]:
+                        unchanged += 1
+                        continue
+
+                    # Keep the raw payload before parsing, so parser fixes can be replayed offline
                     try:
-                        data = parse_html_daily(filepath)
-                        data['pharmacy_code'] = pharmacy_config["code"]
-                        data['report_date'] = report_date_obj
-
-                        # Delete existing record for this pharmacy and date, if any
-                        session.query(DailyReport).filter_by(
-                            pharmacy_code=pharmacy_config["code"],
-                            report_date=report_date_obj
-                        ).delete(synchronize_session='fetch')
-                        
-                        new_report = DailyReport(**data)
-                        session.add(new_report)
-                        session.commit()
-                        print(f"[SUCCESS] Report data saved to database for {pharmacy_config['code']} - {report_date_obj.strftime('%Y-%m-%d')}")
-                        processed_files_count += 1
+                        archive_report(session, payload, charset, message_id, code, report_date_obj, digest)
                     except Exception as e:
-                        session.rollback()
-                        print(f"[ERROR] Failed to parse or save report {filepath}: {e}")
+                        print(f"[ERROR] Failed to archive report for {report_date_obj}: {e}")
+                    try:
+                        data, mtd = parse_html_bytes(payload, charset, with_mtd=True)
+                        writer.add(code, report_date_obj, data, mtd, message_id, digest)
+                        if writer.full:
+                            flush()
+                    except Exception as e:
+                        print(f"[ERROR] Failed to parse report '{subject}' for {report_date_obj}: {e}")
+                        window_failures[key] = window_failures.get(key, 0) + 1
                     finally:
-                        if os.path.exists(filepath):
-                            try:
-                                os.remove(filepath)
-                                print(f"Removed temporary file: {filepath}")
-                            except OSError as e_rm:
-                                print(f"[ERROR] Could not remove temp file {filepath}: {e_rm}")
-                else:
-                    print(f"[WARN] sync_all_emails yielded None filepath for {report_date_obj}")
-            
-            if processed_files_count == 0:
-                print(f"No new email reports found or processed during full sync for {pharmacy_name}.")
-
-        except Exception as e_fetch:
-            print(f"[ERROR] Could not sync emails for {pharmacy_name}: {e_fetch}")
-        
-        print(f"Finished syncing all emails for {pharmacy_name}.")
-
-    if os.path.exists(TEMP_HTML_DIR) and not os.listdir(TEMP_HTML_DIR):
+                        del payload
+                        gc.collect()
+
+                        current_memory = psutil.Process(os.getpid()).memory_info().rss / 1024 ** 2
+                        if current_memory > 150 and not stop.is_set():
+                            print(f"[WARNING] Memory usage high ({current_memory:.2f} MB), stopping; "
+                                  f"run again to resume from the last checkpoint", flush=True)
+                            stop.set()
+                flush()
+            finally:
+                # Fetchers blocked on a full queue must not keep the pool from shutting down
+                stop.set()
+                abort.set()
+    finally:
         try:
-            shutil.rmtree(TEMP_HTML_DIR)
-            print(f"Cleaned up empty temporary directory: {TEMP_HTML_DIR}")
-        except OSError as e_rmdir:
-            print(f"[ERROR] Could not remove temp directory {TEMP_HTML_DIR}: {e_rmdir}")
+            session.close()
+            cleanup_db_sessions()
+        except Exception as e:
+            print(f"[ERROR] Error closing database session: {e}")
 
-    session.close()
+    elapsed = time.perf_counter() - started
+    print(f"Backfill finished in {_duration(elapsed)}: {windows_done}/{len(tasks)} window(s) completed, "
+          f"{reports_stored} report(s) stored, {unchanged} unchanged report(s) skipped via the ingestion ledger.")
+    if windows_done < len(tasks):
+        print("Some windows were not completed; run again to resume.")
 
 if __name__ == "__main__":
     main()